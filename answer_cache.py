@@ -0,0 +1,93 @@
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# Кэш ответов на повторяющиеся вопросы
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+# Сортировка слов склеивает разные вопросы («Венера в Скорпионе, Марс в Тельце»
+# и «Венера в Тельце, Марс в Скорпионе»), поэтому по умолчанию выключена
+ANSWER_CACHE_SORT_WORDS = os.getenv("ANSWER_CACHE_SORT_WORDS", "0") == "1"
+# По умолчанию кэшируем только первые реплики диалога
+ANSWER_CACHE_MULTI_TURN = os.getenv("ANSWER_CACHE_MULTI_TURN", "0") == "1"
+
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_question(text: str, sort_words: bool = ANSWER_CACHE_SORT_WORDS) -> str:
+    """Регистр, ё/е, пунктуация и (опционально) порядок слов не влияют на ключ"""
+    words = _NON_WORD_RE.sub(" ", text.lower().replace("ё", "е")).split()
+    if sort_words:
+        words.sort()
+    return " ".join(words)
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(
+        json.dumps(value, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class AnswerCache:
+    """LRU-кэш ответов с TTL и счетчиками попаданий"""
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 multi_turn: bool = ANSWER_CACHE_MULTI_TURN):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.multi_turn = multi_turn
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def make_key(self, question: str, context: List[dict], params: dict) -> Optional[str]:
+        """Ключ кэша или None, если запрос кэшировать нельзя.
+
+        context — сообщения до вопроса (системный промпт и прошлые реплики),
+        params — параметры генерации без messages.
+        """
+        prior_turns = [m for m in context if m.get("role") != "system"]
+        if prior_turns and not self.multi_turn:
+            return None
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        scope = _digest({
+            "context": [(m["role"], m["content"]) for m in context],
+            "params": params
+        })
+        return f"{scope}:{normalized}"
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Optional[str], answer: str):
+        if key is None:
+            return
+        self._entries[key] = (answer, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,491 @@
+"""Офлайн-нагрузочный тест бота без сети и без затрат на API.
+
+Поднимает локальную заглушку DeepSeek и Bot API на 127.0.0.1, создает
+синтетических пользователей и прогоняет их сообщения через обработчики
+бота (режим direct) или через настоящий вебхук (режим webhook).
+
+Пример:
+    python benchmark.py --users 200 --messages 5 --mode webhook --ds-429 0.05
+    python benchmark.py --users 50 --fail-p95 8 --json report.json
+"""
+import os
+import gc
+import hashlib
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tracemalloc
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+BENCH_TOKEN = "123456:BENCHMARK"
+BENCH_WEBHOOK_PATH = "/bench-webhook"
+END_MARK = "∎"
+# Промежуточные тексты бота: заглушка, позиция в очереди, потоковая правка
+INTERIM_PREFIXES = ("🔭", "⏳ Сейчас много")
+STREAM_CURSOR = " ▌"
+
+QUESTIONS = [
+    "Как Луна в Весах влияет на отношения?",
+    "Сатурн в 10 доме — что это значит для карьеры?",
+    "Как проработать аспект Марс-Плутон?",
+    "Что показывает мой восходящий знак о моем стиле?",
+    "Почему ретроградный Меркурий так на меня влияет?",
+    "Что значит Венера в Скорпионе?",
+    "Как понять свою Лунную ноду?",
+    "Я Лев, что меня ждет в этом месяце?",
+]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(len(ordered) * p / 100 + 0.5)) - 1))
+    return ordered[index]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ============ ЗАГЛУШКА DEEPSEEK И BOT API ============
+class FakeUpstream:
+    """HTTP/1.1-сервер с keep-alive: /chat/completions (DeepSeek) и /bot<token>/<method> (Telegram)"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.port = 0
+        self.deepseek_calls = 0
+        self.deepseek_statuses: Dict[int, int] = {}
+        self.telegram_calls: Dict[str, int] = {}
+        # Контекстный кэш DeepSeek: префиксы промптов по границам сообщений
+        self._prefixes = set()
+        self.prompt_tokens = 0
+        self.prompt_cache_hit_tokens = 0
+        self._message_id = 0
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        """Future завершится финальным ответом бота в чат: True — ответ модели, False — текст ошибки"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        return future
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                _, path, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                body = await reader.readexactly(length) if length else b""
+
+                if path.endswith("/chat/completions"):
+                    await self._deepseek(body, writer)
+                elif path.startswith("/bot"):
+                    await self._telegram(path.rsplit("/", 1)[-1], headers, body, writer)
+                else:
+                    await self._respond(writer, 404, b"{}")
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, body: bytes,
+                       content_type: str = "application/json", extra: str = ""):
+        writer.write(
+            f"HTTP/1.1 {status} X\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n{extra}\r\n".encode()
+            + body
+        )
+        await writer.drain()
+
+    # ---- DeepSeek ----
+    async def _deepseek(self, body: bytes, writer: asyncio.StreamWriter):
+        args = self.args
+        self.deepseek_calls += 1
+        payload = json.loads(body)
+        # Задержка до первого токена: логнормальное распределение вокруг медианы
+        await asyncio.sleep(args.ds_latency * self.rng.lognormvariate(0, args.ds_sigma))
+
+        roll = self.rng.random()
+        if roll < args.ds_429:
+            return await self._deepseek_status(writer, 429, "retry-after: 1\r\n")
+        if roll < args.ds_429 + args.ds_503:
+            return await self._deepseek_status(writer, 503)
+        self.deepseek_statuses[200] = self.deepseek_statuses.get(200, 0) + 1
+
+        prompt_tokens, hit_tokens = self._prompt_cache(payload.get("messages", []))
+        completion_tokens = min(args.ds_tokens, int(payload.get("max_tokens") or args.ds_tokens))
+        words = [f"звезда{index} " for index in range(completion_tokens - 1)] + [END_MARK]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_cache_hit_tokens": hit_tokens, "prompt_cache_miss_tokens": prompt_tokens - hit_tokens}
+
+        if not payload.get("stream"):
+            await asyncio.sleep(args.ds_token_interval * completion_tokens)
+            data = {"choices": [{"message": {"role": "assistant", "content": "".join(words)}}], "usage": usage}
+            return await self._respond(writer, 200, json.dumps(data, ensure_ascii=False).encode())
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        events = [{"choices": [{"delta": {"content": word}}]} for word in words]
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            events.append({"choices": [], "usage": usage})
+        for event in events:
+            await asyncio.sleep(args.ds_token_interval)
+            self._write_chunk(writer, f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+            await writer.drain()
+        self._write_chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def _prompt_cache(self, messages: List[dict]):
+        """(токены промпта, из них попало в кэш): самый длинный ранее виденный префикс"""
+        serialized = ""
+        hit_chars = 0
+        for message in messages:
+            serialized += json.dumps(message, ensure_ascii=False)
+            key = hashlib.sha1(serialized.encode("utf-8")).digest()
+            if key in self._prefixes:
+                hit_chars = len(serialized)
+            else:
+                self._prefixes.add(key)
+        prompt_tokens, hit_tokens = len(serialized) // 3, hit_chars // 3
+        self.prompt_tokens += prompt_tokens
+        self.prompt_cache_hit_tokens += hit_tokens
+        return prompt_tokens, hit_tokens
+
+    async def _deepseek_status(self, writer: asyncio.StreamWriter, status: int, extra: str = ""):
+        self.deepseek_statuses[status] = self.deepseek_statuses.get(status, 0) + 1
+        await self._respond(writer, status, b'{"error": {"message": "injected"}}', extra=extra)
+
+    @staticmethod
+    def _write_chunk(writer: asyncio.StreamWriter, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    # ---- Telegram Bot API ----
+    async def _telegram(self, method: str, headers: Dict[str, str], body: bytes, writer: asyncio.StreamWriter):
+        self.telegram_calls[method] = self.telegram_calls.get(method, 0) + 1
+        if "json" in headers.get("content-type", ""):
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+        if self.args.tg_latency:
+            await asyncio.sleep(self.args.tg_latency * self.rng.uniform(0.5, 1.5))
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            text = params.get("text", "")
+            if method == "sendMessage":
+                self._message_id += 1
+            message_id = int(params.get("message_id") or self._message_id)
+            result = {"message_id": message_id, "date": int(time.time()), "text": text,
+                      "chat": {"id": chat_id, "type": "private"}}
+            self._resolve(chat_id, text)
+        else:
+            result = True
+        await self._respond(writer, 200, json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode())
+
+    def _resolve(self, chat_id: int, text: str):
+        if text.endswith(STREAM_CURSOR) or text.startswith(INTERIM_PREFIXES):
+            return
+        future = self._waiters.pop(chat_id, None)
+        if future is not None and not future.done():
+            future.set_result(text.rstrip().endswith(END_MARK))
+
+
+# ============ СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ============
+class UpdateFactory:
+    """Апдейты Telegram с текстовыми сообщениями от пользователей в личных чатах"""
+
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self._update_id = 0
+
+    def message(self, user_id: int, text: Optional[str] = None) -> dict:
+        self._update_id += 1
+        return {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+                "text": text or self.rng.choice(QUESTIONS),
+            },
+        }
+
+
+# ============ ДРАЙВЕРЫ ============
+class DirectDriver:
+    """Апдейт передается в update_processor приложения, как это делает вебхук-воркер"""
+
+    def __init__(self, application):
+        self.application = application
+        self._tasks = set()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def deliver(self, data: dict):
+        from telegram import Update
+        application = self.application
+        update = Update.de_json(data, application.bot)
+        task = asyncio.create_task(
+            application.update_processor.process_update(update, application.process_update(update))
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class WebhookDriver:
+    """Апдейт отправляется POST-запросом на вебхук бота (сервер, очередь, воркеры)"""
+
+    def __init__(self, application, bot_module):
+        from webhook import WebhookIntake
+        self.port = free_port()
+        self.intake = WebhookIntake(application)
+        bot_module.astrobot.webhook_intake = self.intake
+        self.server = bot_module.create_web_server(application, self.port, BENCH_WEBHOOK_PATH, self.intake)
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": bot_module.WEBHOOK_SECRET} if bot_module.WEBHOOK_SECRET else {}
+        self.client = None
+        self.rejected = 0
+
+    async def start(self):
+        import httpx
+        await self.intake.start()
+        await self.server.start()
+        self.client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.port}",
+                                        limits=httpx.Limits(max_connections=100))
+
+    async def stop(self):
+        await self.server.stop()
+        await self.intake.stop()
+        await self.client.aclose()
+
+    async def deliver(self, data: dict):
+        # Как Telegram: при 5xx повторяем доставку позже
+        while True:
+            response = await self.client.post(BENCH_WEBHOOK_PATH, json=data, headers=self.headers)
+            if response.status_code < 500:
+                return
+            self.rejected += 1
+            await asyncio.sleep(1)
+
+
+# ============ СЦЕНАРИЙ ============
+class Results:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ok = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.messages = 0
+
+
+async def run_user(user_id: int, args, upstream: FakeUpstream, factory: UpdateFactory, driver, results: Results,
+                   messages: int):
+    rng = random.Random(args.seed + user_id)
+    await asyncio.sleep(rng.uniform(0, args.ramp_up))
+    for _ in range(messages):
+        reply = upstream.expect_reply(user_id)
+        # Вопрос несколькими быстрыми сообщениями подряд
+        for index in range(args.burst):
+            if index:
+                await asyncio.sleep(rng.uniform(0.05, 0.3))
+            await driver.deliver(factory.message(user_id))
+            results.messages += 1
+        started = time.monotonic()
+        try:
+            success = await asyncio.wait_for(reply, args.reply_timeout)
+        except asyncio.TimeoutError:
+            results.timeouts += 1
+        else:
+            results.latencies.append(time.monotonic() - started)
+            if success:
+                results.ok += 1
+            else:
+                results.errors += 1
+        await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+async def run_phase(user_ids: range, messages: int, args, upstream, factory, driver) -> Results:
+    results = Results()
+    await asyncio.gather(*(
+        run_user(user_id, args, upstream, factory, driver, results, messages) for user_id in user_ids
+    ))
+    return results
+
+
+async def benchmark(args) -> dict:
+    upstream = FakeUpstream(args)
+    await upstream.start()
+
+    # Конфигурация бота читается из окружения при импорте
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_TOKEN,
+        "DEEPSEEK_API_KEY": "sk-benchmark",
+        "DEEPSEEK_API_URL": f"http://127.0.0.1:{upstream.port}/chat/completions",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{upstream.port}/bot",
+        "LOG_LEVEL": args.log_level,
+        # Ночная пакетная генерация гороскопов исказила бы замер (включается через --env)
+        "HOROSCOPE_ENABLED": "0",
+    })
+    if args.session_backend == "sqlite":
+        os.environ["SESSION_DB_PATH"] = os.path.join(args.workdir, f"bench-{os.getpid()}.db")
+    os.environ["SESSION_BACKEND"] = args.session_backend
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+    import bot as bot_module
+    application = bot_module.setup_bot()
+    await application.initialize()
+    await application.post_init(application)
+
+    driver = WebhookDriver(application, bot_module) if args.mode == "webhook" else DirectDriver(application)
+    await driver.start()
+    factory = UpdateFactory(args.seed)
+
+    users = range(10_000, 10_000 + args.users)
+    started = time.monotonic()
+    results = await run_phase(users, args.messages, args, upstream, factory, driver)
+    duration = time.monotonic() - started
+    deepseek_calls = upstream.deepseek_calls
+
+    # Память на активного пользователя: отдельная фаза под tracemalloc,
+    # чтобы трассировка не искажала пропускную способность
+    memory_per_user = None
+    if args.memory_users:
+        saved_ramp_up, args.ramp_up = args.ramp_up, 0
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot()
+        memory_users = range(20_000, 20_000 + args.memory_users)
+        await run_phase(memory_users, 1, args, upstream, factory, driver)
+        gc.collect()
+        grown = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, "filename"))
+        tracemalloc.stop()
+        args.ramp_up = saved_ramp_up
+        memory_per_user = grown / args.memory_users
+
+    await driver.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await upstream.stop()
+
+    latencies = results.latencies
+    return {
+        "mode": args.mode,
+        "users": args.users,
+        "messages": results.messages,
+        "replies_ok": results.ok,
+        "replies_error": results.errors,
+        "timeouts": results.timeouts,
+        "duration_s": round(duration, 3),
+        "throughput_msg_s": round(results.messages / duration, 2) if duration else None,
+        "latency_p50_s": _round(percentile(latencies, 50)),
+        "latency_p95_s": _round(percentile(latencies, 95)),
+        "latency_p99_s": _round(percentile(latencies, 99)),
+        "api_calls_per_message": round(deepseek_calls / results.messages, 3) if results.messages else None,
+        "prompt_cache_hit_ratio": (
+            round(upstream.prompt_cache_hit_tokens / upstream.prompt_tokens, 3) if upstream.prompt_tokens else None
+        ),
+        "deepseek_statuses": upstream.deepseek_statuses,
+        "telegram_calls": upstream.telegram_calls,
+        "webhook_redeliveries": getattr(driver, "rejected", 0),
+        "memory_per_user_kb": round(memory_per_user / 1024, 2) if memory_per_user is not None else None,
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 3) if value is not None else None
+
+
+def print_report(report: dict):
+    print("📊 Результаты нагрузочного теста")
+    for key, value in report.items():
+        print(f"  {key:<24} {value}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота с заглушкой DeepSeek и Telegram")
+    parser.add_argument("--mode", choices=("direct", "webhook"), default="direct",
+                        help="direct — в обработчики напрямую, webhook — через HTTP-вебхук")
+    parser.add_argument("--users", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=3, help="вопросов на пользователя")
+    parser.add_argument("--burst", type=int, default=1, help="сообщений в одном вопросе (быстро подряд)")
+    parser.add_argument("--think-time", type=float, default=1.0, help="пауза пользователя между вопросами, с")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="разброс старта пользователей, с")
+    parser.add_argument("--reply-timeout", type=float, default=120.0)
+    parser.add_argument("--memory-users", type=int, default=100,
+                        help="пользователей в фазе замера памяти (0 — не мерить)")
+    parser.add_argument("--ds-latency", type=float, default=0.8, help="медиана задержки DeepSeek до первого токена, с")
+    parser.add_argument("--ds-sigma", type=float, default=0.4, help="разброс логнормального распределения задержки")
+    parser.add_argument("--ds-tokens", type=int, default=60, help="токенов в ответе")
+    parser.add_argument("--ds-token-interval", type=float, default=0.01, help="пауза между токенами потока, с")
+    parser.add_argument("--ds-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--ds-503", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="средняя задержка Bot API, с")
+    parser.add_argument("--session-backend", choices=("memory", "sqlite"), default="sqlite")
+    parser.add_argument("--workdir", default="/tmp", help="каталог для временной базы сессий")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="переопределить настройку бота (например MESSAGE_COALESCE_WINDOW=0.5)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="записать отчет в JSON-файл")
+    parser.add_argument("--fail-p95", type=float, help="код выхода 1, если p95 задержки больше, с")
+    parser.add_argument("--min-throughput", type=float, help="код выхода 1, если сообщений в секунду меньше")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(benchmark(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+    failed = False
+    if args.fail_p95 is not None and (report["latency_p95_s"] is None or report["latency_p95_s"] > args.fail_p95):
+        print(f"❌ p95 {report['latency_p95_s']} с больше порога {args.fail_p95} с")
+        failed = True
+    if args.min_throughput is not None and (report["throughput_msg_s"] or 0) < args.min_throughput:
+        print(f"❌ Пропускная способность {report['throughput_msg_s']} сообщ./с ниже порога {args.min_throughput}")
+        failed = True
+    if report["timeouts"]:
+        print(f"⚠️ Без ответа осталось {report['timeouts']} вопросов")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
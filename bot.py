@@ -1,11 +1,18 @@
 import os
+import math
+import signal
+import asyncio
 import logging
 import json
+import hmac
 import random
-from typing import Dict, Optional
+import time
+from contextlib import nullcontext
+from urllib.parse import parse_qs
+from typing import Awaitable, Callable, Optional
 from datetime import datetime, timedelta
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -15,20 +22,57 @@ from telegram.ext import (
     filters
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 import httpx
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+from dispatcher import PerUserUpdateProcessor, update_user_key
+from coalescer import MessageCoalescer
+from outbox import TELEGRAM_MESSAGE_LIMIT, TelegramSender, split_message
+from tokens import PROMPT_TOKEN_BUDGET, api_messages, history_tokens, make_message
+from quotas import UsageLedger
+from tiers import EXPAND_REQUEST, GenerationTier, TierClassifier
+from feedback import FeedbackDigest, FeedbackStore
+from prompt import PromptBuilder
+from natal import ChartError, chart_from_text, numpy_available
+from horoscope import HOROSCOPE_ENABLED, HOROSCOPE_MAX_TOKENS, HOROSCOPE_TIME, DailyHoroscope, find_sign, parse_time
+from answer_cache import AnswerCache, ANSWER_CACHE_ENABLED
+from sessions import SessionStore, UserSession, create_session_backend
+from summarizer import SUMMARY_ENABLED, SUMMARY_MAX_TOKENS, ConversationSummarizer
+from resilience import CircuitBreaker, CircuitOpenError
+from scheduler import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, SchedulerQueueFull
+from logging_setup import body_sample, redact_text, setup_logging
+from tracing import (
+    DEBUG_TOKEN_HEADER, KIND_CLIENT, TRACE_DEBUG_TOKEN, TRACER, current_trace_id, record_span, span, trace_id_for
 )
-logger = logging.getLogger(__name__)
+from metrics import (
+    ANSWER_CACHE_EVENTS, HANDLER_ACTIVE, HANDLER_PENDING, TELEGRAM_LATENCY, REGISTRY, CONTENT_TYPE, record_usage
+)
+from webserver import Request, Response, WebServer
+from webhook import DEDUP_TTL, WEBHOOK_FAST_ACK, WebhookIntake
+from cluster import CLUSTER_SECRET_HEADER, INTERNAL_UPDATE_PATH, REPLICA_COUNT, Cluster, SharedDeduplicator, create_shared_store
+from providers import provider_secrets
+from deepseek import DeepSeekClient, iter_sse_deltas, DEEPSEEK_READ_TIMEOUT
 
 # Конфигурация
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID", "")
+# Адрес Bot API (локальный Bot API сервер или заглушка в benchmark.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+# Секрет вебхука: Telegram пришлет его в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Readiness: доля заполнения очередей, после которой реплика не принимает трафик
+READY_MAX_QUEUE_FILL = float(os.getenv("READY_MAX_QUEUE_FILL", "0.8"))
+
+# Настройка логирования (неблокирующая запись, секреты маскируются)
+setup_logging(secrets=[DEEPSEEK_API_KEY, TELEGRAM_BOT_TOKEN, *provider_secrets()])
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Потоковые ответы: интервал правок держим в пределах лимитов Telegram (~1 правка/с на чат)
+DEEPSEEK_STREAMING = os.getenv("DEEPSEEK_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
 
 # Реквизиты для донатов (ЗАПОЛНИТЕ ВСЕ ПОЛЯ!)
 DONATION_DETAILS = {
@@ -177,15 +221,197 @@ IV. ЭКЗИСТЕНЦИАЛЬНО-ФЕНОМЕНОЛОГИЧЕСКИЙ ПОДХ
 
 Отвечай на русском языке, используй научную терминологию с пояснениями, будь точным в ссылках на исследования и скромным в утверждениях.
 """
-"""
+
+# Заготовленный ответ на время недоступности DeepSeek
+DEGRADED_REPLY = (
+    "🌙 Звезды сейчас молчат: сервис AI временно недоступен. "
+    "Я уже проверяю связь — попробуйте задать вопрос через пару минут."
+)
+
+
+def queue_notice_text(position: int) -> str:
+    return f"⏳ Сейчас много вопросов к звездам. Ваше место в очереди: {position}. Ответ придет автоматически."
+
+
+def quota_text(retry_after: float) -> str:
+    minutes = max(1, math.ceil(retry_after / 60))
+    return (
+        f"🌙 Мы очень много успели обсудить за последнее время — дадим звездам немного отдохнуть.\n\n"
+        f"Новый вопрос можно будет задать через {minutes} мин. "
+        f"А пока загляните в /today — гороскоп на день доступен без ограничений. 🌟"
+    )
+
+
+def usage_fields(usage: Optional[dict]) -> dict:
+    """Токены промпта и попадания в кэш префикса для структурированного лога"""
+    if not usage:
+        return {}
+    return {
+        key: usage[key] for key in ("prompt_tokens", "prompt_cache_hit_tokens", "completion_tokens") if key in usage
+    }
+
+
+class ApiErrorReply(str):
+    """Текст ошибки для пользователя вместо ответа модели (не кэшируется)"""
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest с замером задержки каждого вызова Bot API"""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        with TELEGRAM_LATENCY.time(method=api_method):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+class StreamingReply:
+    """Прогрессивное редактирование сообщения с ограничением частоты правок"""
+    
+    CURSOR = " ▌"
+    
+    def __init__(self, message: Message, sender: TelegramSender, interval: float):
+        self.message = message
+        self.sender = sender
+        self.interval = interval
+        self.last_edit = 0.0
+        self.last_text = message.text or ""
+        
+    async def update(self, text: str):
+        """Промежуточная правка, не чаще одного раза в interval секунд"""
+        if time.monotonic() - self.last_edit < self.interval:
+            return
+        await self._edit(text[:TELEGRAM_MESSAGE_LIMIT - len(self.CURSOR)] + self.CURSOR)
+        
+    async def notice(self, text: str):
+        """Служебный текст (например, позиция в очереди) до начала ответа"""
+        await self._edit(text)
+        
+    async def finish(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        """Финальная правка; длинный ответ дописывается следующими сообщениями"""
+        chunks = split_message(text)
+        await self._edit(chunks[0], final=True, reply_markup=reply_markup if len(chunks) == 1 else None)
+        for index, chunk in enumerate(chunks[1:], start=2):
+            await self.sender.reply(self.message, chunk, reply_markup=reply_markup if index == len(chunks) else None)
+        
+    async def _edit(self, text: str, final: bool = False, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        if text == self.last_text and reply_markup is None:
+            return
+        self.last_edit = time.monotonic()
+        try:
+            # Промежуточные правки пропускаются, если лимит чата исчерпан
+            if await self.sender.edit(self.message, text, interim=not final, reply_markup=reply_markup) is not None:
+                self.last_text = text
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.error(f"Failed to edit streaming message: {e}")
+
 
 class AstroBot:
     def __init__(self):
-        self.user_sessions: Dict[int, list] = {}
-        self.user_last_donation_reminder: Dict[int, datetime] = {}
-        self.max_history = 10
+        # Сессии: LRU-кэш в памяти перед SQLite, запись пачками в фоне.
+        # Несколько реплик делят одно хранилище сессий, аренд и дедупликации
+        if REPLICA_COUNT > 1:
+            shared = create_shared_store()
+            self.sessions = SessionStore(shared.sessions())
+            self.cluster: Optional[Cluster] = Cluster(shared, self.sessions)
+        else:
+            self.sessions = SessionStore(create_session_backend())
+            self.cluster = None
+        self.prompt_token_budget = PROMPT_TOKEN_BUDGET
+        # Системный промпт не меняется — считаем его стоимость один раз
+        self.system_message = make_message("system", SYSTEM_PROMPT)
+        # Стабильный префикс промпта для контекстного кэша DeepSeek
+        self.prompts = PromptBuilder(self.system_message, self.prompt_token_budget)
         self.donation_reminder_interval = timedelta(hours=24)
         self.donation_reminder_chance = 0.3
+        self.deepseek = DeepSeekClient(DEEPSEEK_API_KEY)
+        self.update_processor: Optional[PerUserUpdateProcessor] = None
+        self.webhook_intake: Optional[WebhookIntake] = None
+        self.streaming_enabled = DEEPSEEK_STREAMING
+        self.answer_cache = AnswerCache() if ANSWER_CACHE_ENABLED else None
+        self.stream_edit_interval = STREAM_EDIT_INTERVAL
+        # Все исходящие сообщения — через очередь с лимитами Telegram
+        self.sender = TelegramSender()
+        # Быстрые сообщения подряд склеиваются в один вопрос
+        self.coalescer = MessageCoalescer(self.guarded_turn)
+        # Старые реплики сжимаются в фоне в «память» после системного промпта
+        self.summarizer = ConversationSummarizer(self.sessions, self.summarize_call) if SUMMARY_ENABLED else None
+        # Отзывы пишутся в журнал и уходят администратору сводками
+        self.feedback = FeedbackStore(deliver=bool(ADMIN_CHAT_ID))
+        self.feedback_digest: Optional[FeedbackDigest] = None
+        # Учет токенов по пользователям: скользящая квота
+        self.usage = UsageLedger()
+        # Уровень генерации по вопросу: короткий ответ на короткий вопрос
+        self.tiers = TierClassifier()
+        # Гороскопы на день генерируются пакетом ночью и отдаются из кэша
+        self.horoscope = (
+            DailyHoroscope(self.horoscope_call, self.system_message)
+            if HOROSCOPE_ENABLED and numpy_available() else None
+        )
+
+    async def post_init(self, application: Application):
+        """Запуск общих ресурсов при старте приложения"""
+        await self.deepseek.start()
+        await self.sessions.start()
+        await TRACER.start()
+        if self.cluster is not None:
+            await self.cluster.start()
+        await asyncio.to_thread(self.feedback.load)
+        if ADMIN_CHAT_ID:
+            self.feedback_digest = FeedbackDigest(self.feedback, lambda text: self.sender.send(
+                application.bot, ADMIN_CHAT_ID, text, parse_mode=ParseMode.HTML
+            ))
+            await self.feedback_digest.start()
+        if self.horoscope is not None:
+            self.schedule_horoscope(application)
+
+    def schedule_horoscope(self, application: Application):
+        """Ежедневная генерация через JobQueue; при старте — догенерировать недостающее"""
+        self.horoscope.load()
+        job_queue = application.job_queue
+        if job_queue is None:
+            logger.warning("⚠️ JobQueue недоступна (pip install \"python-telegram-bot[job-queue]\"): "
+                           "гороскопы генерируются по первому запросу /today")
+            return
+        job_queue.run_daily(self.horoscope.job, parse_time(HOROSCOPE_TIME, self.horoscope.zone), name="daily_horoscope")
+        job_queue.run_once(self.horoscope.job, 10, name="daily_horoscope_startup")
+
+    def readiness(self, application: Application) -> dict:
+        """Готовность принимать трафик: приложение запущено, DeepSeek доступен, очереди не забиты"""
+        scheduler = self.deepseek.scheduler
+        state = {
+            "running": application.running,
+            "deepseek_circuit": self.deepseek.breaker.state,
+            "deepseek_queue": scheduler.queue_depth,
+            "pending_updates": self.update_processor.pending if self.update_processor else 0,
+            "webhook_queue": self.webhook_intake.queue.qsize() if self.webhook_intake else 0
+        }
+        queue_ok = scheduler.queue_depth < scheduler.max_queue * READY_MAX_QUEUE_FILL
+        updates_ok = (
+            self.update_processor is None
+            or self.update_processor.pending < self.update_processor.max_concurrent_updates * READY_MAX_QUEUE_FILL
+        )
+        intake_ok = self.webhook_intake is None or self.webhook_intake.fill < READY_MAX_QUEUE_FILL
+        state["ready"] = bool(
+            application.running and state["deepseek_circuit"] != CircuitBreaker.OPEN
+            and queue_ok and updates_ok and intake_ok
+        )
+        return state
+        
+    async def post_shutdown(self, application: Application):
+        """Освобождение общих ресурсов при остановке приложения"""
+        await self.coalescer.close()
+        if self.feedback_digest is not None:
+            await self.feedback_digest.close()
+        if self.summarizer is not None:
+            await self.summarizer.close()
+        if self.horoscope is not None:
+            await self.horoscope.close()
+        await self.deepseek.close()
+        await self.sessions.close()
+        await TRACER.close()
+        if self.cluster is not None:
+            await self.cluster.close()
         
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
@@ -215,13 +441,16 @@ class AstroBot:
 /start - это сообщение
 /help - подробнее о методе
 /donate - поддержать развитие
+/chart - моя натальная карта
+/today - гороскоп и транзиты дня
 /reset - новый диалог
 /feedback - отзыв
 
 Просто напишите ваш астрологический вопрос! 🌙
         """
         
-        await update.message.reply_text(
+        await self.sender.reply(
+            update.message,
             welcome_message,
             parse_mode=ParseMode.MARKDOWN
         )
@@ -259,6 +488,20 @@ class AstroBot:
 • "Как проработать аспект Марс-Плутон?"
 • "Что показывает мой восходящий знак о моем стиле?"
 
+На короткий вопрос я отвечаю коротко — кнопка «📖 Подробнее»
+или слово «подробнее» раскроют ответ.
+
+🪐 НАТАЛЬНАЯ КАРТА:
+`/chart 15.03.1990 14:30 Москва` — я рассчитаю положения планет,
+домов и аспекты и буду опираться на них в ответах.
+Время неизвестно — укажите только дату и город.
+Город не из списка — координаты: `/chart 15.03.1990 14:30 55.75, 37.62 UTC+3`
+`/chart сброс` — забыть карту
+
+🌅 НА СЕГОДНЯ:
+`/today` — небо и главные транзиты дня
+`/today Рыбы` — гороскоп для знака
+
 💡 ПОМНИТЕ:
 • Астрология — не приговор, а язык символов
 • У вас всегда есть свобода выбора
@@ -267,7 +510,8 @@ class AstroBot:
 💝 Поддержка проекта: /donate
         """
         
-        await update.message.reply_text(
+        await self.sender.reply(
+            update.message,
             help_text,
             parse_mode=ParseMode.MARKDOWN
         )
@@ -279,7 +523,8 @@ class AstroBot:
         
         if missing_fields:
             logger.error(f"Missing donation details: {missing_fields}")
-            await update.message.reply_text(
+            await self.sender.reply(
+                update.message,
                 "⚠️ Реквизиты временно недоступны. Попробуйте позже.",
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -311,7 +556,8 @@ class AstroBot:
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(
+        await self.sender.reply(
+            update.message,
             donation_text,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=reply_markup
@@ -323,35 +569,114 @@ class AstroBot:
         await query.answer()
         
         if query.data == "donated":
-            await query.edit_message_text(
+            await self.sender.call(query.message.chat_id, lambda: query.edit_message_text(
                 "🙏 СПАСИБО! Ваш вклад помогает развивать интегративный подход к самопознанию. ✨",
                 parse_mode=ParseMode.MARKDOWN
-            )
+            ))
+            
+        elif query.data == "expand":
+            # Кнопка под коротким ответом: тот же путь, что и вопрос «расскажи подробнее»
+            try:
+                await self.sender.call(query.message.chat_id, lambda: query.edit_message_reply_markup(None))
+            except BadRequest as e:
+                logger.warning(f"⚠️ Не удалось убрать кнопку «Подробнее»: {e}")
+            await query.message.chat.send_action(action="typing")
+            self.coalescer.add(update.effective_user.id, EXPAND_REQUEST, update, context)
             
         elif query.data == "copy_details":
             details_text = f"Карта: {DONATION_DETAILS['card_number']}\nБанк: {DONATION_DETAILS['bank']}"
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"`{details_text}`\n\nРеквизиты скопированы.",
+            await self.sender.send(
+                context.bot,
+                query.message.chat_id,
+                f"`{details_text}`\n\nРеквизиты скопированы.",
                 parse_mode=ParseMode.MARKDOWN
             )
             
     async def reset_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /reset"""
         user_id = update.effective_user.id
-        self.user_sessions[user_id] = []
+        # Ответ на прежний диалог больше не нужен и не должен попасть в историю
+        await self.coalescer.cancel(user_id)
+        if self.summarizer is not None:
+            self.summarizer.cancel(user_id)
+        session = await self.sessions.get(user_id)
+        session.history = []
+        session.summary = None
+        self.sessions.save(session)
         
-        await update.message.reply_text(
+        await self.sender.reply(
+            update.message,
             "♻️ ДИАЛОГ СБРОШЕН!\n\nГотов к новому исследованию. Задавайте ваш вопрос! 🌟",
             parse_mode=ParseMode.MARKDOWN
         )
         
+    async def chart_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /chart: расчет натальной карты по данным рождения"""
+        user_id = update.effective_user.id
+        args = " ".join(context.args or [])
+        session = await self.sessions.get(user_id)
+
+        if not args:
+            text = (
+                f"🪐 ВАША КАРТА\n\n{session.chart}" if session.chart else
+                "🪐 Укажите данные рождения:\n/chart 15.03.1990 14:30 Москва\n\nПодробнее: /help"
+            )
+            await self.sender.reply(update.message, text)
+            return
+
+        if args.lower() in ("сброс", "reset"):
+            session.chart = None
+            self.sessions.save(session)
+            await self.sender.reply(update.message, "♻️ Натальная карта удалена.")
+            return
+
+        try:
+            chart = chart_from_text(args)
+        except ChartError as e:
+            await self.sender.reply(update.message, f"⚠️ {e}")
+            return
+
+        session.chart = chart.to_prompt()
+        self.sessions.save(session)
+        logger.info(f"🪐 Рассчитана натальная карта пользователя {user_id}")
+        await self.sender.reply(
+            update.message,
+            f"🪐 КАРТА РАССЧИТАНА\n\n{session.chart}\n\nТеперь я учитываю ее в ответах. Задавайте вопрос! 🌟"
+        )
+
+    async def today_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /today: готовые гороскопы на день"""
+        if self.horoscope is None:
+            await self.sender.reply(update.message, "⚠️ Гороскопы на день сейчас недоступны.")
+            return
+
+        args = " ".join(context.args or [])
+        sign = find_sign(args) if args else None
+        if args and sign is None:
+            await self.sender.reply(update.message, "⚠️ Не узнал знак. Пример: /today Рыбы")
+            return
+
+        self.horoscope.ensure_fresh()
+        text = self.horoscope.for_sign(sign) if sign else self.horoscope.overview()
+        if text is None:
+            text = "⏳ Гороскопы на сегодня еще готовятся. Загляните через пару минут!"
+        elif not sign:
+            text += "\n\nГороскоп для знака: /today Рыбы"
+        await self.sender.reply(update.message, text)
+
     async def feedback_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик команды /feedback"""
+        """Обработчик команды /feedback: отзыв сразу в команде или следующим сообщением"""
+        text = " ".join(context.args or []).strip()
+        if text:
+            await self.handle_feedback(update, context, text)
+            return
+            
+        # Следующее текстовое сообщение пользователя уйдет в отзывы (см. handle_message)
+        context.user_data['awaiting_feedback'] = True
         feedback_text = """
 📝 ОТЗЫВ
 
-Ваше мнение важно! Напишите:
+Ваше мнение важно! Напишите следующим сообщением:
 • Что было особенно полезно?
 • Что можно улучшить?
 • Идеи для новых функций
@@ -359,218 +684,414 @@ class AstroBot:
 Ваш отзыв помогает становиться лучше! 🌟
         """
         
-        await update.message.reply_text(
+        await self.sender.reply(
+            update.message,
             feedback_text,
             parse_mode=ParseMode.MARKDOWN
         )
         
-    async def handle_feedback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def handle_feedback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, feedback: Optional[str] = None):
         """Обработчик отзывов"""
         user = update.effective_user
-        feedback = update.message.text
-        
-        feedback_data = {
-            "user_id": user.id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "feedback": feedback,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        logger.info(f"Feedback received: {feedback_data}")
+        feedback = feedback or update.message.text
         
-        if ADMIN_CHAT_ID:
-            admin_message = f"""
-📨 НОВЫЙ ОТЗЫВ
-
-Пользователь: {user.first_name} (@{user.username})
-Отзыв: {feedback}
-            """
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=ADMIN_CHAT_ID,
-                    text=admin_message,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            except Exception as e:
-                logger.error(f"Failed to send feedback to admin: {e}")
+        # Администратор получит отзыв в ближайшей сводке (FeedbackDigest)
+        try:
+            record = await self.feedback.append(user.id, user.first_name, user.username, feedback)
+        except OSError as e:
+            logger.error(f"❌ Не удалось сохранить отзыв: {e}")
+        else:
+            logger.info("Feedback received", extra={"fields": {
+                "event": "feedback", "user_id": user.id, "feedback_id": record["id"], "text": redact_text(feedback)
+            }})
         
-        await update.message.reply_text(
+        await self.sender.reply(
+            update.message,
             "✅ СПАСИБО! Ваш отзыв поможет сделать подход еще глубже. 🌟",
             parse_mode=ParseMode.MARKDOWN
         )
         
-    def get_user_session(self, user_id: int) -> list:
-        """Получить историю сообщений пользователя"""
-        if user_id not in self.user_sessions:
-            self.user_sessions[user_id] = [
-                {"role": "system", "content": SYSTEM_PROMPT}
-            ]
-        return self.user_sessions[user_id]
+    async def get_user_session(self, user_id: int) -> UserSession:
+        """Получить сессию пользователя (из кэша или с диска)"""
+        return await self.sessions.get(user_id)
         
-async def call_deepseek_api(self, messages: list) -> Optional[str]:
-    """Вызов DeepSeek API с полным логированием"""
-    
-    # Логируем начало запроса
-    last_message = messages[-1]["content"] if messages else "пусто"
-    logger.info(f"📨 Отправляю запрос в DeepSeek. Последнее сообщение: {last_message[:100]}...")
-    logger.info(f"📊 Всего сообщений в истории: {len(messages)}")
-    
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
-    payload = {
-        "model": "deepseek-chat",
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 2000,  # Увеличил для натальных карт
-        "stream": False
-    }
-    
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:  # Увеличил таймаут
-            logger.info(f"🔗 Подключаюсь к {DEEPSEEK_API_URL}")
-            logger.info(f"🔑 API ключ присутствует: {'Да' if DEEPSEEK_API_KEY else 'Нет'}")
-            
-            response = await client.post(
-                DEEPSEEK_API_URL,
-                headers=headers,
-                json=payload
-            )
-            
-            # ЛОГИРУЕМ ВСЕ ДЕТАЛИ
-            logger.info(f"📊 Ответ получен. Статус: {response.status_code}")
-            logger.info(f"📊 Заголовки ответа: {dict(response.headers)}")
-            
-            # Сохраняем полный ответ для анализа
+        
+    def generation_params(self, tier: Optional[GenerationTier] = None) -> dict:
+        """Параметры генерации (входят и в ключ кэша ответов); tier задает свой бюджет"""
+        params = {
+            "model": "deepseek-chat",
+            "temperature": 0.7,
+            "max_tokens": 2000  # Увеличил для натальных карт
+        }
+        if tier is not None:
+            params.update(tier.params())
+        return params
+        
+    def build_payload(self, messages: list, stream: bool = False, params: Optional[dict] = None,
+                      tier: Optional[GenerationTier] = None) -> dict:
+        """Тело запроса chat/completions; params переопределяют параметры генерации"""
+        payload = {
+            **self.generation_params(tier),
+            **(params or {}),
+            "messages": api_messages(messages),
+            "stream": stream
+        }
+        if stream:
+            # Последний фрагмент потока принесет usage
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+        
+    async def call_deepseek_api(self, messages: list, priority: int = PRIORITY_NORMAL,
+                                on_wait: Optional[Callable[[int], Awaitable[None]]] = None,
+                                params: Optional[dict] = None, user_id: Optional[int] = None,
+                                tier: Optional[GenerationTier] = None) -> Optional[str]:
+        """Вызов DeepSeek API; итог пишется одной структурированной записью"""
+        payload = self.build_payload(messages, params=params, tier=tier)
+        fields = {"event": "deepseek_request", "stream": False, "messages": len(messages), "trace_id": current_trace_id(),
+                  "tier": tier.name if tier else None, "max_tokens": payload.get("max_tokens")}
+        started = time.monotonic()
+        
+        try:
+            with span("deepseek", KIND_CLIENT, priority=priority, messages=len(messages)):
+                response = await self.deepseek.post(
+                    payload, priority, on_wait, flow=user_id, cost=history_tokens(messages),
+                    read_timeout=tier.timeout if tier else None
+                )
+            fields["status"] = response.status_code
+            fields["duration_ms"] = round((time.monotonic() - started) * 1000)
             response_text = response.text
-            logger.info(f"📊 Тело ответа (первые 1000 символов): {response_text[:1000]}")
+            fields["response_bytes"] = len(response.content)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"📊 Тело ответа: {body_sample(response_text)}")
             
             if response.status_code == 200:
                 try:
-                    data = response.json()
-                    logger.info(f"✅ JSON успешно распарсен")
+                    with span("json_parse", bytes=len(response.content)):
+                        data = response.json()
                     
                     # Проверяем структуру ответа
-                    if "choices" not in data:
-                        logger.error(f"❌ Нет ключа 'choices' в ответе. Ключи: {data.keys()}")
-                        return None
-                    
-                    if not data["choices"]:
-                        logger.error(f"❌ Пустой массив choices. Ответ: {data}")
-                        return None
-                    
-                    if "message" not in data["choices"][0]:
-                        logger.error(f"❌ Нет ключа 'message' в choice. Choice: {data['choices'][0]}")
+                    if not data.get("choices") or "message" not in data["choices"][0]:
+                        logger.error(f"❌ Неожиданная структура ответа. Ключи: {list(data.keys())}")
                         return None
                     
                     result = data["choices"][0]["message"].get("content", "")
+                    self.account_usage(user_id, data.get("usage"))
+                    fields.update(usage_fields(data.get("usage")))
                     
                     if not result:
                         logger.warning("⚠️ Пустой content в ответе")
-                        result = "Извините, получен пустой ответ от AI. Попробуйте переформулировать вопрос."
+                        result = ApiErrorReply("Извините, получен пустой ответ от AI. Попробуйте переформулировать вопрос.")
                     
-                    logger.info(f"✅ Успешно. Длина ответа: {len(result)} символов")
+                    fields["answer_chars"] = len(result)
                     return result
                     
                 except json.JSONDecodeError as e:
                     logger.error(f"❌ Ошибка декодирования JSON: {e}")
-                    logger.error(f"❌ Сырой ответ: {response_text[:500]}")
-                    return f"Ошибка обработки ответа AI. Ответ не в JSON формате."
+                    return ApiErrorReply("Ошибка обработки ответа AI. Ответ не в JSON формате.")
                     
-            elif response.status_code == 429:
-                # Проверяем заголовки лимитов
-                limit = response.headers.get('x-ratelimit-limit', 'неизвестно')
-                remaining = response.headers.get('x-ratelimit-remaining', 'неизвестно')
-                reset = response.headers.get('x-ratelimit-reset', 'неизвестно')
-                
-                logger.error(f"❌ ЛИМИТ 429. Limit: {limit}, Remaining: {remaining}, Reset: {reset}")
-                logger.error(f"❌ Полный ответ: {response_text}")
-                
-                return "⚠️ Превышен лимит запросов к AI. DeepSeek ограничивает даже платные аккаунты. Попробуйте через несколько минут."
-                
-            elif response.status_code == 401:
-                logger.error(f"❌ ОШИБКА АВТОРИЗАЦИИ 401. Проверьте API ключ.")
-                logger.error(f"❌ Заголовки: {dict(response.headers)}")
-                
-                # Проверяем формат ключа
-                if DEEPSEEK_API_KEY:
-                    key_preview = DEEPSEEK_API_KEY[:10] + "..." if len(DEEPSEEK_API_KEY) > 10 else DEEPSEEK_API_KEY
-                    logger.error(f"❌ Используемый ключ (первые 10 символов): {key_preview}")
-                
-                return "❌ Ошибка авторизации API. Проверьте настройки API ключа."
-                
-            elif response.status_code == 400:
-                logger.error(f"❌ ОШИБКА 400 (Bad Request). Возможно, слишком длинный запрос.")
-                logger.error(f"❌ Длина запроса: {len(str(payload))} символов")
-                logger.error(f"❌ Ответ: {response_text[:500]}")
+            return await self.handle_api_error(response, response_text, messages, payload, user_id, tier)
                 
-                # Упрощаем запрос если слишком длинный
-                if len(messages) > 5:
-                    logger.info("🔄 Сокращаю историю сообщений...")
-                    simplified_messages = [messages[0]] + messages[-3:]  # Системный + последние 3
-                    return await self.call_deepseek_api(simplified_messages)
+        except Exception as e:
+            fields["error"] = type(e).__name__
+            return self.handle_api_exception(e, tier)
+            
+        finally:
+            fields.setdefault("duration_ms", round((time.monotonic() - started) * 1000))
+            logger.info("📨 Запрос к DeepSeek", extra={"fields": fields})
+            
+    def account_usage(self, user_id: Optional[int], usage: Optional[dict]):
+        """Общие метрики токенов и учет на пользователя (квота и справедливая очередь)"""
+        record_usage(usage)
+        if user_id is None or not usage:
+            return
+        self.usage.record(user_id, usage)
+        # Промпт уже учтен оценкой при постановке в очередь, доначисляем ответ
+        self.deepseek.scheduler.charge(user_id, usage.get("completion_tokens") or 0)
+        
+    async def summarize_call(self, messages: list) -> Optional[str]:
+        """Дешевый фоновый запрос для сжатия истории: короткий ответ, низкий приоритет"""
+        result = await self.call_deepseek_api(
+            messages, priority=PRIORITY_LOW, params={"temperature": 0.3, "max_tokens": SUMMARY_MAX_TOKENS}
+        )
+        return None if isinstance(result, ApiErrorReply) else result
+        
+    async def horoscope_call(self, messages: list) -> Optional[str]:
+        """Фоновый запрос пакетной генерации гороскопов"""
+        result = await self.call_deepseek_api(
+            messages, priority=PRIORITY_LOW, params={"max_tokens": HOROSCOPE_MAX_TOKENS}
+        )
+        return None if isinstance(result, ApiErrorReply) else result
+        
+    async def stream_deepseek_api(self, messages: list, on_delta: Callable[[str], Awaitable[None]],
+                                  on_wait: Optional[Callable[[int], Awaitable[None]]] = None,
+                                  user_id: Optional[int] = None, tier: Optional[GenerationTier] = None) -> Optional[str]:
+        """Потоковый вызов DeepSeek API (SSE): on_delta получает накопленный текст"""
+        payload = self.build_payload(messages, stream=True, tier=tier)
+        fields = {"event": "deepseek_request", "stream": True, "messages": len(messages), "trace_id": current_trace_id(),
+                  "tier": tier.name if tier else None, "max_tokens": payload.get("max_tokens")}
+        started = time.monotonic()
+        
+        try:
+            async with self.deepseek.stream(
+                payload, on_wait=on_wait, flow=user_id, cost=history_tokens(messages),
+                read_timeout=tier.timeout if tier else None
+            ) as response:
+                fields["status"] = response.status_code
+                fields["headers_ms"] = round((time.monotonic() - started) * 1000)
                 
-                return "⚠️ Запрос слишком сложный. Попробуйте задать вопрос короче или использовать /reset."
+                if response.status_code != 200:
+                    response_text = (await response.aread()).decode("utf-8", errors="replace")
+                    return await self.handle_api_error(response, response_text, messages, payload, user_id, tier)
                 
-            elif response.status_code == 503:
-                logger.error("❌ СЕРВИС НЕДОСТУПЕН 503. Проблемы на стороне DeepSeek.")
-                return "🌙 Сервис AI временно недоступен. Попробуйте через 10-15 минут."
+                parts = []
+                usage: dict = {}
+                headers_at = time.monotonic()
+                async for delta in iter_sse_deltas(response, usage):
+                    if not parts:
+                        fields["ttft_ms"] = round((time.monotonic() - started) * 1000)
+                    parts.append(delta)
+                    await on_delta("".join(parts))
+                record_span("deepseek_stream_body", headers_at, time.monotonic(), KIND_CLIENT, chunks=len(parts))
+                    
+            self.account_usage(user_id, usage)
+            fields.update(usage_fields(usage))
+            result = "".join(parts)
+            if not result:
+                logger.warning("⚠️ Пустой поток в ответе")
+                result = ApiErrorReply("Извините, получен пустой ответ от AI. Попробуйте переформулировать вопрос.")
                 
+            fields["answer_chars"] = len(result)
+            return result
+            
+        except Exception as e:
+            fields["error"] = type(e).__name__
+            return self.handle_api_exception(e, tier)
+            
+        finally:
+            fields["duration_ms"] = round((time.monotonic() - started) * 1000)
+            logger.info("📨 Потоковый запрос к DeepSeek", extra={"fields": fields})
+            
+    async def handle_api_error(self, response: httpx.Response, response_text: str, messages: list, payload: dict,
+                               user_id: Optional[int] = None, tier: Optional[GenerationTier] = None) -> Optional[str]:
+        """Текст для пользователя по неуспешному HTTP-статусу DeepSeek (повтор — с тем же уровнем)"""
+        if response.status_code == 429:
+            # Проверяем заголовки лимитов
+            limit = response.headers.get('x-ratelimit-limit', 'неизвестно')
+            remaining = response.headers.get('x-ratelimit-remaining', 'неизвестно')
+            reset = response.headers.get('x-ratelimit-reset', 'неизвестно')
+            
+            logger.error(f"❌ ЛИМИТ 429. Limit: {limit}, Remaining: {remaining}, Reset: {reset}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"❌ Ответ: {body_sample(response_text)}")
+            
+            return ApiErrorReply("⚠️ Превышен лимит запросов к AI. DeepSeek ограничивает даже платные аккаунты. Попробуйте через несколько минут.")
+            
+        elif response.status_code == 401:
+            logger.error("❌ ОШИБКА АВТОРИЗАЦИИ 401. Проверьте DEEPSEEK_API_KEY (или ключи DEEPSEEK_API_KEYS / DEEPSEEK_PROVIDERS).")
+            
+            return ApiErrorReply("❌ Ошибка авторизации API. Проверьте настройки API ключа.")
+            
+        elif response.status_code == 400:
+            logger.error(f"❌ ОШИБКА 400 (Bad Request). Возможно, слишком длинный запрос. Сообщений: {len(messages)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"❌ Ответ: {body_sample(response_text)}")
+            
+            # Локальная оценка токенов ошиблась — повторяем с половинным бюджетом
+            # Подсказка уровня стоит после вопроса: обрезаем без нее, чтобы не потерять вопрос, и ставим обратно
+            hint = messages[-1:] if tier is not None and tier.hint and messages[-1].get("role") == "system" else []
+            simplified_messages = self.prompts.trim(messages[:len(messages) - len(hint)], self.prompt_token_budget // 2) + hint
+            if len(simplified_messages) < len(messages):
+                logger.info("🔄 Сокращаю историю сообщений...")
+                return await self.call_deepseek_api(
+                    simplified_messages, priority=PRIORITY_HIGH, user_id=user_id, tier=tier
+                )
+            
+            return ApiErrorReply("⚠️ Запрос слишком сложный. Попробуйте задать вопрос короче или использовать /reset.")
+            
+        elif response.status_code == 503:
+            logger.error("❌ СЕРВИС НЕДОСТУПЕН 503. Проблемы на стороне DeepSeek.")
+            return ApiErrorReply("🌙 Сервис AI временно недоступен. Попробуйте через 10-15 минут.")
+            
+        else:
+            logger.error(f"❌ НЕИЗВЕСТНАЯ ОШИБКА: {response.status_code}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"❌ Ответ: {body_sample(response_text)}")
+            return ApiErrorReply(f"⚠️ Ошибка AI сервиса (код {response.status_code}). Попробуйте позже.")
+            
+    def handle_api_exception(self, e: Exception, tier: Optional[GenerationTier] = None) -> str:
+        """Текст для пользователя по сетевой ошибке DeepSeek"""
+        if isinstance(e, httpx.TimeoutException):
+            read_timeout = tier.timeout if tier else DEEPSEEK_READ_TIMEOUT
+            tier_name = f", уровень {tier.name}" if tier else ""
+            logger.error(f"⏰ ТАЙМАУТ ({read_timeout:.0f} с на чтение{tier_name}). Слишком долгий ответ от DeepSeek.")
+            return ApiErrorReply("⏳ AI долго обрабатывает запрос. Попробуйте задать вопрос проще или подождите.")
+            
+        if isinstance(e, CircuitOpenError):
+            # Не ждем таймаутов, пока DeepSeek лежит — сразу отвечаем заготовкой
+            logger.warning(f"🔴 ВЫКЛЮЧАТЕЛЬ РАЗОМКНУТ: {e}")
+            return ApiErrorReply(DEGRADED_REPLY)
+            
+        if isinstance(e, SchedulerQueueFull):
+            logger.error(f"🚦 ОЧЕРЕДЬ ПЕРЕПОЛНЕНА: {e}")
+            return ApiErrorReply("🚦 Сейчас очень много вопросов к звездам. Попробуйте через минуту.")
+            
+        if isinstance(e, httpx.ConnectError):
+            logger.error("🔌 ОШИБКА ПОДКЛЮЧЕНИЯ. Нет связи с сервером DeepSeek.")
+            return ApiErrorReply("🌐 Проблемы с интернет-соединением или сервером AI.")
+            
+        logger.error(f"💥 НЕОЖИДАННАЯ ОШИБКА: {e}", exc_info=e)
+        return ApiErrorReply("❌ Непредвиденная ошибка. Попробуйте перезапустить диалог /reset.")
+        
+    def queue_notifier(self, update: Update) -> Callable[[int], Awaitable[None]]:
+        """Сообщать пользователю позицию в очереди вместо отказа"""
+        notice: dict = {}
+        
+        async def on_wait(position: int):
+            text = queue_notice_text(position)
+            if "message" in notice:
+                await self.sender.edit(notice["message"], text, interim=True)
             else:
-                logger.error(f"❌ НЕИЗВЕСТНАЯ ОШИБКА: {response.status_code}")
-                logger.error(f"❌ Полный ответ: {response_text}")
-                return f"⚠️ Ошибка AI сервиса (код {response.status_code}). Попробуйте позже."
+                notice["message"] = (await self.sender.reply(update.effective_message, text))[0]
                 
-    except httpx.TimeoutException:
-        logger.error("⏰ ТАЙМАУТ 60 секунд. Слишком долгий ответ от DeepSeek.")
-        return "⏳ AI долго обрабатывает запрос. Попробуйте задать вопрос проще или подождите."
+        return on_wait
         
-    except httpx.ConnectError:
-        logger.error("🔌 ОШИБКА ПОДКЛЮЧЕНИЯ. Нет связи с сервером DeepSeek.")
-        return "🌐 Проблемы с интернет-соединением или сервером AI."
+    async def stream_reply(self, update: Update, messages: list, tier: Optional[GenerationTier] = None) -> Optional[str]:
+        """Отправить заглушку и дописывать ее по мере прихода токенов"""
+        placeholder = (await self.sender.reply(update.effective_message, "🔭 Смотрю на звезды..."))[0]
+        reply = StreamingReply(placeholder, self.sender, self.stream_edit_interval)
         
-    except Exception as e:
-        logger.error(f"💥 НЕОЖИДАННАЯ ОШИБКА: {e}", exc_info=True)
-        return "❌ Непредвиденная ошибка. Попробуйте перезапустить диалог /reset."
+        async def on_wait(position: int):
+            await reply.notice(queue_notice_text(position))
             
+        try:
+            bot_response = await self.stream_deepseek_api(messages, reply.update, on_wait, update.effective_user.id, tier)
+        except asyncio.CancelledError:
+            # Вопрос дополнен или сброшен: недописанный ответ убираем
+            try:
+                await self.sender.call(placeholder.chat_id, placeholder.delete)
+            except Exception:
+                pass
+            raise
+        await reply.finish(
+            bot_response or "⚠️ Не удалось получить ответ. Возможно, превышен лимит запросов. Попробуйте через час.",
+            reply_markup=self.expand_markup(tier, bot_response)
+        )
+        return bot_response
+        
+    def expand_markup(self, tier: Optional[GenerationTier], bot_response: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+        """Кнопка «Подробнее» под ответом с урезанным бюджетом"""
+        if tier is None or not tier.expandable or not bot_response or isinstance(bot_response, ApiErrorReply):
+            return None
+        return InlineKeyboardMarkup([[InlineKeyboardButton("📖 Подробнее", callback_data="expand")]])
+        
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
         user = update.effective_user
         user_message = update.message.text
         
-        if context.user_data.get('awaiting_feedback', False):
-            context.user_data['awaiting_feedback'] = False
-            await self.handle_feedback(update, context)
-            return
-            
-        await update.message.chat.send_action(action="typing")
-        
-        user_history = self.get_user_session(user.id)
-        user_history.append({"role": "user", "content": user_message})
+        with TRACER.trace("handle_message", trace_id_for(update.update_id), update_id=update.update_id, user_id=user.id):
+            if context.user_data.get('awaiting_feedback', False):
+                context.user_data['awaiting_feedback'] = False
+                await self.handle_feedback(update, context)
+                return
+                
+            with span("send_action"):
+                await update.message.chat.send_action(action="typing")
+            self.coalescer.add(user.id, user_message, update, context)
         
-        if len(user_history) > self.max_history:
-            user_history = [user_history[0]] + user_history[-(self.max_history-1):]
+    async def guarded_turn(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str,
+                           commit: Callable[[], None]):
+        """Ответ идет вне очереди апдейтов — аренду пользователя держим и на это время,
+        а воркера занимаем из общего лимита обработки апдейтов"""
+        user_id = update.effective_user.id
+        # Ответ — продолжение трассы апдейта, принятого handle_message: задача склейки
+        # унаследовала ее контекст, спан answer_turn становится дочерним к ее корню
+        with TRACER.follow("answer_turn", trace_id_for(update.update_id), update_id=update.update_id, user_id=user_id):
+            guard = self.cluster.user_guard(user_id) if self.cluster is not None else nullcontext()
+            async with guard:
+                turn = self.answer_turn(update, context, user_message, commit)
+                if self.update_processor is not None:
+                    await self.update_processor.run_detached(turn)
+                else:
+                    await turn
+
+    async def answer_turn(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str,
+                          commit: Callable[[], None]):
+        """Ответ на склеенный вопрос; до commit() задачу можно отменить новым сообщением"""
+        user = update.effective_user
+        with span("session"):
+            session = await self.get_user_session(user.id)
+        with span("prompt_build"):
+            context_messages = self.prompts.prefix(session) + session.history
+            user_turn = make_message("user", user_message)
+            user_history = self.prompts.build(session, user_turn)
+            # Бюджет ответа по вопросу; подсказка о длине — после вопроса, префикс промпта не меняется
+            tier = self.tiers.choose(user_message, has_chart=bool(session.chart), has_history=bool(session.history))
+            request_messages = user_history + [make_message("system", tier.hint)] if tier.hint else user_history
+            
+            cache_key = None
+            if self.answer_cache is not None:
+                cache_key = self.answer_cache.make_key(
+                    user_message, context_messages, {**self.generation_params(tier), "tier": tier.name}
+                )
             
         try:
-            bot_response = await self.call_deepseek_api(user_history)
+            # «Гороскоп на сегодня для Льва» — готовый текст из ночной генерации
+            daily_response = self.horoscope.match(user_message) if self.horoscope is not None else None
+            cached_response = None
+            if cache_key is not None and not daily_response:
+                # Некэшируемые запросы (ключа нет) не считаются промахами
+                cached_response = self.answer_cache.get(cache_key)
+                ANSWER_CACHE_EVENTS.inc(result="hit" if cached_response else "miss")
+            delivered = False
+            
+            if daily_response:
+                logger.info(f"🌅 Ответ из гороскопов на день для пользователя {user.id}")
+                bot_response = daily_response
+            elif cached_response:
+                logger.info(f"⚡ Ответ из кэша (попаданий: {self.answer_cache.hits}, промахов: {self.answer_cache.misses})")
+                bot_response = cached_response
+            elif (retry_after := self.usage.retry_after(user.id)) is not None:
+                logger.info(f"⏳ Квота пользователя {user.id} исчерпана: {self.usage.used(user.id)} токенов за окно")
+                await self.sender.reply(update.effective_message, quota_text(retry_after))
+                return
+            elif self.streaming_enabled:
+                # Заглушка уже дописана ответом или текстом ошибки
+                with span("stream_reply"):
+                    bot_response = await self.stream_reply(update, request_messages, tier)
+                if not bot_response:
+                    return
+                delivered = True
+            else:
+                bot_response = await self.call_deepseek_api(
+                    request_messages, on_wait=self.queue_notifier(update), user_id=user.id, tier=tier
+                )
             
             if bot_response:
-                user_history.append({"role": "assistant", "content": bot_response})
-                self.user_sessions[user.id] = user_history
+                if (self.answer_cache is not None and not cached_response and not daily_response
+                        and not isinstance(bot_response, ApiErrorReply)):
+                    self.answer_cache.put(cache_key, bot_response)
+                    
+                commit()
+                # Дописываем к текущей истории: за время ответа ее могла сжать фоновая задача
+                self.prompts.append(session, user_turn, make_message("assistant", bot_response))
+                self.sessions.save(session)
+                if self.summarizer is not None:
+                    self.summarizer.maybe_schedule(session)
                 
-                await update.message.reply_text(
-                    bot_response,
-                    parse_mode=None
-                )
+                if not delivered:
+                    with span("reply", chars=len(bot_response)):
+                        await self.sender.reply(
+                            update.effective_message,
+                            bot_response,
+                            parse_mode=None,
+                            reply_markup=None if daily_response else self.expand_markup(tier, bot_response)
+                        )
                 
                 # Напоминание о донате
                 now = datetime.now()
-                last_reminder = self.user_last_donation_reminder.get(user.id)
+                last_reminder = session.last_donation_reminder
                 
                 should_send_reminder = False
                 
@@ -596,57 +1117,84 @@ async def call_deepseek_api(self, messages: list) -> Optional[str]:
 Любая сумма — вклад в развитие! 🙏
                     """
                     
-                    await update.message.reply_text(
+                    await self.sender.reply(
+                        update.effective_message,
                         reminder_text,
                         parse_mode=ParseMode.MARKDOWN
                     )
-                    self.user_last_donation_reminder[user.id] = now
+                    session.last_donation_reminder = now
+                    self.sessions.save(session)
                 
             else:
-                await update.message.reply_text(
+                await self.sender.reply(
+                    update.effective_message,
                     "⚠️ Не удалось получить ответ. Возможно, превышен лимит запросов. Попробуйте через час."
                 )
                 
         except Exception as e:
             logger.error(f"Error in handle_message: {e}")
-            await update.message.reply_text(
+            await self.sender.reply(
+                update.effective_message,
                 "❌ Произошла ошибка. Попробуйте позже или используйте /reset."
             )
             
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ошибок"""
-        logger.error(f"Update {update} caused error {context.error}")
+        update_id = getattr(update, "update_id", None)
+        logger.error(f"Update {update_id} caused error {context.error}", exc_info=context.error)
         
         if update and update.effective_message:
-            await update.effective_message.reply_text(
+            await self.sender.reply(
+                update.effective_message,
                 "😔 Произошла ошибка. Попробуйте еще раз или используйте /reset.",
                 parse_mode=ParseMode.MARKDOWN
             )
 
-# Глобальная переменная для доступа к приложению
+# Глобальные переменные для доступа к приложению и боту
 application = None
+astrobot = None
 
 def setup_bot():
     """Настройка и создание приложения бота"""
-    global application
+    global application, astrobot
     
     # Проверка переменных окружения
     if not TELEGRAM_BOT_TOKEN:
         raise ValueError("TELEGRAM_BOT_TOKEN не установлен")
-    if not DEEPSEEK_API_KEY:
+    if not DEEPSEEK_API_KEY and not provider_secrets():
         raise ValueError("DEEPSEEK_API_KEY не установлен")
         
-    # Создание приложения
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    
     # Инициализация бота
     astrobot = AstroBot()
     
+    update_processor = PerUserUpdateProcessor()
+    if astrobot.cluster is not None:
+        # Пользователя обрабатывает одна реплика за раз
+        update_processor.guard = astrobot.cluster.user_guard
+    astrobot.update_processor = update_processor
+    HANDLER_PENDING.set_function(lambda: update_processor.pending)
+    HANDLER_ACTIVE.set_function(lambda: update_processor.active)
+    
+    # Создание приложения (пул DeepSeek живет от post_init до post_shutdown;
+    # апдейты разных пользователей обрабатываются параллельно, одного — по порядку)
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .post_init(astrobot.post_init)
+        .post_shutdown(astrobot.post_shutdown)
+        .concurrent_updates(update_processor)
+        .request(TimedRequest(connection_pool_size=256))
+        .build()
+    )
+    
     # Регистрация обработчиков
     application.add_handler(CommandHandler("start", astrobot.start))
     application.add_handler(CommandHandler("help", astrobot.help_command))
     application.add_handler(CommandHandler("donate", astrobot.donate_command))
     application.add_handler(CommandHandler("reset", astrobot.reset_command))
+    application.add_handler(CommandHandler("chart", astrobot.chart_command))
+    application.add_handler(CommandHandler("today", astrobot.today_command))
     application.add_handler(CommandHandler("feedback", astrobot.feedback_command))
     
     application.add_handler(CallbackQueryHandler(astrobot.button_callback))
@@ -659,74 +1207,144 @@ def setup_bot():
     
     return application
 
-# ============ ОСНОВНОЙ БЛОК ЗАПУСКА ============
-if __name__ == '__main__':
-    import os
-    from threading import Thread
-    from http.server import BaseHTTPRequestHandler, HTTPServer
-    
-    # Получаем порт от Railway
-    port = int(os.environ.get("PORT", 8080))
-    
-    # === 1. Настраиваем бота ===
-    if application is None:
-        application = setup_bot()
+# ============ ВЕБ-СЕРВЕР И ЗАПУСК ============
+def create_web_server(application: Application, port: int, webhook_path: Optional[str] = None,
+                      intake: Optional[WebhookIntake] = None) -> WebServer:
+    """Один asyncio-сервер для вебхука, healthcheck, readiness и метрик"""
+    server = WebServer(port=port)
+    cluster = astrobot.cluster
     
-    # === 2. Запускаем healthcheck сервер в отдельном потоке ===
-    def run_healthcheck_server():
-        """Запуск HTTP сервера для healthcheck в отдельном потоке"""
-        class HealthHandler(BaseHTTPRequestHandler):
-            def do_GET(self):
-                if self.path == '/':
-                    self.send_response(200)
-                    self.send_header('Content-type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(b'Bot is running')
-                else:
-                    self.send_response(404)
-                    self.end_headers()
-            
-            def log_message(self, format, *args):
-                pass
+    async def health(request: Request) -> Response:
+        return Response.text("Bot is running")
+        
+    async def ready(request: Request) -> Response:
+        state = astrobot.readiness(application)
+        return Response.json(state, status=200 if state["ready"] else 503)
         
+    async def metrics(request: Request) -> Response:
+        return Response(200, REGISTRY.render().encode("utf-8"), CONTENT_TYPE)
+        
+    async def traces(request: Request) -> Response:
+        # Последние трассы: /debug/traces?limit=20&min_ms=5000 — только медленные
+        if not hmac.compare_digest(request.headers.get(DEBUG_TOKEN_HEADER, ""), TRACE_DEBUG_TOKEN):
+            return Response.text("Forbidden", 403)
+        query = parse_qs(request.query)
         try:
-            server = HTTPServer(('0.0.0.0', port), HealthHandler)
-            print(f"✅ Healthcheck сервер запущен на порту {port}")
-            server.serve_forever()
-        except Exception as e:
-            print(f"❌ Ошибка healthcheck сервера: {e}")
-    
-    # Запускаем healthcheck в отдельном потоке (демон)
-    healthcheck_thread = Thread(target=run_healthcheck_server, daemon=True)
-    healthcheck_thread.start()
-    
-    # === 3. Запускаем бота в ОСНОВНОМ потоке ===
-    print("🚀 Запускаю Астролога-Психолога...")
-    
-    # Получаем конфигурацию
+            limit = int(query.get("limit", ["50"])[0])
+            min_ms = float(query.get("min_ms", ["0"])[0])
+        except ValueError:
+            return Response.text("Bad Request", 400)
+        return Response.json(TRACER.recent(limit, min_ms))
+        
+    async def webhook(request: Request) -> Response:
+        if WEBHOOK_SECRET and request.headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return Response.text("Forbidden", 403)
+        return await accept(request, forward=True)
+        
+    async def internal_update(request: Request) -> Response:
+        # Апдейт, пересланный соседней репликой: этот процесс — владелец пользователя
+        if not cluster.secret or request.headers.get(CLUSTER_SECRET_HEADER) != cluster.secret:
+            return Response.text("Forbidden", 403)
+        return await accept(request, forward=False)
+        
+    async def accept(request: Request, forward: bool) -> Response:
+        try:
+            update = Update.de_json(request.json(), application.bot)
+        except (ValueError, TypeError) as e:
+            logger.error(f"❌ Некорректный апдейт в вебхуке: {e}")
+            return Response.text("Bad Request", 400)
+        key = update_user_key(update)
+        if forward and cluster is not None and isinstance(key, int):
+            try:
+                if await cluster.forward(key, request.body):
+                    return Response.text("OK")
+            except OverflowError:
+                return Response.text("Service Unavailable", 503)
+        if intake is None:
+            await application.update_queue.put(update)
+        elif not await intake.submit(update):
+            # Очередь заполнена: Telegram повторит доставку позже
+            return Response.text("Service Unavailable", 503)
+        return Response.text("OK")
+        
+    server.add_route("GET", "/", health)
+    server.add_route("GET", "/ready", ready)
+    server.add_route("GET", "/metrics", metrics)
+    if TRACE_DEBUG_TOKEN:
+        # user_id и тайминги запросов — только с токеном
+        server.add_route("GET", "/debug/traces", traces)
+    if webhook_path:
+        server.add_route("POST", webhook_path, webhook)
+        if cluster is not None:
+            server.add_route("POST", INTERNAL_UPDATE_PATH, internal_update)
+    return server
+
+
+async def run_bot(application: Application, port: int):
+    """Жизненный цикл приложения: вебхук или polling и веб-сервер в одном цикле событий"""
     domain = os.environ.get("RAILWAY_PUBLIC_DOMAIN", "")
-    token = os.environ.get("TELEGRAM_BOT_TOKEN", "")
+    webhook_path = f"/{TELEGRAM_BOT_TOKEN}" if domain else None
+    # Быстрое подтверждение: ответ Telegram сразу, обработка — воркерами из ограниченной очереди
+    cluster = astrobot.cluster
+    shared_dedup = SharedDeduplicator(cluster.store, DEDUP_TTL) if cluster is not None else None
+    intake = WebhookIntake(application, shared_dedup=shared_dedup) if webhook_path and WEBHOOK_FAST_ACK else None
+    astrobot.webhook_intake = intake
+    server = create_web_server(application, port, webhook_path, intake)
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await server.start()
     
-    if domain and token:
+    if webhook_path:
         # Запуск через вебхук на Railway
-        webhook_url = f"https://{domain}/{token}"
         print(f"📡 Использую вебхук: {domain}")
-        
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            url_path=token,
-            webhook_url=webhook_url,
-            cert=None
+        await application.bot.set_webhook(
+            url=f"https://{domain}{webhook_path}",
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=WEBHOOK_SECRET or None
         )
     else:
         # Запуск через polling
         print("⚠️ Запускаю polling...")
-        
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            close_loop=False,
-            stop_signals=None
-        )
+        if cluster is not None:
+            logger.warning("⚠️ Polling с REPLICA_COUNT > 1: Telegram отдает апдейты только одному getUpdates, "
+                           "для нескольких реплик нужен вебхук")
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    await application.start()
+    if intake is not None:
+        await intake.start()
     
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+            
+    try:
+        await stop_event.wait()
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        await server.stop()
+        if intake is not None:
+            await intake.stop()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# ============ ОСНОВНОЙ БЛОК ЗАПУСКА ============
+if __name__ == '__main__':
+    # Получаем порт от Railway
+    port = int(os.environ.get("PORT", 8080))
+    
+    if application is None:
+        application = setup_bot()
+    
+    print("🚀 Запускаю Астролога-Психолога...")
+    asyncio.run(run_bot(application, port))
     print("🛑 Бот остановлен")
@@ -0,0 +1,315 @@
+import os
+import time
+import zlib
+import asyncio
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+from metrics import CLUSTER_FORWARDS
+from sessions import MemorySessionBackend, SessionBackend, SessionStore, SQLiteSessionBackend
+
+logger = logging.getLogger(__name__)
+
+# Несколько реплик бота: номер этой реплики и их общее число
+REPLICA_COUNT = int(os.getenv("REPLICA_COUNT", "1"))
+REPLICA_INDEX = int(os.getenv("REPLICA_INDEX", "0"))
+# Внутренние адреса реплик по номерам, через запятую (http://bot-0:8080,http://bot-1:8080)
+REPLICA_URLS = os.getenv("REPLICA_URLS", "")
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", os.getenv("WEBHOOK_SECRET", ""))
+CLUSTER_FORWARD_TIMEOUT = float(os.getenv("CLUSTER_FORWARD_TIMEOUT", "3"))
+# Общее хранилище сессий, блокировок и дедупликации
+SHARED_STORE = os.getenv("SHARED_STORE", "sqlite")
+SHARED_STORE_PATH = os.getenv("SHARED_STORE_PATH", "shared.db")
+# Аренда пользователя репликой: продлевается, пока идет обработка
+USER_LOCK_TTL = float(os.getenv("USER_LOCK_TTL", "30"))
+USER_LOCK_WAIT = float(os.getenv("USER_LOCK_WAIT", "60"))
+USER_LOCK_POLL = 0.2
+
+INTERNAL_UPDATE_PATH = "/internal/update"
+CLUSTER_SECRET_HEADER = "x-cluster-secret"
+
+
+def partition(user_id: int, count: int = REPLICA_COUNT) -> int:
+    """Реплика-владелец пользователя (стабильный хеш, одинаковый во всех процессах)"""
+    return zlib.crc32(str(user_id).encode()) % count if count > 1 else 0
+
+
+class SharedStore(ABC):
+    """Состояние, общее для реплик (синхронное, вызывается из потока).
+
+    Ключи с истечением — для дедупликации апдейтов, аренды — для
+    блокировок пользователей, sessions() — хранилище сессий (вместе с
+    отметками напоминаний). Время — настенное: его сравнивают разные
+    процессы.
+    """
+
+    @abstractmethod
+    def add_if_absent(self, key: str, ttl: float) -> bool:
+        """Запомнить ключ на ttl секунд; False, если он уже есть"""
+
+    @abstractmethod
+    def discard(self, key: str):
+        """Забыть ключ"""
+
+    @abstractmethod
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Взять или продлить аренду; False, если ее держит другой владелец"""
+
+    @abstractmethod
+    def release_lease(self, name: str, owner: str):
+        """Отпустить аренду, если она еще наша"""
+
+    @abstractmethod
+    def sessions(self) -> SessionBackend:
+        """Бэкенд сессий в этом же хранилище"""
+
+    def close(self):
+        """Освободить ресурсы"""
+
+
+class MemorySharedStore(SharedStore):
+    """Общее состояние в памяти — для тестов и нескольких реплик в одном процессе"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: Dict[str, float] = {}
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._sessions = MemorySessionBackend()
+
+    def add_if_absent(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            if self._keys.get(key, 0) > now:
+                return False
+            self._keys[key] = now + ttl
+            if len(self._keys) % 1000 == 0:
+                self._keys = {k: expires for k, expires in self._keys.items() if expires > now}
+            return True
+
+    def discard(self, key: str):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is not None and holder[0] != owner and holder[1] > now:
+                return False
+            self._leases[name] = (owner, now + ttl)
+            return True
+
+    def release_lease(self, name: str, owner: str):
+        with self._lock:
+            if self._leases.get(name, ("",))[0] == owner:
+                del self._leases[name]
+
+    def sessions(self) -> SessionBackend:
+        return self._sessions
+
+
+class SQLiteSharedStore(SharedStore):
+    """Общий файл SQLite — реплики на одной машине или общем томе"""
+
+    def __init__(self, path: str = SHARED_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS shared_keys (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._writes = 0
+
+    def add_if_absent(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO shared_keys (key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE shared_keys.expires_at <= ?",
+                (key, now + ttl, now)
+            )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._conn.execute("DELETE FROM shared_keys WHERE expires_at <= ?", (now,))
+            return cursor.rowcount == 1
+
+    def discard(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM shared_keys WHERE key = ?", (key,))
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+                (name, owner, now + ttl, now)
+            )
+            return cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def sessions(self) -> SessionBackend:
+        return SQLiteSessionBackend(self.path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_shared_store(kind: str = SHARED_STORE) -> SharedStore:
+    if kind == "memory":
+        return MemorySharedStore()
+    if kind == "sqlite":
+        return SQLiteSharedStore()
+    raise ValueError(f"Неизвестный SHARED_STORE: {kind}")
+
+
+class SharedDeduplicator:
+    """Дедупликация апдейтов между репликами: повтор мог прийти на соседнюю"""
+
+    def __init__(self, store: SharedStore, ttl: float):
+        self.store = store
+        self.ttl = ttl
+
+    async def check_and_add(self, update_id: int) -> bool:
+        return await asyncio.to_thread(self.store.add_if_absent, f"update:{update_id}", self.ttl)
+
+    async def forget(self, update_id: int):
+        await asyncio.to_thread(self.store.discard, f"update:{update_id}")
+
+
+class Cluster:
+    """Реплика в группе: владение пользователями, аренды и пересылка апдейтов.
+
+    Апдейт пользователя обрабатывает реплика partition(user_id); вебхук,
+    принятый другой репликой, пересылается владельцу. Если владелец
+    недоступен, апдейт обрабатывается на месте — порядок и целостность
+    сессии охраняет аренда пользователя в общем хранилище. Пока аренда
+    у реплики, сессия живет в ее кэше; при взятии аренды кэш сбрасывается
+    (сессию могла изменить другая реплика), при отпускании — записывается.
+    """
+
+    def __init__(self, store: SharedStore, sessions: SessionStore, index: int = REPLICA_INDEX,
+                 count: int = REPLICA_COUNT, urls: Optional[List[str]] = None, secret: str = CLUSTER_SECRET,
+                 lock_ttl: float = USER_LOCK_TTL, lock_wait: float = USER_LOCK_WAIT):
+        self.store = store
+        self.sessions = sessions
+        self.index = index
+        self.count = count
+        self.urls = urls if urls is not None else [url.strip() for url in REPLICA_URLS.split(",") if url.strip()]
+        self.secret = secret
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        # Владелец аренды уникален для процесса: перезапущенная реплика не продлит чужую
+        self.owner = f"replica-{index}-{os.getpid()}-{id(self):x}"
+        self._holders: Dict[int, int] = {}
+        self._renewals: Dict[int, asyncio.Task] = {}
+        self._guards: Dict[int, asyncio.Lock] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def forwarding(self) -> bool:
+        return len(self.urls) == self.count and bool(self.secret)
+
+    async def start(self):
+        if self.count > 1 and not self.forwarding:
+            logger.warning("⚠️ REPLICA_URLS или CLUSTER_SECRET не заданы: апдейты не пересылаются владельцу, "
+                           "порядок держится только арендами")
+        if self.forwarding and self._client is None:
+            self._client = httpx.AsyncClient(timeout=CLUSTER_FORWARD_TIMEOUT)
+        logger.info(f"🧩 Реплика {self.index + 1} из {self.count}")
+
+    async def close(self):
+        for task in self._renewals.values():
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        await asyncio.to_thread(self.store.close)
+
+    def owner_of(self, user_id: int) -> int:
+        return partition(user_id, self.count)
+
+    async def forward(self, user_id: int, body: bytes) -> bool:
+        """Переслать апдейт владельцу; False — обработать на месте"""
+        target = self.owner_of(user_id)
+        if target == self.index or self._client is None:
+            return False
+        try:
+            response = await self._client.post(
+                self.urls[target] + INTERNAL_UPDATE_PATH, content=body,
+                headers={CLUSTER_SECRET_HEADER: self.secret, "Content-Type": "application/json"}
+            )
+        except httpx.HTTPError as e:
+            CLUSTER_FORWARDS.inc(result="failover")
+            logger.warning(f"⚠️ Реплика {target + 1} недоступна ({type(e).__name__}), обрабатываю апдейт сам")
+            return False
+        if response.status_code == 503:
+            # Очередь владельца заполнена — пусть Telegram повторит доставку
+            raise OverflowError("Очередь реплики-владельца заполнена")
+        if response.status_code != 200:
+            CLUSTER_FORWARDS.inc(result="failover")
+            logger.warning(f"⚠️ Реплика {target + 1} ответила {response.status_code}, обрабатываю апдейт сам")
+            return False
+        CLUSTER_FORWARDS.inc(result="forwarded")
+        return True
+
+    @asynccontextmanager
+    async def user_guard(self, user_id: int) -> AsyncIterator[None]:
+        """Аренда пользователя на время обработки (повторный вход в реплике разрешен)"""
+        guard = self._guards.setdefault(user_id, asyncio.Lock())
+        async with guard:
+            if not self._holders.get(user_id):
+                await self._acquire(user_id)
+            self._holders[user_id] = self._holders.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            async with guard:
+                self._holders[user_id] -= 1
+                if not self._holders[user_id]:
+                    del self._holders[user_id]
+                    await self._release(user_id)
+            if user_id not in self._holders and not guard.locked():
+                self._guards.pop(user_id, None)
+
+    async def _acquire(self, user_id: int):
+        name = f"user:{user_id}"
+        deadline = time.monotonic() + self.lock_wait
+        while not await asyncio.to_thread(self.store.acquire_lease, name, self.owner, self.lock_ttl):
+            if time.monotonic() >= deadline:
+                # Держатель завис дольше разумного — работаем без аренды, но громко
+                logger.error(f"❌ Не дождался аренды пользователя {user_id} за {self.lock_wait:.0f} с")
+                break
+            await asyncio.sleep(USER_LOCK_POLL)
+        self.sessions.invalidate(user_id)
+        self._renewals[user_id] = asyncio.create_task(self._renew(name))
+
+    async def _renew(self, name: str):
+        while True:
+            await asyncio.sleep(self.lock_ttl / 3)
+            if not await asyncio.to_thread(self.store.acquire_lease, name, self.owner, self.lock_ttl):
+                logger.error(f"❌ Аренда {name} перехвачена другой репликой")
+
+    async def _release(self, user_id: int):
+        task = self._renewals.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+        try:
+            await self.sessions.flush_user(user_id)
+        finally:
+            await asyncio.to_thread(self.store.release_lease, f"user:{user_id}", self.owner)
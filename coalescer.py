@@ -0,0 +1,117 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Окно склейки: сообщения, пришедшие подряд быстрее, объединяются в один вопрос
+MESSAGE_COALESCE_WINDOW = float(os.getenv("MESSAGE_COALESCE_WINDOW", "1.5"))
+# Сколько ждать завершения отмененного ответа при /reset
+CANCEL_WAIT_TIMEOUT = 5.0
+
+# on_turn(update, context, text, commit): commit() вызывается перед записью ответа в сессию
+TurnHandler = Callable[[Any, Any, str, Callable[[], None]], Awaitable[None]]
+
+
+class _Attempt:
+    __slots__ = ("count", "task", "committed")
+
+    def __init__(self, count: int):
+        self.count = count
+        self.task: Optional[asyncio.Task] = None
+        self.committed = False
+
+
+class _Turn:
+    __slots__ = ("texts", "update", "context", "timer", "attempt")
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.update = None
+        self.context = None
+        self.timer: Optional[asyncio.Task] = None
+        self.attempt: Optional[_Attempt] = None
+
+
+class MessageCoalescer:
+    """Склейка быстрых сообщений пользователя в один вопрос.
+
+    Каждое сообщение перезапускает таймер окна; по его истечении все
+    накопленные тексты уходят в on_turn одним вопросом. Новое сообщение
+    отменяет ответ, который еще не записан в сессию, — его текст войдет
+    в следующий, дополненный вопрос. После commit() ответ доводится до конца.
+    """
+
+    def __init__(self, on_turn: TurnHandler, window: float = MESSAGE_COALESCE_WINDOW):
+        self.on_turn = on_turn
+        self.window = window
+        self._turns: Dict[Hashable, _Turn] = {}
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def add(self, key: Hashable, text: str, update: Any, context: Any):
+        turn = self._turns.get(key)
+        if turn is None:
+            turn = self._turns[key] = _Turn()
+
+        attempt = turn.attempt
+        if attempt is not None and not attempt.committed and not attempt.task.done():
+            logger.info(f"✂️ Пользователь {key} дополнил вопрос, текущий ответ отменен")
+            attempt.task.cancel()
+
+        turn.texts.append(text)
+        turn.update = update
+        turn.context = context
+        if turn.timer is not None:
+            turn.timer.cancel()
+        turn.timer = asyncio.create_task(self._flush_later(key, turn))
+
+    async def cancel(self, key: Hashable):
+        """Забыть накопленные сообщения и остановить ответ (например, при /reset)"""
+        turn = self._turns.pop(key, None)
+        if turn is None:
+            return
+        tasks = [task for task in (turn.timer, turn.attempt and turn.attempt.task) if task and not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=CANCEL_WAIT_TIMEOUT)
+
+    async def close(self):
+        for key in list(self._turns):
+            await self.cancel(key)
+
+    async def _flush_later(self, key: Hashable, turn: _Turn):
+        await asyncio.sleep(self.window)
+        turn.timer = None
+        previous = turn.attempt
+        attempt = turn.attempt = _Attempt(len(turn.texts))
+        text = "\n".join(turn.texts)
+        attempt.task = asyncio.create_task(self._run(key, turn, attempt, previous, text))
+
+    async def _run(self, key: Hashable, turn: _Turn, attempt: _Attempt, previous: Optional[_Attempt], text: str):
+        cancelled = False
+        try:
+            # Ответы одному пользователю не обгоняют друг друга
+            if previous is not None and not previous.task.done():
+                await asyncio.wait([previous.task])
+            await self.on_turn(turn.update, turn.context, text, lambda: self._commit(turn, attempt))
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка ответа пользователю {key}: {e}", exc_info=e)
+        finally:
+            if not cancelled and not attempt.committed:
+                # Завершился без записи (ошибка API): не повторяем эти сообщения
+                self._commit(turn, attempt)
+            if turn.attempt is attempt and turn.timer is None and not turn.texts and self._turns.get(key) is turn:
+                del self._turns[key]
+
+    def _commit(self, turn: _Turn, attempt: _Attempt):
+        if attempt.committed:
+            return
+        attempt.committed = True
+        del turn.texts[:attempt.count]
@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional
+
+import httpx
+
+from metrics import DEEPSEEK_ERRORS, DEEPSEEK_IN_FLIGHT, DEEPSEEK_LATENCY, DEEPSEEK_QUEUE_DEPTH, DEEPSEEK_RESPONSES
+from resilience import (
+    CircuitBreaker, LatencyTracker, RETRY_ATTEMPTS, RETRYABLE_EXCEPTIONS, RETRYABLE_STATUSES,
+    HEDGING_ENABLED, backoff_delay, hedged
+)
+from providers import Provider, ProviderPool, load_providers
+from scheduler import DeepSeekScheduler, PRIORITY_HIGH, PRIORITY_NORMAL, RATE_LIMIT_REQUEUES, TokenBucket
+from tracing import KIND_CLIENT, record_span, span
+
+logger = logging.getLogger(__name__)
+
+# Настройки HTTP-клиента DeepSeek
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+DEEPSEEK_HTTP2 = os.getenv("DEEPSEEK_HTTP2", "1") == "1"
+DEEPSEEK_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "50"))
+DEEPSEEK_MAX_KEEPALIVE = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "20"))
+DEEPSEEK_KEEPALIVE_EXPIRY = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "120"))
+DEEPSEEK_CONNECT_TIMEOUT = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5"))
+DEEPSEEK_READ_TIMEOUT = float(os.getenv("DEEPSEEK_READ_TIMEOUT", "60"))
+DEEPSEEK_WRITE_TIMEOUT = float(os.getenv("DEEPSEEK_WRITE_TIMEOUT", "10"))
+DEEPSEEK_POOL_TIMEOUT = float(os.getenv("DEEPSEEK_POOL_TIMEOUT", "10"))
+
+
+def _http2_available() -> bool:
+    """HTTP/2 в httpx требует пакет h2 (pip install httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def request_timeout(read: Optional[float] = None):
+    """Таймауты запроса: свой таймаут чтения или настройки клиента"""
+    if read is None:
+        return httpx.USE_CLIENT_DEFAULT
+    return httpx.Timeout(
+        connect=DEEPSEEK_CONNECT_TIMEOUT, read=read, write=DEEPSEEK_WRITE_TIMEOUT, pool=DEEPSEEK_POOL_TIMEOUT
+    )
+
+
+def tier_timeout(error: BaseException, read_timeout: Optional[float]) -> bool:
+    """Сработал собственный, более короткий таймаут уровня генерации: повтор с тем же
+    бюджетом снова не успеет, поэтому запрос не повторяется. В счет выключателя и
+    здоровья провайдера такой сбой идет как обычно"""
+    return (
+        read_timeout is not None and read_timeout < DEEPSEEK_READ_TIMEOUT
+        and isinstance(error, httpx.ReadTimeout)
+    )
+
+
+class _RequestTrace:
+    """Фазы запроса (подключение, первый байт) через trace-расширение httpcore"""
+
+    def __init__(self, provider: str = ""):
+        self.provider = provider
+        self.started = time.monotonic()
+        self.connect: Optional[float] = None
+        self.ttfb: Optional[float] = None
+        self._connect_started: Optional[float] = None
+
+    async def __call__(self, event_name: str, info: dict):
+        now = time.monotonic()
+        if event_name == "connection.connect_tcp.started":
+            self._connect_started = now
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            if self._connect_started is not None:
+                self.connect = now - self._connect_started
+        elif event_name.endswith("receive_response_headers.complete"):
+            self.ttfb = now - self.started
+
+    def finish(self, status_code: Optional[int] = None, error: Optional[BaseException] = None):
+        # Подключение замеряется только для новых соединений пула
+        if self.connect is not None:
+            DEEPSEEK_LATENCY.observe(self.connect, phase="connect")
+        if self.ttfb is not None:
+            DEEPSEEK_LATENCY.observe(self.ttfb, phase="ttfb")
+        DEEPSEEK_LATENCY.observe(time.monotonic() - self.started, phase="total")
+        # Те же фазы — спанами в трассу апдейта
+        if self.connect is not None:
+            record_span("deepseek_connect", self._connect_started, self._connect_started + self.connect, KIND_CLIENT)
+        if self.ttfb is not None:
+            record_span("deepseek_ttfb", self.started, self.started + self.ttfb, KIND_CLIENT)
+        attributes = {"provider": self.provider}
+        if status_code is not None:
+            attributes["http.status_code"] = status_code
+        if error is not None:
+            attributes["error"] = type(error).__name__
+        record_span("deepseek_http", self.started, time.monotonic(), KIND_CLIENT, **attributes)
+        if status_code is not None:
+            DEEPSEEK_RESPONSES.inc(status=status_code)
+        if error is not None:
+            DEEPSEEK_ERRORS.inc(type=type(error).__name__)
+
+
+class DeepSeekClient:
+    """Долгоживущий HTTP-клиент DeepSeek с пулом keep-alive соединений"""
+
+    def __init__(self, api_key: Optional[str], api_url: str = DEEPSEEK_API_URL,
+                 scheduler: Optional[DeepSeekScheduler] = None, pool: Optional[ProviderPool] = None):
+        # Ключи и эндпоинты; у каждого свой лимит
+        self.pool = pool or ProviderPool(load_providers(api_key, api_url))
+        # Общая очередь с приоритетами; ее скорость — сумма лимитов ключей
+        self.scheduler = scheduler or DeepSeekScheduler(TokenBucket(self.pool.total_rate, self.pool.total_burst))
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyTracker()
+        DEEPSEEK_QUEUE_DEPTH.set_function(lambda: self.scheduler.queue_depth)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("DeepSeekClient не запущен: вызовите start()")
+        return self._client
+
+    async def start(self):
+        """Создать пул соединений (вызывается из post_init приложения)"""
+        if self._client is not None:
+            return
+        await self.scheduler.start()
+
+        http2 = DEEPSEEK_HTTP2 and _http2_available()
+        if DEEPSEEK_HTTP2 and not http2:
+            logger.warning("⚠️ Пакет h2 не установлен, DeepSeek работает по HTTP/1.1")
+
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json"
+            },
+            limits=httpx.Limits(
+                max_connections=DEEPSEEK_MAX_CONNECTIONS,
+                max_keepalive_connections=DEEPSEEK_MAX_KEEPALIVE,
+                keepalive_expiry=DEEPSEEK_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(
+                connect=DEEPSEEK_CONNECT_TIMEOUT,
+                read=DEEPSEEK_READ_TIMEOUT,
+                write=DEEPSEEK_WRITE_TIMEOUT,
+                pool=DEEPSEEK_POOL_TIMEOUT
+            )
+        )
+        logger.info(f"🔗 Пул соединений DeepSeek создан (HTTP/2: {'да' if http2 else 'нет'}, "
+                    f"провайдеров: {len(self.pool.providers)})")
+
+    async def close(self):
+        """Закрыть пул соединений (вызывается из post_shutdown приложения)"""
+        await self.scheduler.close()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("🔌 Пул соединений DeepSeek закрыт")
+
+    def _hedge_delay(self) -> Optional[float]:
+        return self.latency.hedge_delay() if HEDGING_ENABLED else None
+
+    def _retry_delay(self, retries: int, reason: str) -> Optional[float]:
+        """Учесть сбой; задержка перед повтором или None, если повторять нельзя"""
+        self.breaker.record_failure()
+        if retries + 1 >= RETRY_ATTEMPTS or self.breaker.state == CircuitBreaker.OPEN:
+            return None
+        delay = backoff_delay(retries)
+        logger.warning(f"🔁 {reason}, повтор через {delay:.1f} с (попытка {retries + 2} из {RETRY_ATTEMPTS})")
+        return delay
+
+    def _observe(self, provider: Provider, response: httpx.Response):
+        self.pool.observe(provider, response.status_code, response.headers)
+        # Заголовки лимитов одного ключа описывают всю очередь, только если ключ один
+        if self.pool.single:
+            self.scheduler.observe(response.status_code, response.headers)
+
+    def _requeue(self, status_code: int) -> bool:
+        """429 — подождать лимит; 401/403 одного ключа из нескольких — уйти на другой"""
+        return status_code == 429 or (status_code in (401, 403) and not self.pool.single)
+
+    async def _send(self, payload: dict, is_hedge: bool, read_timeout: Optional[float] = None) -> httpx.Response:
+        if is_hedge:
+            # Страхующий запрос тоже расходует лимит
+            await self.scheduler.acquire(PRIORITY_HIGH)
+        provider = await self.pool.acquire()
+        trace = _RequestTrace(provider.name)
+        DEEPSEEK_IN_FLIGHT.inc()
+        try:
+            response = await self.client.post(
+                provider.url, json=provider.payload(payload), headers=provider.headers, extensions={"trace": trace},
+                timeout=request_timeout(read_timeout)
+            )
+        except Exception as e:
+            trace.finish(error=e)
+            if isinstance(e, RETRYABLE_EXCEPTIONS):
+                self.pool.fail(provider)
+            raise
+        finally:
+            DEEPSEEK_IN_FLIGHT.dec()
+            self.pool.release(provider)
+        trace.finish(status_code=response.status_code)
+        self._observe(provider, response)
+        return response
+
+    async def post(self, payload: dict, priority: int = PRIORITY_NORMAL,
+                   on_wait: Optional[Callable[[int], Awaitable[None]]] = None,
+                   flow: Optional[Hashable] = None, cost: float = 0.0,
+                   read_timeout: Optional[float] = None) -> httpx.Response:
+        """Отправить запрос chat/completions через очередь и общий пул.
+
+        После 429 запрос встает обратно в очередь (до RATE_LIMIT_REQUEUES раз),
+        сетевые сбои и 5xx повторяются с джиттером (до RETRY_ATTEMPTS попыток),
+        при разомкнутом выключателе сразу поднимается CircuitOpenError.
+        on_wait получает позицию в очереди, если ждать приходится долго;
+        flow и cost (пользователь и оценка токенов) — для справедливой очереди;
+        read_timeout — таймаут чтения уровня генерации вместо общего; если он
+        короче общего, его срабатывание не повторяется (но идет в счет выключателя).
+        """
+        self.breaker.check()
+        requeues = retries = 0
+        while True:
+            first = not (requeues or retries)
+            with span("deepseek_queue", attempt=requeues + retries):
+                await self.scheduler.acquire(priority if first else PRIORITY_HIGH, on_wait, flow, cost if first else 0.0)
+            started = time.monotonic()
+            try:
+                response = await hedged(lambda is_hedge: self._send(payload, is_hedge, read_timeout), self._hedge_delay())
+            except RETRYABLE_EXCEPTIONS as e:
+                if tier_timeout(e, read_timeout):
+                    self.breaker.record_failure()
+                    raise
+                delay = self._retry_delay(retries, f"Сетевой сбой DeepSeek ({type(e).__name__})")
+                if delay is None:
+                    raise
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            if self._requeue(response.status_code) and requeues < RATE_LIMIT_REQUEUES:
+                requeues += 1
+                logger.warning(f"🔁 {response.status_code} от DeepSeek, возвращаю запрос в очередь (попытка {requeues})")
+                continue
+            if response.status_code in RETRYABLE_STATUSES:
+                delay = self._retry_delay(retries, f"DeepSeek ответил {response.status_code}")
+                if delay is None:
+                    return response
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            if response.status_code == 200:
+                self.latency.record(time.monotonic() - started)
+            return response
+
+    @asynccontextmanager
+    async def stream(self, payload: dict, priority: int = PRIORITY_NORMAL,
+                     on_wait: Optional[Callable[[int], Awaitable[None]]] = None,
+                     flow: Optional[Hashable] = None, cost: float = 0.0,
+                     read_timeout: Optional[float] = None) -> AsyncIterator[httpx.Response]:
+        """Открыть потоковый (SSE) ответ chat/completions через очередь.
+
+        Повторы и возврат в очередь — как в post(), но только до начала
+        потока: обрыв посреди ответа пробрасывается вызывающему.
+        """
+        self.breaker.check()
+        requeues = retries = 0
+        while True:
+            first = not (requeues or retries)
+            with span("deepseek_queue", attempt=requeues + retries):
+                await self.scheduler.acquire(priority if first else PRIORITY_HIGH, on_wait, flow, cost if first else 0.0)
+            provider = await self.pool.acquire()
+            trace = _RequestTrace(provider.name)
+            request = self.client.build_request(
+                "POST", provider.url, json=provider.payload(payload), headers=provider.headers,
+                timeout=request_timeout(read_timeout),
+                extensions={"trace": trace}
+            )
+            DEEPSEEK_IN_FLIGHT.inc()
+            try:
+                response = await self.client.send(request, stream=True)
+            except Exception as e:
+                DEEPSEEK_IN_FLIGHT.dec()
+                self.pool.release(provider)
+                trace.finish(error=e)
+                if not isinstance(e, RETRYABLE_EXCEPTIONS):
+                    raise
+                self.pool.fail(provider)
+                if tier_timeout(e, read_timeout):
+                    self.breaker.record_failure()
+                    raise
+                delay = self._retry_delay(retries, f"Сетевой сбой DeepSeek ({type(e).__name__})")
+                if delay is None:
+                    raise
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            delay = None
+            error: Optional[BaseException] = None
+            try:
+                self._observe(provider, response)
+                if self._requeue(response.status_code) and requeues < RATE_LIMIT_REQUEUES:
+                    requeues += 1
+                    logger.warning(f"🔁 {response.status_code} от DeepSeek, возвращаю поток в очередь (попытка {requeues})")
+                    continue
+                if response.status_code in RETRYABLE_STATUSES:
+                    delay = self._retry_delay(retries, f"DeepSeek ответил {response.status_code}")
+                    if delay is not None:
+                        retries += 1
+                        continue
+                else:
+                    self.breaker.record_success()
+                try:
+                    yield response
+                except Exception as e:
+                    error = e
+                    raise
+                return
+            finally:
+                await response.aclose()
+                DEEPSEEK_IN_FLIGHT.dec()
+                self.pool.release(provider)
+                # total для потока — до конца чтения тела
+                trace.finish(status_code=response.status_code, error=error)
+                if delay is not None:
+                    await asyncio.sleep(delay)
+
+
+async def iter_sse_deltas(response: httpx.Response, usage: Optional[dict] = None) -> AsyncIterator[str]:
+    """Достать фрагменты текста из SSE-потока DeepSeek (формат OpenAI).
+
+    Если передан словарь usage, в него попадет поле usage из последнего
+    фрагмента (нужно stream_options.include_usage в запросе).
+    """
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            # Пустые строки-разделители и keep-alive комментарии
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            logger.warning(f"⚠️ Некорректный SSE-фрагмент: {data[:200]}")
+            continue
+        if usage is not None and chunk.get("usage"):
+            usage.update(chunk["usage"])
+        for choice in chunk.get("choices") or []:
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                yield content
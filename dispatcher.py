@@ -0,0 +1,110 @@
+import os
+import asyncio
+import inspect
+import logging
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Параллельная обработка апдейтов
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "16"))
+BOT_MAX_PENDING_UPDATES = int(os.getenv("BOT_MAX_PENDING_UPDATES", "256"))
+
+
+def update_user_key(update: object) -> Optional[Hashable]:
+    """Ключ упорядочивания: пользователь, иначе чат"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class _UserLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка разных пользователей при строгом порядке внутри одного.
+
+    Внешний семафор PTB (max_pending) ограничивает число принятых апдейтов,
+    включая ожидающие своей очереди у пользователя; внутренний (workers) —
+    число одновременно работающих обработчиков. Апдейт, ждущий предыдущее
+    сообщение того же пользователя, не занимает место воркера.
+    guard(key) — межпроцессная блокировка пользователя (аренда реплики).
+    run_detached() — работа вне апдейта (ответ на склеенные сообщения): она
+    занимает тех же воркеров и видна в pending/active.
+    """
+
+    def __init__(self, workers: int = BOT_WORKERS, max_pending: int = BOT_MAX_PENDING_UPDATES):
+        super().__init__(max_concurrent_updates=max(workers, max_pending))
+        self.workers = workers
+        self._workers_semaphore = asyncio.BoundedSemaphore(workers)
+        self._user_locks: Dict[Hashable, _UserLock] = {}
+        self.active = 0
+        self.detached = 0
+        self.guard: Optional[Callable[[Hashable], AsyncContextManager]] = None
+
+    @property
+    def pending(self) -> int:
+        """Апдейты и ответы вне апдейтов, принятые в обработку, но еще не завершенные"""
+        return sum(entry.users for entry in self._user_locks.values()) + self.detached
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = update_user_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = _UserLock()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                if self.guard is None:
+                    await self._run(coroutine)
+                else:
+                    async with self.guard(key):
+                        await self._run(coroutine)
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._user_locks[key]
+
+    async def run_detached(self, coroutine: Awaitable[Any]) -> None:
+        """Выполнить работу, запущенную вне апдейта, под общим лимитом воркеров"""
+        self.detached += 1
+        try:
+            await self._run(coroutine)
+        except asyncio.CancelledError:
+            # Отменили, пока ждали воркера: корутина так и не запускалась
+            if inspect.iscoroutine(coroutine):
+                coroutine.close()
+            raise
+        finally:
+            self.detached -= 1
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        async with self._workers_semaphore:
+            self.active += 1
+            try:
+                await coroutine
+            finally:
+                self.active -= 1
+
+    async def initialize(self) -> None:
+        logger.info(f"⚙️ Параллельная обработка: {self.workers} воркеров, "
+                    f"до {self.max_concurrent_updates} апдейтов в очереди")
+
+    async def shutdown(self) -> None:
+        """Ничего не освобождаем: PTB дожидается задач сам"""
@@ -0,0 +1,216 @@
+import os
+import json
+import html
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, List, Optional
+
+from metrics import FEEDBACK_EVENTS
+from resilience import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+# Отзывы: журнал только на дозапись с ротацией по размеру
+FEEDBACK_PATH = os.getenv("FEEDBACK_PATH", "feedback.jsonl")
+FEEDBACK_MAX_BYTES = int(os.getenv("FEEDBACK_MAX_BYTES", str(5 * 1024 * 1024)))
+FEEDBACK_BACKUPS = int(os.getenv("FEEDBACK_BACKUPS", "5"))
+# Сводки администратору: не чаще раза в интервал, одной пачкой
+FEEDBACK_DIGEST_INTERVAL = float(os.getenv("FEEDBACK_DIGEST_INTERVAL", "300"))
+FEEDBACK_DIGEST_RETRIES = int(os.getenv("FEEDBACK_DIGEST_RETRIES", "3"))
+# Размер одной сводки (лимит Telegram 4096 символов) и длина отзыва в ней
+FEEDBACK_DIGEST_CHARS = 3800
+FEEDBACK_ITEM_CHARS = 1200
+
+# send(text) отправляет HTML-сводку администратору
+DigestSender = Callable[[str], Awaitable[object]]
+
+
+class FeedbackStore:
+    """Журнал отзывов в JSONL с ротацией и отметкой доставки.
+
+    Каждый отзыв получает возрастающий id. Id последнего отзыва, дошедшего
+    до администратора, хранится в файле <path>.sent, поэтому после
+    перезапуска недоставленные отзывы поднимаются из журнала заново.
+    Без доставки (deliver=False) отзывы только пишутся в журнал.
+    """
+
+    def __init__(self, path: str = FEEDBACK_PATH, max_bytes: int = FEEDBACK_MAX_BYTES, backups: int = FEEDBACK_BACKUPS,
+                 deliver: bool = True):
+        self.path = path
+        self.deliver = deliver
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pending: Deque[dict] = deque()
+        self.delivered_id = 0
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cursor_path(self) -> str:
+        return f"{self.path}.sent"
+
+    def _files(self) -> List[str]:
+        """Файлы журнала от старых к новым"""
+        rotated = [f"{self.path}.{index}" for index in range(self.backups, 0, -1)]
+        return [path for path in rotated + [self.path] if os.path.exists(path)]
+
+    def load(self):
+        """Восстановить недоставленные отзывы после перезапуска"""
+        try:
+            with open(self.cursor_path, encoding="utf-8") as f:
+                self.delivered_id = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.cursor_path}: {e}")
+
+        for path in self._files():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Недописанная строка после аварийной остановки
+                        continue
+                    self._last_id = max(self._last_id, record["id"])
+                    if self.deliver and record["id"] > self.delivered_id:
+                        self.pending.append(record)
+        if self.pending:
+            logger.info(f"📨 Недоставленных отзывов: {len(self.pending)}")
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self.backups and os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    async def append(self, user_id: int, name: str, username: Optional[str], text: str) -> dict:
+        # Id из времени: остается возрастающим и после перезапуска
+        self._last_id = max(self._last_id + 1, time.time_ns() // 1000)
+        record = {
+            "id": self._last_id,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "user_id": user_id,
+            "name": name,
+            "username": username,
+            "text": text
+        }
+        await asyncio.to_thread(self._write, record)
+        if self.deliver:
+            self.pending.append(record)
+        FEEDBACK_EVENTS.inc(result="stored")
+        return record
+
+    def _write_cursor(self, delivered_id: int):
+        temporary = f"{self.cursor_path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(str(delivered_id))
+        os.replace(temporary, self.cursor_path)
+
+    async def mark_delivered(self, records: List[dict]):
+        delivered = {record["id"] for record in records}
+        self.pending = deque(record for record in self.pending if record["id"] not in delivered)
+        self.delivered_id = max(self.delivered_id, *delivered)
+        await asyncio.to_thread(self._write_cursor, self.delivered_id)
+
+
+def format_item(record: dict) -> str:
+    """Отзыв в HTML-сводке: пользовательский текст экранируется"""
+    text = record["text"]
+    if len(text) > FEEDBACK_ITEM_CHARS:
+        text = text[:FEEDBACK_ITEM_CHARS] + "…"
+    author = html.escape(record.get("name") or "")
+    if record.get("username"):
+        author += f" (@{html.escape(record['username'])})"
+    return f"<b>{author}</b> · id {record['user_id']} · {record['time'][11:16]}\n{html.escape(text)}"
+
+
+def build_digest(records: List[dict], limit: int = FEEDBACK_DIGEST_CHARS) -> List[dict]:
+    """Сколько отзывов с начала очереди помещается в одно сообщение"""
+    batch = []
+    size = 0
+    for record in records:
+        size += len(format_item(record)) + 2
+        if batch and size > limit:
+            break
+        batch.append(record)
+    return batch
+
+
+class FeedbackDigest:
+    """Фоновая доставка отзывов администратору сводками.
+
+    Раз в interval все накопленные отзывы уходят одним или несколькими
+    сообщениями; при ошибке сводка повторяется с задержкой, а если
+    попытки кончились — отзывы остаются в очереди до следующего цикла.
+    """
+
+    def __init__(self, store: FeedbackStore, send: DigestSender, interval: float = FEEDBACK_DIGEST_INTERVAL,
+                 retries: int = FEEDBACK_DIGEST_RETRIES):
+        self.store = store
+        self.send = send
+        self.interval = interval
+        self.retries = retries
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка доставки отзывов: {e}")
+
+    async def flush(self) -> int:
+        """Отправить все накопленные отзывы; возвращает число доставленных"""
+        delivered = 0
+        while self.store.pending:
+            batch = build_digest(list(self.store.pending))
+            header = f"📨 <b>ОТЗЫВЫ</b> ({len(batch)} из {len(self.store.pending)})"
+            text = "\n\n".join([header] + [format_item(record) for record in batch])
+            if not await self._send_with_retry(text):
+                break
+            await self.store.mark_delivered(batch)
+            FEEDBACK_EVENTS.inc(len(batch), result="delivered")
+            delivered += len(batch)
+        return delivered
+
+    async def _send_with_retry(self, text: str) -> bool:
+        for attempt in range(self.retries):
+            try:
+                await self.send(text)
+                return True
+            except Exception as e:
+                logger.warning(f"⚠️ Сводка отзывов не отправлена (попытка {attempt + 1} из {self.retries}): {e}")
+                if attempt + 1 < self.retries:
+                    await asyncio.sleep(backoff_delay(attempt + 1))
+        FEEDBACK_EVENTS.inc(result="digest_failed")
+        return False
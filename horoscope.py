@@ -0,0 +1,251 @@
+import os
+import re
+import json
+import asyncio
+import logging
+from datetime import date, datetime, time as dt_time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import natal
+from metrics import DAILY_HOROSCOPE_EVENTS
+from tokens import make_message
+
+logger = logging.getLogger(__name__)
+
+# Ежедневные гороскопы по знакам и толкования главных транзитов дня
+HOROSCOPE_ENABLED = os.getenv("HOROSCOPE_ENABLED", "1") == "1"
+HOROSCOPE_TIMEZONE = os.getenv("HOROSCOPE_TIMEZONE", "Europe/Moscow")
+# Время пакетной генерации (ЧЧ:ММ в HOROSCOPE_TIMEZONE) — ночью, когда мало живых запросов
+HOROSCOPE_TIME = os.getenv("HOROSCOPE_TIME", "03:30")
+HOROSCOPE_CONCURRENCY = int(os.getenv("HOROSCOPE_CONCURRENCY", "3"))
+HOROSCOPE_TRANSITS = int(os.getenv("HOROSCOPE_TRANSITS", "5"))
+HOROSCOPE_MAX_TOKENS = int(os.getenv("HOROSCOPE_MAX_TOKENS", "700"))
+HOROSCOPE_PATH = os.getenv("HOROSCOPE_PATH", "horoscope.json")
+# Вопросы длиннее — уже не «гороскоп на сегодня», а личная консультация
+HOROSCOPE_MATCH_MAX_CHARS = int(os.getenv("HOROSCOPE_MATCH_MAX_CHARS", "120"))
+
+SKY_HEADER = "Небо на {day} (полдень, {zone}). Используй только эти положения:"
+SIGN_PROMPT = "Гороскоп на сегодня для знака {sign}: как сегодняшние транзиты проявляются у этого знака. До 150 слов."
+TRANSIT_PROMPT = "Что означает сегодняшний транзит «{transit}» для всех знаков и как с ним работать? До 150 слов."
+
+# Основы названий знаков в любом падеже: «для Льва», «Рыбам», «у Весов»
+SIGN_PATTERNS = (
+    r"ов(ен|н[а-я]*)", r"тел(ец|ьц[а-я]*)", r"близнец[а-я]*", r"рак(а|у|ом|е|ам|ов|и)?", r"(лев|льв[а-я]*)",
+    r"дев(а|ы|е|у|ой|ам|ах)", r"вес(ы|ов|ам|ах)", r"скорпион[а-я]*", r"стрел(ец|ьц[а-я]*)",
+    r"козерог[а-я]*", r"водоле[а-я]*", r"рыб(а|ы|ам|ах)?"
+)
+_SIGN_RES = [re.compile(rf"(?<![а-я]){pattern}(?![а-я])") for pattern in SIGN_PATTERNS]
+# Просьба о гороскопе на сегодня: «гороскоп для Льва», «Лев сегодня», «что на сегодня Рыбам?»
+_HOROSCOPE_RE = re.compile(r"гороскоп(а|ы)?")
+_DAY_RE = re.compile(r"сегодня|сегодняшн[а-я]*|день|дня")
+# Кроме знака, «гороскоп» и дня в такой просьбе встречаются только эти слова;
+# любое другое («неделю», «совместимости», «составить») — уже вопрос к модели
+_FILLER_WORDS = {
+    "что", "как", "а", "и", "на", "для", "у", "мне", "нам", "меня", "знак", "знака", "знаку",
+    "ждет", "ожидает", "будет", "там", "по", "пожалуйста"
+}
+# Медленные аспекты, в которых не участвует Луна: она меняет знак каждые 2,5 дня
+TRANSIT_MAX_ORB = 3.0
+
+# complete(messages) -> текст или None, если вызов не удался
+Completion = Callable[[List[dict]], Awaitable[Optional[str]]]
+
+
+def parse_time(value: str, zone: ZoneInfo) -> dt_time:
+    hours, minutes = map(int, value.split(":"))
+    return dt_time(hours, minutes, tzinfo=zone)
+
+
+def _sign_of_word(word: str) -> Optional[str]:
+    for sign, pattern in zip(natal.SIGNS, _SIGN_RES):
+        if pattern.fullmatch(word):
+            return sign
+    return None
+
+
+def find_sign(text: str) -> Optional[str]:
+    """Первый знак зодиака, упомянутый в тексте"""
+    text = text.lower().replace("ё", "е")
+    found = []
+    for sign, pattern in zip(natal.SIGNS, _SIGN_RES):
+        match = pattern.search(text)
+        if match:
+            found.append((match.start(), sign))
+    return min(found)[1] if found else None
+
+
+def daily_sign(text: str) -> Optional[str]:
+    """Знак из просьбы о гороскопе на сегодня или None.
+
+    Подходит только сообщение из одного знака, слов «гороскоп»/«сегодня» и
+    служебных слов. Другой период, совместимость, второй знак или вопрос по
+    существу («Луна в Весах в моем гороскопе») идут к модели.
+    """
+    words = re.findall(r"[а-яa-z]+", text.lower().replace("ё", "е"))
+    if not any(_HOROSCOPE_RE.fullmatch(word) or _DAY_RE.fullmatch(word) for word in words):
+        return None
+    signs = set()
+    for word in words:
+        sign = _sign_of_word(word)
+        if sign:
+            signs.add(sign)
+        elif word not in _FILLER_WORDS and not _HOROSCOPE_RE.fullmatch(word) and not _DAY_RE.fullmatch(word):
+            return None
+    return signs.pop() if len(signs) == 1 else None
+
+
+def sky_of_day(day: date, zone: ZoneInfo) -> Tuple[str, List[str]]:
+    """Положения планет на полдень дня и главные транзиты (самые точные аспекты без Луны)"""
+    chart = natal.calculate_chart(datetime.combine(day, dt_time(12, 0), zone), time_known=False)
+    lines = []
+    for placement in chart.placements:
+        text = f"{natal.BODY_NAMES[placement.body]} в знаке {natal.sign_of(placement.longitude)}"
+        if placement.retrograde:
+            text += " (ретроград)"
+        lines.append(text)
+    transits = [
+        f"{natal.BODY_NAMES[first]} {aspect} {natal.BODY_NAMES[second]}"
+        for first, second, aspect, orb in chart.aspects
+        if "moon" not in (first, second) and orb <= TRANSIT_MAX_ORB
+    ][:HOROSCOPE_TRANSITS]
+    header = SKY_HEADER.format(day=day.strftime("%d.%m.%Y"), zone=zone.key)
+    facts = "\n".join([header, *lines, "Главные транзиты: " + ("; ".join(transits) or "нет точных аспектов")])
+    return facts, transits
+
+
+class DailyHoroscope:
+    """Пакетная генерация ежедневных текстов и мгновенная выдача из кэша.
+
+    Раз в сутки (JobQueue, ночью) для 12 знаков и главных транзитов дня
+    генерируются толкования: не больше concurrency запросов одновременно,
+    с низким приоритетом в общем планировщике DeepSeek. Все запросы
+    начинаются с одинаковых системного промпта и фактов неба, поэтому
+    попадают в контекстный кэш. Результат хранится в памяти и в файле,
+    чтобы перезапуск не повторял генерацию. Тексты, которые не удалось
+    получить, догенерируются при следующем обращении.
+    """
+
+    def __init__(self, complete: Completion, system_message: dict, path: str = HOROSCOPE_PATH,
+                 concurrency: int = HOROSCOPE_CONCURRENCY, timezone_name: str = HOROSCOPE_TIMEZONE):
+        self.complete = complete
+        self.system_message = system_message
+        self.path = path
+        self.concurrency = concurrency
+        self.zone = ZoneInfo(timezone_name)
+        self.day: Optional[date] = None
+        self.sky = ""
+        self.transits: List[str] = []
+        self.texts: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def today(self) -> date:
+        return datetime.now(self.zone).date()
+
+    @property
+    def fresh(self) -> bool:
+        return self.day == self.today()
+
+    @property
+    def generating(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def load(self):
+        """Поднять сегодняшние тексты из файла после перезапуска"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            day = date.fromisoformat(data["day"])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.path}: {e}")
+            return
+        if day == self.today():
+            self.day, self.sky, self.transits, self.texts = day, data["sky"], data["transits"], data["texts"]
+            logger.info(f"🌅 Гороскопы на {day} загружены из {self.path}")
+
+    def _dump(self, data: dict):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temporary, self.path)
+
+    def ensure_fresh(self) -> Optional[asyncio.Task]:
+        """Запустить генерацию в фоне, если текстов на сегодня нет или не хватает"""
+        complete = self.fresh and all(self.texts.get(key) for key in self._keys())
+        if not complete and not self.generating:
+            self._task = asyncio.create_task(self.refresh())
+        return self._task
+
+    async def job(self, context):
+        """Колбэк JobQueue"""
+        task = self.ensure_fresh()
+        if task is not None:
+            await asyncio.shield(task)
+
+    def _keys(self) -> List[str]:
+        return list(natal.SIGNS) + self.transits
+
+    async def refresh(self):
+        day = self.today()
+        if self.day != day:
+            self.sky, self.transits = sky_of_day(day, self.zone)
+            self.day, self.texts = day, {}
+
+        missing = [key for key in self._keys() if not self.texts.get(key)]
+        if not missing:
+            return
+        logger.info(f"🌅 Генерация гороскопов на {day}: {len(missing)} текстов, по {self.concurrency} одновременно")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        prefix = [self.system_message, make_message("system", self.sky)]
+
+        async def generate(key: str):
+            question = SIGN_PROMPT.format(sign=key) if key in natal.SIGNS else TRANSIT_PROMPT.format(transit=key)
+            async with semaphore:
+                try:
+                    text = await self.complete(prefix + [make_message("user", question)])
+                except Exception as e:
+                    logger.error(f"❌ Гороскоп «{key}» не получен: {e}")
+                    text = None
+            if text and self.day == day:
+                self.texts[key] = text.strip()
+                DAILY_HOROSCOPE_EVENTS.inc(result="generated")
+            else:
+                DAILY_HOROSCOPE_EVENTS.inc(result="failed")
+
+        await asyncio.gather(*(generate(key) for key in missing))
+        if self.day == day:
+            data = {"day": day.isoformat(), "sky": self.sky, "transits": self.transits, "texts": self.texts}
+            await asyncio.to_thread(self._dump, data)
+            logger.info(f"🌅 Гороскопы на {day}: готово {len(self.texts)} из {len(self._keys())}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def for_sign(self, sign: str) -> Optional[str]:
+        text = self.texts.get(sign) if self.fresh else None
+        if text:
+            DAILY_HOROSCOPE_EVENTS.inc(result="served")
+            return f"🌅 {sign.upper()}: ГОРОСКОП НА {self.day.strftime('%d.%m.%Y')}\n\n{text}"
+        return None
+
+    def overview(self) -> Optional[str]:
+        """Небо дня и толкования главных транзитов"""
+        if not self.fresh:
+            return None
+        parts = [f"🌅 НЕБО НА {self.day.strftime('%d.%m.%Y')}", self.sky.split("\n", 1)[1]]
+        for transit in self.transits:
+            if self.texts.get(transit):
+                parts.append(f"🔭 {transit.upper()}\n{self.texts[transit]}")
+        DAILY_HOROSCOPE_EVENTS.inc(result="served")
+        return "\n\n".join(parts)
+
+    def match(self, question: str) -> Optional[str]:
+        """Готовый ответ на короткий вопрос вида «гороскоп на сегодня для Рыб»"""
+        if len(question) > HOROSCOPE_MATCH_MAX_CHARS:
+            return None
+        sign = daily_sign(question)
+        return self.for_sign(sign) if sign else None
@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import queue
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+# Формат логов: text — как раньше, json — одна JSON-запись на строку
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Сколько символов тела ответа писать на уровне DEBUG
+LOG_BODY_SAMPLE = int(os.getenv("LOG_BODY_SAMPLE", "300"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_BEARER_RE = re.compile(r"(Bearer\s+)[A-Za-z0-9._\-]+", re.IGNORECASE)
+# Токен бота без \b слева: в URL он идет сразу после «bot» (api.telegram.org/bot<TOKEN>/)
+_SECRET_RE = re.compile(r"\bsk-[A-Za-z0-9]{8,}|(?<!\d)\d{6,12}:[A-Za-z0-9_\-]{30,}")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def redact_text(text: Optional[str]) -> str:
+    """Пользовательский текст в логах: только длина и короткий отпечаток"""
+    if not text:
+        return "<empty>"
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:8]
+    return f"<text len={len(text)} sha={digest}>"
+
+
+def redact_secrets(message: str, secrets: Iterable[Optional[str]] = ()) -> str:
+    """Вырезать ключи API, токены ботов и Bearer-заголовки"""
+    for secret in secrets:
+        if secret:
+            message = message.replace(secret, "***")
+    message = _BEARER_RE.sub(r"\1***", message)
+    return _SECRET_RE.sub("***", message)
+
+
+def body_sample(text: str) -> str:
+    """Начало тела ответа для DEBUG-логов"""
+    if len(text) <= LOG_BODY_SAMPLE:
+        return text
+    return f"{text[:LOG_BODY_SAMPLE]}… (+{len(text) - LOG_BODY_SAMPLE} симв.)"
+
+
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+    """Ставит в очередь уже отформатированную запись и маскирует секреты в итоговом
+    тексте (вместе с трассировкой исключения) и в полях структурированной записи"""
+
+    def __init__(self, log_queue: "queue.SimpleQueue[logging.LogRecord]", secrets: Iterable[Optional[str]] = ()):
+        super().__init__(log_queue)
+        self.secrets = [secret for secret in secrets if secret]
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # prepare() копирует запись и дописывает трассировку к сообщению
+        record = super().prepare(record)
+        record.msg = record.message = redact_secrets(record.msg, self.secrets)
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.fields = {
+                key: redact_secrets(value, self.secrets) if isinstance(value, str) else value
+                for key, value in fields.items()
+            }
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат; поля структурированной записи — в виде key=value"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-запись на строку с полями из extra={'fields': {...}}"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(secrets: Iterable[Optional[str]] = ()):
+    """Настроить корневой логгер: запись в stdout через очередь в фоновом потоке,
+    чтобы обработчики в цикле событий не ждали ввода-вывода"""
+    global _listener
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(TEXT_FORMAT))
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    # Маскируем при постановке в очередь, после форматирования с трассировкой
+    queue_handler = RedactingQueueHandler(log_queue, secrets)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,265 @@
+import math
+import time
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Минимальная реализация метрик в текстовом формате Prometheus (без внешних зависимостей)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TELEGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, object]) -> LabelKey:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelKey, float] = {}
+        self._functions: Dict[LabelKey, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """Значение вычисляется в момент сбора метрик"""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        function = self._functions.get(key)
+        return function() if function else self._values.get(key, 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+            functions = list(self._functions.items())
+        lines = [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional["Registry"] = None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # ключ -> (счетчики по корзинам, сумма, количество)
+        self._values: Dict[LabelKey, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, object]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics)
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Метрики бота
+DEEPSEEK_LATENCY = Histogram(
+    "astrobot_deepseek_latency_seconds",
+    "Задержка запросов к DeepSeek по фазам (connect, ttfb, total)",
+    ["phase"]
+)
+DEEPSEEK_IN_FLIGHT = Gauge("astrobot_deepseek_in_flight", "Запросы к DeepSeek в процессе выполнения")
+DEEPSEEK_QUEUE_DEPTH = Gauge("astrobot_deepseek_queue_depth", "Запросы, ожидающие слота в очереди к DeepSeek")
+DEEPSEEK_RESPONSES = Counter("astrobot_deepseek_responses_total", "Ответы DeepSeek по HTTP-статусу", ["status"])
+DEEPSEEK_ERRORS = Counter("astrobot_deepseek_errors_total", "Сетевые ошибки запросов к DeepSeek", ["type"])
+DEEPSEEK_PROVIDER_OUTSTANDING = Gauge(
+    "astrobot_deepseek_provider_outstanding", "Запросы в работе по провайдерам (ключ и эндпоинт)", ["provider"]
+)
+DEEPSEEK_PROVIDER_EJECTIONS = Counter(
+    "astrobot_deepseek_provider_ejections_total", "Исключения провайдеров из ротации по причине", ["provider", "reason"]
+)
+DEEPSEEK_TOKENS = Counter("astrobot_deepseek_tokens_total", "Токены из поля usage ответов DeepSeek", ["kind"])
+GENERATION_TIERS = Counter(
+    "astrobot_generation_tier_total", "Вопросы по уровням генерации: short, normal, deep, expand", ["tier"]
+)
+SPAN_DURATION = Histogram(
+    "astrobot_span_seconds",
+    "Длительность участков обработки апдейта (спаны трассировки)",
+    ["span"]
+)
+TELEGRAM_LATENCY = Histogram(
+    "astrobot_telegram_request_latency_seconds",
+    "Задержка вызовов Telegram Bot API",
+    ["method"],
+    buckets=TELEGRAM_BUCKETS
+)
+TELEGRAM_RETRY_AFTER = Counter("astrobot_telegram_retry_after_total", "Ответы RetryAfter (flood control) от Telegram")
+HANDLER_PENDING = Gauge("astrobot_handler_pending_updates", "Апдейты, принятые в обработку и еще не завершенные")
+HANDLER_ACTIVE = Gauge("astrobot_handler_active_updates", "Апдейты, которые обрабатываются прямо сейчас")
+ANSWER_CACHE_EVENTS = Counter("astrobot_answer_cache_total", "Обращения к кэшу ответов", ["result"])
+WEBHOOK_QUEUE_DEPTH = Gauge("astrobot_webhook_queue_depth", "Апдейты во внутренней очереди вебхука")
+CLUSTER_FORWARDS = Counter(
+    "astrobot_cluster_forwards_total", "Апдейты, пересланные реплике-владельцу: forwarded, failover", ["result"]
+)
+FEEDBACK_EVENTS = Counter(
+    "astrobot_feedback_total", "Отзывы: stored, delivered, digest_failed", ["result"]
+)
+USER_QUOTA_THROTTLED = Counter("astrobot_user_quota_throttled_total", "Вопросы, отклоненные по квоте токенов пользователя")
+DAILY_HOROSCOPE_EVENTS = Counter(
+    "astrobot_daily_horoscope_total", "Ежедневные гороскопы: generated, failed, served", ["result"]
+)
+WEBHOOK_UPDATES = Counter("astrobot_webhook_updates_total", "Апдейты вебхука: accepted, duplicate, rejected", ["result"])
+
+
+DEEPSEEK_PROMPT_CACHE_HIT_RATIO = Gauge(
+    "astrobot_deepseek_prompt_cache_hit_ratio",
+    "Доля токенов промпта, взятых из контекстного кэша DeepSeek"
+)
+
+USAGE_KINDS = ("prompt_tokens", "completion_tokens", "prompt_cache_hit_tokens", "prompt_cache_miss_tokens")
+
+
+def prompt_cache_hit_ratio() -> float:
+    hit = DEEPSEEK_TOKENS.value(kind="prompt_cache_hit")
+    miss = DEEPSEEK_TOKENS.value(kind="prompt_cache_miss")
+    return hit / (hit + miss) if hit + miss else 0.0
+
+
+DEEPSEEK_PROMPT_CACHE_HIT_RATIO.set_function(prompt_cache_hit_ratio)
+
+
+def record_usage(usage: Optional[dict]):
+    """Учесть поле usage из ответа DeepSeek (включая попадания в кэш префикса)"""
+    if not usage:
+        return
+    for kind in USAGE_KINDS:
+        value = usage.get(kind)
+        if isinstance(value, (int, float)):
+            DEEPSEEK_TOKENS.inc(value, kind=kind[:-len("_tokens")])
@@ -0,0 +1,501 @@
+"""Локальный расчет натальной карты по предрассчитанной эфемериде.
+
+Таблица долгот планет (шаг 1 сутки, 1900–2100, uint16) лежит в
+ephemeris.npy рядом с модулем и открывается через memory map: в память
+читаются только 4 строки вокруг нужной даты, положение получается
+кубической интерполяцией. Пересобрать таблицу: python natal.py build
+"""
+import os
+import re
+import sys
+import math
+import logging
+from datetime import date, datetime, time as dt_time, timedelta, timezone, tzinfo
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+logger = logging.getLogger(__name__)
+
+EPHEMERIS_PATH = os.getenv("EPHEMERIS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ephemeris.npy"))
+EPHEMERIS_START = date(1900, 1, 1)
+EPHEMERIS_END = date(2100, 12, 31)
+# Долгота в uint16: 360° / 65536 ≈ 20″
+LONGITUDE_SCALE = 65536 / 360
+
+BODIES = ("sun", "moon", "mercury", "venus", "mars", "jupiter", "saturn", "uranus", "neptune", "pluto", "node")
+BODY_NAMES = {
+    "sun": "Солнце", "moon": "Луна", "mercury": "Меркурий", "venus": "Венера", "mars": "Марс",
+    "jupiter": "Юпитер", "saturn": "Сатурн", "uranus": "Уран", "neptune": "Нептун", "pluto": "Плутон",
+    "node": "Северный узел"
+}
+SIGNS = ("Овен", "Телец", "Близнецы", "Рак", "Лев", "Дева", "Весы", "Скорпион", "Стрелец", "Козерог",
+         "Водолей", "Рыбы")
+# Мажорные аспекты: угол, орбис
+ASPECTS = (("соединение", 0, 8), ("секстиль", 60, 4), ("квадрат", 90, 6), ("трин", 120, 6), ("оппозиция", 180, 8))
+
+# Города: широта, долгота (восток +), часовой пояс IANA
+CITIES: Dict[str, Tuple[float, float, str]] = {
+    "москва": (55.7558, 37.6173, "Europe/Moscow"),
+    "санкт-петербург": (59.9343, 30.3351, "Europe/Moscow"),
+    "петербург": (59.9343, 30.3351, "Europe/Moscow"),
+    "спб": (59.9343, 30.3351, "Europe/Moscow"),
+    "новосибирск": (55.0084, 82.9357, "Asia/Novosibirsk"),
+    "екатеринбург": (56.8389, 60.6057, "Asia/Yekaterinburg"),
+    "казань": (55.7961, 49.1064, "Europe/Moscow"),
+    "нижний новгород": (56.2965, 43.9361, "Europe/Moscow"),
+    "челябинск": (55.1644, 61.4368, "Asia/Yekaterinburg"),
+    "самара": (53.1959, 50.1002, "Europe/Samara"),
+    "омск": (54.9885, 73.3242, "Asia/Omsk"),
+    "ростов-на-дону": (47.2357, 39.7015, "Europe/Moscow"),
+    "уфа": (54.7388, 55.9721, "Asia/Yekaterinburg"),
+    "красноярск": (56.0153, 92.8932, "Asia/Krasnoyarsk"),
+    "воронеж": (51.6720, 39.1843, "Europe/Moscow"),
+    "пермь": (58.0105, 56.2502, "Asia/Yekaterinburg"),
+    "волгоград": (48.7080, 44.5133, "Europe/Volgograd"),
+    "краснодар": (45.0355, 38.9753, "Europe/Moscow"),
+    "саратов": (51.5336, 46.0343, "Europe/Saratov"),
+    "тюмень": (57.1530, 65.5343, "Asia/Yekaterinburg"),
+    "иркутск": (52.2870, 104.3050, "Asia/Irkutsk"),
+    "хабаровск": (48.4827, 135.0838, "Asia/Vladivostok"),
+    "владивосток": (43.1155, 131.8855, "Asia/Vladivostok"),
+    "калининград": (54.7104, 20.4522, "Europe/Kaliningrad"),
+    "сочи": (43.6028, 39.7342, "Europe/Moscow"),
+    "ярославль": (57.6261, 39.8845, "Europe/Moscow"),
+    "минск": (53.9045, 27.5615, "Europe/Minsk"),
+    "киев": (50.4501, 30.5234, "Europe/Kyiv"),
+    "алматы": (43.2220, 76.8512, "Asia/Almaty"),
+    "астана": (51.1605, 71.4704, "Asia/Almaty"),
+    "ташкент": (41.2995, 69.2401, "Asia/Tashkent"),
+    "тбилиси": (41.7151, 44.8271, "Asia/Tbilisi"),
+    "ереван": (40.1792, 44.4991, "Asia/Yerevan"),
+    "баку": (40.4093, 49.8671, "Asia/Baku"),
+    "рига": (56.9496, 24.1052, "Europe/Riga"),
+    "вильнюс": (54.6872, 25.2797, "Europe/Vilnius"),
+    "таллин": (59.4370, 24.7536, "Europe/Tallinn"),
+    "кишинев": (47.0105, 28.8638, "Europe/Chisinau"),
+    "бишкек": (42.8746, 74.5698, "Asia/Bishkek"),
+    "берлин": (52.5200, 13.4050, "Europe/Berlin"),
+    "лондон": (51.5074, -0.1278, "Europe/London"),
+    "париж": (48.8566, 2.3522, "Europe/Paris"),
+    "рим": (41.9028, 12.4964, "Europe/Rome"),
+    "прага": (50.0755, 14.4378, "Europe/Prague"),
+    "варшава": (52.2297, 21.0122, "Europe/Warsaw"),
+    "стамбул": (41.0082, 28.9784, "Europe/Istanbul"),
+    "тель-авив": (32.0853, 34.7818, "Asia/Jerusalem"),
+    "дубай": (25.2048, 55.2708, "Asia/Dubai"),
+    "нью-йорк": (40.7128, -74.0060, "America/New_York"),
+    "лос-анджелес": (34.0522, -118.2437, "America/Los_Angeles"),
+}
+
+_DATE_RE = re.compile(r"^(\d{1,2})[./-](\d{1,2})[./-](\d{4})$|^(\d{4})-(\d{1,2})-(\d{1,2})$")
+_TIME_RE = re.compile(r"^(\d{1,2})[:.](\d{2})$")
+_COORDS_RE = re.compile(r"^(-?\d+(?:\.\d+)?)[,\s]+(-?\d+(?:\.\d+)?)(?:\s+(?:UTC|GMT)?([+-]\d{1,2}(?::?\d{2})?))?$", re.I)
+
+_table = None
+
+
+class ChartError(ValueError):
+    """Некорректные данные рождения или нет эфемериды"""
+
+
+def numpy_available() -> bool:
+    """Расчет карты требует NumPy (pip install numpy)"""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# ============ ЭФЕМЕРИДА ============
+def _julian_day(moment: datetime) -> float:
+    """Юлианская дата для времени в UTC"""
+    moment = moment.astimezone(timezone.utc)
+    days = (moment.replace(tzinfo=None) - datetime(2000, 1, 1, 12)).total_seconds() / 86400
+    return 2451545.0 + days
+
+
+START_JD = _julian_day(datetime.combine(EPHEMERIS_START, dt_time(), timezone.utc))
+
+
+def compute_longitudes(jd):
+    """Геоцентрические эклиптические долготы (тропические, на дату) по
+    упрощенной аналитической теории: кеплеровы элементы орбит с вековыми
+    членами и главными возмущениями Луны, Юпитера, Сатурна и Урана.
+    Точность около 1-2′ для планет и нескольких минут для Луны.
+    Векторизовано: jd — массив, результат — (len(jd), len(BODIES)) в градусах."""
+    import numpy as np
+
+    d = np.asarray(jd, dtype=np.float64) - 2451543.5
+    rad = np.radians
+
+    def kepler(M, e):
+        E = M + e * np.sin(M) * (1 + e * np.cos(M))
+        for _ in range(6):
+            E = E - (E - e * np.sin(E) - M) / (1 - e * np.cos(E))
+        return E
+
+    def orbit(N, i, w, a, e, M):
+        N, i, w, M = rad(N), rad(i), rad(w), rad(M)
+        E = kepler(M, e)
+        xv = a * (np.cos(E) - e)
+        yv = a * np.sqrt(1 - e * e) * np.sin(E)
+        v = np.arctan2(yv, xv)
+        r = np.hypot(xv, yv)
+        xh = r * (np.cos(N) * np.cos(v + w) - np.sin(N) * np.sin(v + w) * np.cos(i))
+        yh = r * (np.sin(N) * np.cos(v + w) + np.cos(N) * np.sin(v + w) * np.cos(i))
+        zh = r * np.sin(v + w) * np.sin(i)
+        return xh, yh, zh
+
+    # Солнце
+    ws = 282.9404 + 4.70935e-5 * d
+    es = 0.016709 - 1.151e-9 * d
+    Ms = (356.0470 + 0.9856002585 * d) % 360
+    Es = kepler(rad(Ms), es)
+    xv, yv = np.cos(Es) - es, np.sqrt(1 - es * es) * np.sin(Es)
+    sun_lon = np.degrees(np.arctan2(yv, xv)) + ws
+    rs = np.hypot(xv, yv)
+    xs, ys = rs * np.cos(rad(sun_lon)), rs * np.sin(rad(sun_lon))
+
+    # Луна
+    Nm = 125.1228 - 0.0529538083 * d
+    wm = 318.0634 + 0.1643573223 * d
+    Mm = (115.3654 + 13.0649929509 * d) % 360
+    xh, yh, _ = orbit(Nm, 5.1454, wm, 60.2666, 0.054900, Mm)
+    moon_lon = np.degrees(np.arctan2(yh, xh))
+    Ls = Ms + ws
+    Lm = Mm + wm + Nm
+    D = Lm - Ls
+    F = Lm - Nm
+    moon_lon = moon_lon + (
+        -1.274 * np.sin(rad(Mm - 2 * D)) + 0.658 * np.sin(rad(2 * D)) - 0.186 * np.sin(rad(Ms))
+        - 0.059 * np.sin(rad(2 * Mm - 2 * D)) - 0.057 * np.sin(rad(Mm - 2 * D + Ms))
+        + 0.053 * np.sin(rad(Mm + 2 * D)) + 0.046 * np.sin(rad(2 * D - Ms)) + 0.041 * np.sin(rad(Mm - Ms))
+        - 0.035 * np.sin(rad(D)) - 0.031 * np.sin(rad(Mm + Ms)) - 0.015 * np.sin(rad(2 * F - 2 * D))
+        + 0.011 * np.sin(rad(Mm - 4 * D))
+    )
+
+    elements = {
+        "mercury": (48.3313 + 3.24587e-5 * d, 7.0047 + 5.00e-8 * d, 29.1241 + 1.01444e-5 * d, 0.387098,
+                    0.205635 + 5.59e-10 * d, 168.6562 + 4.0923344368 * d),
+        "venus": (76.6799 + 2.46590e-5 * d, 3.3946 + 2.75e-8 * d, 54.8910 + 1.38374e-5 * d, 0.723330,
+                  0.006773 - 1.302e-9 * d, 48.0052 + 1.6021302244 * d),
+        "mars": (49.5574 + 2.11081e-5 * d, 1.8497 - 1.78e-8 * d, 286.5016 + 2.92961e-5 * d, 1.523688,
+                 0.093405 + 2.516e-9 * d, 18.6021 + 0.5240207766 * d),
+        "jupiter": (100.4542 + 2.76854e-5 * d, 1.3030 - 1.557e-7 * d, 273.8777 + 1.64505e-5 * d, 5.20256,
+                    0.048498 + 4.469e-9 * d, 19.8950 + 0.0830853001 * d),
+        "saturn": (113.6634 + 2.38980e-5 * d, 2.4886 - 1.081e-7 * d, 339.3939 + 2.97661e-5 * d, 9.55475,
+                   0.055546 - 9.499e-9 * d, 316.9670 + 0.0334442282 * d),
+        "uranus": (74.0005 + 1.3978e-5 * d, 0.7733 + 1.9e-8 * d, 96.6612 + 3.0565e-5 * d, 19.18171 - 1.55e-8 * d,
+                   0.047318 + 7.45e-9 * d, 142.5905 + 0.011725806 * d),
+        "neptune": (131.7806 + 3.0173e-5 * d, 1.7700 - 2.55e-7 * d, 272.8461 - 6.027e-6 * d, 30.05826 + 3.313e-8 * d,
+                    0.008606 + 2.15e-9 * d, 260.2471 + 0.005995147 * d),
+    }
+    Mj, Msat, Mu = elements["jupiter"][5], elements["saturn"][5], elements["uranus"][5]
+    perturbations = {
+        "jupiter": (
+            -0.332 * np.sin(rad(2 * Mj - 5 * Msat - 67.6)) - 0.056 * np.sin(rad(2 * Mj - 2 * Msat + 21))
+            + 0.042 * np.sin(rad(3 * Mj - 5 * Msat + 21)) - 0.036 * np.sin(rad(Mj - 2 * Msat))
+            + 0.022 * np.cos(rad(Mj - Msat)) + 0.023 * np.sin(rad(2 * Mj - 3 * Msat + 52))
+            - 0.016 * np.sin(rad(Mj - 5 * Msat - 69))
+        ),
+        "saturn": (
+            0.812 * np.sin(rad(2 * Mj - 5 * Msat - 67.6)) - 0.229 * np.cos(rad(2 * Mj - 4 * Msat - 2))
+            + 0.119 * np.sin(rad(Mj - 2 * Msat - 3)) + 0.046 * np.sin(rad(2 * Mj - 6 * Msat - 69))
+            + 0.014 * np.sin(rad(Mj - 3 * Msat + 32))
+        ),
+        "uranus": (
+            0.040 * np.sin(rad(Msat - 2 * Mu + 6)) + 0.035 * np.sin(rad(Msat - 3 * Mu + 33))
+            - 0.015 * np.sin(rad(Mj - Mu + 20))
+        ),
+    }
+
+    columns = {"sun": sun_lon, "moon": moon_lon}
+    for body, (N, i, w, a, e, M) in elements.items():
+        xh, yh, zh = orbit(N, i, w, a, e, M % 360)
+        if body in perturbations:
+            lon = np.arctan2(yh, xh) + rad(perturbations[body])
+            r_xy = np.hypot(xh, yh)
+            xh, yh = r_xy * np.cos(lon), r_xy * np.sin(lon)
+        columns[body] = np.degrees(np.arctan2(yh + ys, xh + xs))
+
+    # Плутон: аппроксимация Шлайтера (элементы на J2000, прецессия до даты)
+    S, P = rad(50.03 + 0.033459652 * d), rad(238.95 + 0.003968789 * d)
+    lon = rad(
+        238.9508 + 0.00400703 * d - 19.799 * np.sin(P) + 19.848 * np.cos(P) + 0.897 * np.sin(2 * P)
+        - 4.956 * np.cos(2 * P) + 0.610 * np.sin(3 * P) + 1.211 * np.cos(3 * P) - 0.341 * np.sin(4 * P)
+        - 0.190 * np.cos(4 * P) + 0.128 * np.sin(5 * P) - 0.034 * np.cos(5 * P) - 0.038 * np.sin(6 * P)
+        + 0.031 * np.cos(6 * P) + 0.020 * np.sin(S - P) - 0.010 * np.cos(S - P) + 3.82394e-5 * d
+    )
+    lat = rad(
+        -3.9082 - 5.453 * np.sin(P) - 14.975 * np.cos(P) + 3.527 * np.sin(2 * P) + 1.673 * np.cos(2 * P)
+        - 1.051 * np.sin(3 * P) + 0.328 * np.cos(3 * P) + 0.179 * np.sin(4 * P) - 0.292 * np.cos(4 * P)
+        + 0.019 * np.sin(5 * P) + 0.100 * np.cos(5 * P) - 0.031 * np.sin(6 * P) - 0.026 * np.cos(6 * P)
+        + 0.011 * np.cos(S - P)
+    )
+    r = (40.72 + 6.68 * np.sin(P) + 6.90 * np.cos(P) - 1.18 * np.sin(2 * P) - 0.03 * np.cos(2 * P)
+         + 0.15 * np.sin(3 * P) - 0.14 * np.cos(3 * P))
+    columns["pluto"] = np.degrees(np.arctan2(r * np.cos(lat) * np.sin(lon) + ys, r * np.cos(lat) * np.cos(lon) + xs))
+
+    # Средний северный узел Луны
+    columns["node"] = Nm
+    return np.stack([columns[body] for body in BODIES], axis=-1) % 360
+
+
+def build_ephemeris(path: str = EPHEMERIS_PATH):
+    """Рассчитать таблицу на весь диапазон и сохранить в .npy"""
+    import numpy as np
+
+    days = (EPHEMERIS_END - EPHEMERIS_START).days + 1
+    longitudes = compute_longitudes(START_JD + np.arange(days, dtype=np.float64))
+    table = np.round(longitudes * LONGITUDE_SCALE).astype(np.uint32) % 65536
+    np.save(path, table.astype(np.uint16))
+    logger.info(f"✅ Эфемерида сохранена: {path} ({days} суток × {len(BODIES)} тел)")
+
+
+def _ephemeris():
+    global _table
+    if _table is None:
+        import numpy as np
+        if not os.path.exists(EPHEMERIS_PATH):
+            raise ChartError("Файл эфемериды не найден")
+        table = np.load(EPHEMERIS_PATH, mmap_mode="r")
+        if table.ndim != 2 or table.shape[1] != len(BODIES):
+            raise ChartError("Файл эфемериды поврежден")
+        _table = table
+    return _table
+
+
+def positions(jd):
+    """Долготы и суточные скорости тел для массива юлианских дат.
+
+    Для каждой даты из memory map берутся 4 соседние строки, разворачиваются
+    через 360° и интерполируются полиномом Лагранжа третьей степени.
+    Возвращает (долготы, скорости) формы (len(jd), len(BODIES)).
+    """
+    import numpy as np
+
+    table = _ephemeris()
+    x = (np.atleast_1d(np.asarray(jd, dtype=np.float64)) - START_JD)
+    base = np.floor(x).astype(np.int64) - 1
+    if base.min() < 0 or base.max() + 3 >= table.shape[0]:
+        raise ChartError(f"Дата вне диапазона {EPHEMERIS_START.year}–{EPHEMERIS_END.year}")
+    t = (x - base)[:, None]  # положение внутри окна из 4 узлов (узлы 0..3), t ∈ [1, 2)
+
+    rows = table[base[:, None] + np.arange(4)].astype(np.float64) / LONGITUDE_SCALE  # (n, 4, тела)
+    rows = np.unwrap(rows, period=360, axis=1)
+    p0, p1, p2, p3 = rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3]
+    weights = (
+        -(t - 1) * (t - 2) * (t - 3) / 6,
+        t * (t - 2) * (t - 3) / 2,
+        -t * (t - 1) * (t - 3) / 2,
+        t * (t - 1) * (t - 2) / 6,
+    )
+    longitudes = (weights[0] * p0 + weights[1] * p1 + weights[2] * p2 + weights[3] * p3) % 360
+    speeds = (
+        -(3 * t * t - 12 * t + 11) / 6 * p0 + (3 * t * t - 10 * t + 6) / 2 * p1
+        - (3 * t * t - 8 * t + 3) / 2 * p2 + (3 * t * t - 6 * t + 2) / 6 * p3
+    )
+    return longitudes, speeds
+
+
+def angles(jd: float, latitude: float, longitude: float) -> Tuple[float, float]:
+    """Асцендент и MC (градусы) для момента и места"""
+    d = jd - 2451545.0
+    gmst = (280.46061837 + 360.98564736629 * d) % 360
+    ramc = math.radians((gmst + longitude) % 360)
+    eps = math.radians(23.4393 - 3.563e-7 * (jd - 2451543.5))
+    phi = math.radians(latitude)
+    mc = math.degrees(math.atan2(math.sin(ramc), math.cos(ramc) * math.cos(eps))) % 360
+    asc = math.degrees(math.atan2(
+        math.cos(ramc), -(math.sin(ramc) * math.cos(eps) + math.tan(phi) * math.sin(eps))
+    )) % 360
+    return asc, mc
+
+
+def find_aspects(longitudes) -> List[Tuple[int, int, str, float]]:
+    """Мажорные аспекты между всеми парами тел: (i, j, аспект, орбис)"""
+    import numpy as np
+
+    lon = np.asarray(longitudes, dtype=np.float64)
+    separation = np.abs(lon[:, None] - lon[None, :]) % 360
+    separation = np.minimum(separation, 360 - separation)
+    targets = np.array([angle for _, angle, _ in ASPECTS], dtype=np.float64)
+    orbs = np.array([orb for _, _, orb in ASPECTS], dtype=np.float64)
+    deviation = np.abs(separation[..., None] - targets)  # (тела, тела, аспекты)
+    hits = np.argwhere(np.triu(np.ones(separation.shape, dtype=bool), 1)[..., None] & (deviation <= orbs))
+    result = [(int(i), int(j), ASPECTS[k][0], float(deviation[i, j, k])) for i, j, k in hits]
+    return sorted(result, key=lambda aspect: aspect[3])
+
+
+# ============ КАРТА ============
+class Placement(NamedTuple):
+    body: str
+    longitude: float
+    retrograde: bool
+    house: Optional[int]
+
+
+class NatalChart(NamedTuple):
+    moment: datetime
+    time_known: bool
+    place: str
+    placements: List[Placement]
+    ascendant: Optional[float]
+    midheaven: Optional[float]
+    aspects: List[Tuple[str, str, str, float]]
+
+    def to_prompt(self) -> str:
+        """Компактные факты карты для системного сообщения"""
+        birth = self.moment.strftime("%d.%m.%Y %H:%M" if self.time_known else "%d.%m.%Y")
+        if self.place:
+            birth += f", {self.place}"
+        if not self.time_known:
+            birth += " (время рождения неизвестно: положения на полдень, дома не рассчитаны)"
+        elif self.ascendant is None:
+            birth += " (место не указано, дома не рассчитаны)"
+        lines = [
+            f"Натальная карта пользователя: {birth}. "
+            f"Тропический зодиак, равные дома от асцендента. Используй эти положения, не вычисляй их сам."
+        ]
+        if self.ascendant is not None:
+            lines.append(f"ASC {format_longitude(self.ascendant)}, MC {format_longitude(self.midheaven)}")
+        for placement in self.placements:
+            text = f"{BODY_NAMES[placement.body]} {format_longitude(placement.longitude)}"
+            if placement.house:
+                text += f", {placement.house} дом"
+            if placement.retrograde:
+                text += ", ретроград"
+            lines.append(text)
+        if self.aspects:
+            lines.append("Аспекты: " + "; ".join(
+                f"{BODY_NAMES[first]} {aspect} {BODY_NAMES[second]} (орб {orb:.1f}°)"
+                for first, second, aspect, orb in self.aspects
+            ))
+        return "\n".join(lines)
+
+
+def sign_of(longitude: float) -> str:
+    return SIGNS[int(longitude // 30) % 12]
+
+
+def format_longitude(longitude: float) -> str:
+    degrees_in_sign = longitude % 30
+    whole = int(degrees_in_sign)
+    minutes = int(round((degrees_in_sign - whole) * 60))
+    if minutes == 60:
+        whole, minutes = whole + 1, 0
+    return f"{whole}°{minutes:02d}′ {sign_of(longitude)}"
+
+
+def calculate_chart(moment: datetime, latitude: Optional[float] = None, longitude: Optional[float] = None,
+                    place: str = "", time_known: bool = True) -> NatalChart:
+    """Карта на момент (aware datetime); без координат или времени — без домов и углов"""
+    jd = _julian_day(moment)
+    longitudes, speeds = positions([jd])
+    longitudes, speeds = longitudes[0], speeds[0]
+
+    ascendant = midheaven = None
+    if time_known and latitude is not None and longitude is not None:
+        ascendant, midheaven = angles(jd, latitude, longitude)
+
+    placements = []
+    for index, body in enumerate(BODIES):
+        lon = float(longitudes[index])
+        house = int(((lon - ascendant) % 360) // 30) + 1 if ascendant is not None else None
+        # Узел всегда движется назад — это не ретроградность
+        retrograde = body not in ("sun", "moon", "node") and float(speeds[index]) < 0
+        placements.append(Placement(body, lon, retrograde, house))
+
+    # Узел не участвует в аспектах
+    planet_count = len(BODIES) - 1
+    aspects = [
+        (BODIES[i], BODIES[j], aspect, orb) for i, j, aspect, orb in find_aspects(longitudes[:planet_count])
+    ]
+    return NatalChart(moment, time_known, place, placements, ascendant, midheaven, aspects)
+
+
+# ============ РАЗБОР ВВОДА ============
+def _parse_offset(value: str) -> tzinfo:
+    sign = -1 if value.startswith("-") else 1
+    digits = value.lstrip("+-").replace(":", "")
+    hours, minutes = (int(digits[:-2]), int(digits[-2:])) if len(digits) > 2 else (int(digits), 0)
+    return timezone(sign * timedelta(hours=hours, minutes=minutes))
+
+
+def resolve_place(text: str) -> Tuple[float, float, tzinfo, str]:
+    """Город из справочника или «широта, долгота [UTC+3]»"""
+    text = text.strip()
+    city = CITIES.get(text.lower().replace("ё", "е"))
+    if city is not None:
+        latitude, longitude, zone = city
+        try:
+            return latitude, longitude, ZoneInfo(zone), text.title()
+        except ZoneInfoNotFoundError:
+            raise ChartError("Нет базы часовых поясов (установите пакет tzdata)")
+
+    match = _COORDS_RE.match(text)
+    if not match:
+        raise ChartError(f"Не знаю город «{text}». Укажите координаты: 55.75, 37.62 UTC+3")
+    latitude, longitude = float(match.group(1)), float(match.group(2))
+    if not (-66 <= latitude <= 66 and -180 <= longitude <= 180):
+        raise ChartError("Координаты вне допустимого диапазона (широта до ±66°)")
+    if match.group(3):
+        zone = _parse_offset(match.group(3))
+    else:
+        # Без пояса — солнечное время по долготе, с точностью до часа
+        zone = timezone(timedelta(hours=round(longitude / 15)))
+    return latitude, longitude, zone, f"{latitude:.2f}, {longitude:.2f}"
+
+
+def parse_birth_data(text: str) -> Tuple[datetime, bool, Optional[float], Optional[float], str]:
+    """«15.03.1990 14:30 Москва» → (момент с поясом, время известно, широта, долгота, место)"""
+    parts = text.split()
+    if not parts:
+        raise ChartError("Укажите дату рождения")
+    match = _DATE_RE.match(parts[0])
+    if not match:
+        raise ChartError("Дата в формате ДД.ММ.ГГГГ")
+    if match.group(1):
+        day, month, year = int(match.group(1)), int(match.group(2)), int(match.group(3))
+    else:
+        year, month, day = int(match.group(4)), int(match.group(5)), int(match.group(6))
+    try:
+        birth_date = date(year, month, day)
+    except ValueError:
+        raise ChartError("Такой даты не существует")
+
+    rest = parts[1:]
+    birth_time = None
+    if rest and _TIME_RE.match(rest[0]):
+        hours, minutes = map(int, _TIME_RE.match(rest[0]).groups())
+        if hours > 23 or minutes > 59:
+            raise ChartError("Время в формате ЧЧ:ММ")
+        birth_time = dt_time(hours, minutes)
+        rest = rest[1:]
+
+    place_text = " ".join(rest)
+    if place_text:
+        latitude, longitude, zone, place = resolve_place(place_text)
+    else:
+        latitude = longitude = None
+        zone, place = timezone.utc, ""
+
+    # Без времени — полдень, Луна с погрешностью до ±6°, дома не строим
+    moment = datetime.combine(birth_date, birth_time or dt_time(12, 0), zone)
+    return moment, birth_time is not None, latitude, longitude, place
+
+
+def chart_from_text(text: str) -> NatalChart:
+    if not numpy_available():
+        raise ChartError("Расчет карты недоступен: не установлен NumPy")
+    moment, time_known, latitude, longitude, place = parse_birth_data(text)
+    return calculate_chart(moment, latitude, longitude, place, time_known)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["build"]:
+        logging.basicConfig(level=logging.INFO)
+        build_ephemeris()
+    else:
+        print(chart_from_text(" ".join(sys.argv[1:])).to_prompt())
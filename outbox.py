@@ -0,0 +1,195 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, List, Optional, TypeVar
+
+from telegram import Message
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+from metrics import TELEGRAM_RETRY_AFTER
+from scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду на чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+# Сколько раз повторять вызов после RetryAfter
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+# Сколько чатов держать в памяти (состояние лимитов)
+TELEGRAM_MAX_CHATS = 10000
+
+_CODE_FENCE = "```"
+_MARKDOWN_MODES = (ParseMode.MARKDOWN, ParseMode.MARKDOWN_V2)
+
+
+def _find_cut(text: str, limit: int) -> int:
+    """Позиция разреза не дальше limit: абзац, строка, предложение, слово"""
+    window = text[:limit]
+    for separator in ("\n\n", "\n", ". ", " "):
+        index = window.rfind(separator)
+        # Не режем слишком близко к началу — иначе получатся огрызки
+        if index > limit // 2:
+            return index + len(separator)
+    return limit
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT, markdown: bool = False) -> List[str]:
+    """Разбить текст на сообщения по границам абзацев.
+
+    Для Markdown блок кода, попавший на разрез, закрывается в конце части
+    и открывается заново в начале следующей.
+    """
+    chunks: List[str] = []
+    reserve = len(_CODE_FENCE) + 1 if markdown else 0
+    while len(text) > limit:
+        cut = _find_cut(text, limit - reserve)
+        chunk, text = text[:cut].rstrip(), text[cut:].lstrip("\n")
+        if markdown and chunk.count(_CODE_FENCE) % 2:
+            chunk += "\n" + _CODE_FENCE
+            text = _CODE_FENCE + "\n" + text
+        if chunk:
+            chunks.append(chunk)
+    if text.strip() or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class _ChatState:
+    __slots__ = ("bucket", "lock", "users")
+
+    def __init__(self):
+        self.bucket = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_CHAT_RATE)
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class TelegramSender:
+    """Все исходящие вызовы Telegram: лимиты на чат и на бота, RetryAfter, порядок.
+
+    Вызовы в один чат выполняются строго по очереди (части длинного ответа
+    не перемешиваются с другими сообщениями), перед каждым берется токен из
+    корзины чата и общей корзины бота. RetryAfter приостанавливает корзину
+    чата и повторяет вызов; промежуточные правки при нехватке токенов
+    пропускаются, а не ждут.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST, TELEGRAM_GLOBAL_RATE)
+        self._chats: "OrderedDict[Hashable, _ChatState]" = OrderedDict()
+
+    def _chat(self, chat_id: Hashable) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState()
+            # Вытесняем давно неактивные чаты, у которых нет вызовов в очереди
+            excess = len(self._chats) - TELEGRAM_MAX_CHATS
+            for key in [key for key, entry in self._chats.items() if entry.users == 0][:max(0, excess)]:
+                del self._chats[key]
+        else:
+            self._chats.move_to_end(chat_id)
+        return state
+
+    @staticmethod
+    async def _take(bucket: TokenBucket):
+        while True:
+            wait = bucket.time_until_token()
+            if wait <= 0:
+                bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    async def _send(self, state: _ChatState, request: Callable[[], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            await self._take(state.bucket)
+            await self._take(self.global_bucket)
+            try:
+                return await request()
+            except RetryAfter as e:
+                TELEGRAM_RETRY_AFTER.inc()
+                retry_after = float(e.retry_after)
+                state.bucket.pause(retry_after)
+                if attempt >= TELEGRAM_SEND_RETRIES:
+                    raise
+                attempt += 1
+                logger.warning(f"⏳ Telegram RetryAfter {retry_after:.0f} с, повтор {attempt}/{TELEGRAM_SEND_RETRIES}")
+
+    async def call(self, chat_id: Hashable, request: Callable[[], Awaitable[T]]) -> T:
+        """Выполнить вызов в очереди чата с учетом лимитов"""
+        state = self._chat(chat_id)
+        state.users += 1
+        try:
+            async with state.lock:
+                return await self._send(state, request)
+        finally:
+            state.users -= 1
+
+    async def try_call(self, chat_id: Hashable, request: Callable[[], Awaitable[T]]) -> Optional[T]:
+        """Вызов только если чат свободен и токен есть сразу; иначе None"""
+        state = self._chat(chat_id)
+        if state.lock.locked() or state.bucket.time_until_token() > 0 or self.global_bucket.time_until_token() > 0:
+            return None
+        state.bucket.take()
+        self.global_bucket.take()
+        try:
+            return await request()
+        except RetryAfter as e:
+            TELEGRAM_RETRY_AFTER.inc()
+            state.bucket.pause(float(e.retry_after))
+            logger.warning(f"⏳ Telegram RetryAfter {e.retry_after} с, промежуточная правка пропущена")
+            return None
+
+    async def _send_chunks(self, chat_id: Hashable, text: str, parse_mode: Optional[str], reply_markup: Any,
+                           send: Callable[..., Awaitable[Message]]) -> List[Message]:
+        chunks = split_message(text, markdown=parse_mode in _MARKDOWN_MODES)
+        state = self._chat(chat_id)
+        state.users += 1
+        messages = []
+        try:
+            async with state.lock:
+                for index, chunk in enumerate(chunks):
+                    markup = reply_markup if index == len(chunks) - 1 else None
+                    messages.append(await self._send_markup_safe(state, send, chunk, parse_mode, markup))
+        finally:
+            state.users -= 1
+        return messages
+
+    async def _send_markup_safe(self, state: _ChatState, send: Callable[..., Awaitable[Message]], text: str,
+                                parse_mode: Optional[str], reply_markup: Any) -> Message:
+        try:
+            return await self._send(state, lambda: send(text, parse_mode=parse_mode, reply_markup=reply_markup))
+        except BadRequest as e:
+            if parse_mode is None or "can't parse entities" not in str(e).lower():
+                raise
+            # Разметка не разобралась — отправляем как обычный текст
+            logger.warning(f"⚠️ Telegram не разобрал разметку, отправляю без нее: {e}")
+            return await self._send(state, lambda: send(text, parse_mode=None, reply_markup=reply_markup))
+
+    async def reply(self, message: Message, text: str, parse_mode: Optional[str] = None,
+                    reply_markup: Any = None) -> List[Message]:
+        """Ответить в чат сообщения, разбив длинный текст на части"""
+        return await self._send_chunks(message.chat_id, text, parse_mode, reply_markup, message.reply_text)
+
+    async def send(self, bot: Any, chat_id: Hashable, text: str, parse_mode: Optional[str] = None,
+                   reply_markup: Any = None) -> List[Message]:
+        """Отправить текст в произвольный чат (например, администратору)"""
+        async def send_message(chunk: str, **kwargs) -> Message:
+            return await bot.send_message(chat_id=chat_id, text=chunk, **kwargs)
+
+        return await self._send_chunks(chat_id, text, parse_mode, reply_markup, send_message)
+
+    async def edit(self, message: Message, text: str, parse_mode: Optional[str] = None,
+                   interim: bool = False, reply_markup: Any = None) -> Optional[Message]:
+        """Правка сообщения; interim — промежуточная, ее можно пропустить"""
+        request = lambda: message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        if interim:
+            return await self.try_call(message.chat_id, request)
+        return await self.call(message.chat_id, request)
@@ -0,0 +1,63 @@
+import os
+from typing import List, Optional
+
+from sessions import UserSession
+from summarizer import memory_message
+from tokens import PROMPT_TOKEN_BUDGET, history_tokens, make_message, trim_to_budget
+
+# Какую долю бюджета освобождать за одну обрезку истории
+PROMPT_TRIM_STEP = float(os.getenv("PROMPT_TRIM_STEP", "0.4"))
+
+
+def chart_message(chart: str) -> dict:
+    """Системное сообщение с фактами натальной карты (natal.NatalChart.to_prompt)"""
+    return make_message("system", chart)
+
+
+class PromptBuilder:
+    """Сборка промпта со стабильным префиксом для контекстного кэша DeepSeek.
+
+    Порядок всегда один: системный промпт, натальная карта, память, история,
+    новый вопрос.
+    История только дописывается; когда она перестает влезать в бюджет,
+    старые реплики отбрасываются крупным шагом (до (budget - префикс) * (1 - trim_step)),
+    а не по одной на каждом ходу, — поэтому между обрезками начало промпта
+    побайтно совпадает с предыдущим запросом и попадает в кэш.
+    """
+
+    def __init__(self, system_message: dict, budget: int = PROMPT_TOKEN_BUDGET, trim_step: float = PROMPT_TRIM_STEP):
+        self.system_message = system_message
+        self.budget = budget
+        self.trim_step = trim_step
+
+    def prefix(self, session: UserSession) -> List[dict]:
+        """Неизменная часть: системный промпт и, если есть, карта и сжатая память"""
+        prefix = [self.system_message]
+        if session.chart:
+            prefix.append(chart_message(session.chart))
+        if session.summary:
+            prefix.append(memory_message(session.summary))
+        return prefix
+
+    def trim(self, messages: List[dict], budget: Optional[int] = None) -> List[dict]:
+        """Если сообщения не влезают в бюджет — обрезать с запасом на следующие ходы"""
+        budget = budget or self.budget
+        if history_tokens(messages) <= budget:
+            return messages
+        return trim_to_budget(messages, int(budget * (1 - self.trim_step)))
+
+    def trim_history(self, history: List[dict], prefix: List[dict]) -> List[dict]:
+        """Обрезать историю под бюджет, оставшийся после префикса, крупным шагом"""
+        budget = self.budget - history_tokens(prefix)
+        if history_tokens(history) <= budget:
+            return history
+        return trim_to_budget(history, int(budget * (1 - self.trim_step)))
+
+    def build(self, session: UserSession, user_turn: dict) -> List[dict]:
+        """Промпт для вопроса user_turn"""
+        prefix = self.prefix(session)
+        return prefix + self.trim_history(session.history + [user_turn], prefix)
+
+    def append(self, session: UserSession, *turns: dict):
+        """Дописать реплики в историю сессии, обрезая ее по тому же правилу, что и build()"""
+        session.history = self.trim_history(session.history + list(turns), self.prefix(session))
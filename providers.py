@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from typing import List, Mapping, Optional
+from urllib.parse import urlparse
+
+from metrics import DEEPSEEK_PROVIDER_EJECTIONS, DEEPSEEK_PROVIDER_OUTSTANDING
+from scheduler import DEEPSEEK_BURST, DEEPSEEK_MIN_RATE, DEEPSEEK_RATE, TokenBucket, _parse_int, parse_reset_seconds
+
+logger = logging.getLogger(__name__)
+
+# Несколько ключей к одному DEEPSEEK_API_URL, через запятую
+DEEPSEEK_API_KEYS = os.getenv("DEEPSEEK_API_KEYS", "")
+# Полная конфигурация пула, JSON-список:
+# [{"url": "...", "key": "...", "model": "...", "rate": 5, "burst": 10, "fallback": false, "name": "..."}]
+# fallback — OpenAI-совместимый резерв, используется, только когда все основные исключены
+DEEPSEEK_PROVIDERS = os.getenv("DEEPSEEK_PROVIDERS", "")
+# На сколько исключать ключ из ротации
+PROVIDER_AUTH_EJECT = float(os.getenv("PROVIDER_AUTH_EJECT", "600"))  # 401/403
+PROVIDER_RATE_EJECT = float(os.getenv("PROVIDER_RATE_EJECT", "15"))   # 429 без retry-after
+PROVIDER_ERROR_EJECT = float(os.getenv("PROVIDER_ERROR_EJECT", "30"))  # серия 5xx и сетевых сбоев
+PROVIDER_MAX_FAILURES = int(os.getenv("PROVIDER_MAX_FAILURES", "3"))
+
+
+class Provider:
+    """Один ключ на одном эндпоинте: свой лимит, счетчик запросов в работе и исключение из ротации"""
+
+    def __init__(self, name: str, url: str, api_key: Optional[str], model: Optional[str] = None,
+                 rate: float = DEEPSEEK_RATE, burst: float = DEEPSEEK_BURST, fallback: bool = False):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.fallback = fallback
+        self.bucket = TokenBucket(rate, burst, DEEPSEEK_MIN_RATE)
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        DEEPSEEK_PROVIDER_OUTSTANDING.set_function(lambda: self.outstanding, provider=name)
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def payload(self, payload: dict) -> dict:
+        """Резервному бэкенду может понадобиться своя модель"""
+        return {**payload, "model": self.model} if self.model else payload
+
+
+def _default_name(url: str, index: int) -> str:
+    return f"{urlparse(url).hostname or 'provider'}#{index}"
+
+
+def load_providers(api_key: Optional[str], api_url: str) -> List[Provider]:
+    """Провайдеры из окружения; без DEEPSEEK_PROVIDERS/DEEPSEEK_API_KEYS — один ключ, как раньше"""
+    if DEEPSEEK_PROVIDERS:
+        providers = []
+        for index, item in enumerate(json.loads(DEEPSEEK_PROVIDERS)):
+            url = item.get("url", api_url)
+            providers.append(Provider(
+                item.get("name") or _default_name(url, index), url, item.get("key", api_key),
+                model=item.get("model"), rate=float(item.get("rate", DEEPSEEK_RATE)),
+                burst=float(item.get("burst", DEEPSEEK_BURST)), fallback=bool(item.get("fallback"))
+            ))
+        return providers
+    keys = [key.strip() for key in DEEPSEEK_API_KEYS.split(",") if key.strip()] or [api_key]
+    return [Provider(_default_name(api_url, index), api_url, key) for index, key in enumerate(keys)]
+
+
+def provider_secrets() -> List[str]:
+    """Ключи из конфигурации пула — для маскировки в логах"""
+    secrets = [key.strip() for key in DEEPSEEK_API_KEYS.split(",") if key.strip()]
+    if DEEPSEEK_PROVIDERS:
+        try:
+            secrets += [item["key"] for item in json.loads(DEEPSEEK_PROVIDERS) if item.get("key")]
+        except (ValueError, TypeError):
+            pass
+    return secrets
+
+
+class ProviderPool:
+    """Маршрутизация запросов по ключам и эндпоинтам.
+
+    Запрос уходит провайдеру с наименьшим числом запросов в работе среди
+    тех, у кого есть токен в собственном лимите. Ключ, вернувший 401/403
+    или 429, и эндпоинт с серией сбоев временно исключаются из ротации;
+    резервные бэкенды берутся, только когда все основные исключены. Если
+    исключены все, запрос все равно уходит — исключение лишь понижает
+    предпочтение, а реальную скорость держат лимиты ключей.
+    """
+
+    def __init__(self, providers: List[Provider]):
+        if not providers:
+            raise ValueError("Пул провайдеров DeepSeek пуст")
+        self.providers = providers
+
+    @property
+    def single(self) -> bool:
+        return len(self.providers) == 1
+
+    @property
+    def total_rate(self) -> float:
+        """Суммарная скорость основных ключей — лимит общей очереди"""
+        return sum(provider.bucket.base_rate for provider in self.providers if not provider.fallback)
+
+    @property
+    def total_burst(self) -> float:
+        return sum(provider.bucket.capacity for provider in self.providers if not provider.fallback)
+
+    def _candidates(self, now: float) -> List[Provider]:
+        primary = [p for p in self.providers if not p.fallback and p.healthy(now)]
+        if primary:
+            return primary
+        fallback = [p for p in self.providers if p.fallback and p.healthy(now)]
+        return fallback or self.providers
+
+    async def acquire(self) -> Provider:
+        """Выбрать провайдера (least outstanding) и занять токен его лимита"""
+        while True:
+            candidates = self._candidates(time.monotonic())
+            delays = [(provider.bucket.time_until_token(), provider) for provider in candidates]
+            ready = [provider for delay, provider in delays if delay <= 0]
+            if ready:
+                fewest = min(provider.outstanding for provider in ready)
+                provider = random.choice([p for p in ready if p.outstanding == fewest])
+                provider.bucket.take()
+                provider.outstanding += 1
+                return provider
+            # Пока ждем, ключ может вернуться в ротацию — проверяем не реже раза в секунду
+            await asyncio.sleep(min(1.0, min(delay for delay, _ in delays)))
+
+    def release(self, provider: Provider):
+        provider.outstanding -= 1
+
+    def eject(self, provider: Provider, seconds: float, reason: str):
+        provider.ejected_until = max(provider.ejected_until, time.monotonic() + seconds)
+        DEEPSEEK_PROVIDER_EJECTIONS.inc(provider=provider.name, reason=reason)
+        logger.warning(f"🚫 Провайдер {provider.name} исключен из ротации на {seconds:.0f} с ({reason})")
+
+    def observe(self, provider: Provider, status_code: int, headers: Mapping[str, str]):
+        """Учесть ответ провайдера: лимиты ключа, исключение при 401/429 и сериях сбоев"""
+        if status_code in (401, 403):
+            self.eject(provider, PROVIDER_AUTH_EJECT, "auth")
+            return
+        reset = parse_reset_seconds(headers.get("x-ratelimit-reset"))
+        if status_code == 429:
+            retry_after = parse_reset_seconds(headers.get("retry-after")) or reset or PROVIDER_RATE_EJECT
+            provider.bucket.pause(retry_after)
+            provider.bucket.backoff()
+            self.eject(provider, retry_after, "rate_limit")
+            return
+        if status_code >= 500:
+            self.fail(provider)
+            return
+        provider.failures = 0
+        remaining = _parse_int(headers.get("x-ratelimit-remaining"))
+        if remaining is None:
+            provider.bucket.recover()
+        else:
+            provider.bucket.adapt(remaining, reset)
+
+    def fail(self, provider: Provider):
+        """Сетевой сбой или 5xx"""
+        provider.failures += 1
+        if provider.failures >= PROVIDER_MAX_FAILURES and not self.single:
+            provider.failures = 0
+            self.eject(provider, PROVIDER_ERROR_EJECT, "errors")
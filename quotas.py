@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Optional, Tuple
+
+from metrics import USER_QUOTA_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+# Скользящая квота токенов DeepSeek на пользователя (0 — без ограничения);
+# считаются ответ и промах контекстного кэша, закэшированный системный промпт бесплатен
+USER_TOKEN_QUOTA = int(os.getenv("USER_TOKEN_QUOTA", "60000"))
+USER_QUOTA_WINDOW = float(os.getenv("USER_QUOTA_WINDOW", "3600"))
+# Сколько пользователей держать в учете (самые давние вытесняются)
+USAGE_MAX_USERS = int(os.getenv("USAGE_MAX_USERS", "100000"))
+
+
+class _UserUsage:
+    __slots__ = ("events", "window_tokens", "prompt_tokens", "completion_tokens", "requests")
+
+    def __init__(self):
+        # (время, токены) за окно квоты
+        self.events: Deque[Tuple[float, int]] = deque()
+        self.window_tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.requests = 0
+
+
+class UsageLedger:
+    """Учет токенов DeepSeek по пользователям (из поля usage) и скользящая квота.
+
+    Квота — completion плюс prompt-токены мимо контекстного кэша DeepSeek
+    (prompt_cache_miss_tokens) за последние window секунд: общий системный
+    префикс, попавший в кэш, квоту не расходует.
+    Учет живет в памяти процесса: после перезапуска окно начинается заново.
+    """
+
+    def __init__(self, quota: int = USER_TOKEN_QUOTA, window: float = USER_QUOTA_WINDOW,
+                 max_users: int = USAGE_MAX_USERS):
+        self.quota = quota
+        self.window = window
+        self.max_users = max_users
+        self._users: "OrderedDict[int, _UserUsage]" = OrderedDict()
+
+    def _expire(self, usage: _UserUsage, now: float):
+        while usage.events and usage.events[0][0] <= now - self.window:
+            usage.window_tokens -= usage.events.popleft()[1]
+
+    def record(self, user_id: int, usage: Optional[dict]) -> int:
+        """Учесть usage ответа; возвращает число токенов, списанных с квоты"""
+        if not usage:
+            return 0
+        prompt = int(usage.get("prompt_tokens") or 0)
+        completion = int(usage.get("completion_tokens") or 0)
+        if usage.get("prompt_cache_miss_tokens") is not None:
+            charged_prompt = int(usage["prompt_cache_miss_tokens"])
+        else:
+            charged_prompt = max(0, prompt - int(usage.get("prompt_cache_hit_tokens") or 0))
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = _UserUsage()
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        now = time.monotonic()
+        self._expire(entry, now)
+        entry.events.append((now, charged_prompt + completion))
+        entry.window_tokens += charged_prompt + completion
+        entry.prompt_tokens += prompt
+        entry.completion_tokens += completion
+        entry.requests += 1
+        return charged_prompt + completion
+
+    def used(self, user_id: int) -> int:
+        """Токены пользователя за текущее окно"""
+        entry = self._users.get(user_id)
+        if entry is None:
+            return 0
+        self._expire(entry, time.monotonic())
+        return entry.window_tokens
+
+    def retry_after(self, user_id: int) -> Optional[float]:
+        """Через сколько секунд квота освободится или None, если лимит не исчерпан"""
+        if self.quota <= 0 or self.used(user_id) < self.quota:
+            return None
+        entry = self._users[user_id]
+        # Ждем, пока из окна выйдет достаточно старых запросов
+        excess = entry.window_tokens - self.quota
+        released = 0
+        delay = self.window
+        for timestamp, tokens in entry.events:
+            released += tokens
+            if released > excess:
+                delay = max(1.0, timestamp + self.window - time.monotonic())
+                break
+        USER_QUOTA_THROTTLED.inc()
+        return delay
@@ -0,0 +1,142 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, TypeVar
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Повторы с экспоненциальной задержкой и джиттером
+RETRY_ATTEMPTS = int(os.getenv("DEEPSEEK_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("DEEPSEEK_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("DEEPSEEK_RETRY_MAX_DELAY", "8"))
+# Статусы и исключения, после которых запрос безопасно повторить
+RETRYABLE_STATUSES = frozenset({500, 502, 503, 504})
+RETRYABLE_EXCEPTIONS = (httpx.TimeoutException, httpx.ConnectError, httpx.RemoteProtocolError)
+
+# Хеджирование: второй запрос, если первый дольше перцентиля задержек
+HEDGING_ENABLED = os.getenv("DEEPSEEK_HEDGING", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("DEEPSEEK_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.getenv("DEEPSEEK_HEDGE_MIN_DELAY", "5"))
+HEDGE_MIN_SAMPLES = int(os.getenv("DEEPSEEK_HEDGE_MIN_SAMPLES", "20"))
+
+# Автоматический выключатель
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("DEEPSEEK_BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("DEEPSEEK_BREAKER_RESET", "30"))
+
+
+class CircuitOpenError(Exception):
+    """DeepSeek считается недоступным — запрос не отправляется"""
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Full jitter: случайная задержка от 0 до base * 2^attempt (не больше cap)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """Closed → open после серии сбоев → half-open (одна пробная попытка)"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = self.CLOSED
+        self._probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def check(self):
+        """Пропустить запрос или сразу отказать"""
+        state = self.state
+        if state == self.OPEN:
+            raise CircuitOpenError("DeepSeek недоступен, выключатель разомкнут")
+        if state == self.HALF_OPEN:
+            # Зависший или отмененный пробный запрос не блокирует выключатель навсегда
+            now = time.monotonic()
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                raise CircuitOpenError("DeepSeek проверяется пробным запросом")
+            self._probe_started = now
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logger.info("✅ DeepSeek снова отвечает, выключатель замкнут")
+        self._state = self.CLOSED
+        self.failures = 0
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_started = None
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.error(f"🔴 DeepSeek недоступен ({self.failures} сбоев подряд), "
+                             f"выключатель разомкнут на {self.reset_timeout:.0f} с")
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Скользящее окно задержек успешных запросов"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+    def hedge_delay(self) -> Optional[float]:
+        value = self.percentile(HEDGE_PERCENTILE)
+        return max(HEDGE_MIN_DELAY, value) if value is not None else None
+
+
+async def hedged(call: Callable[[bool], Awaitable[T]], delay: Optional[float]) -> T:
+    """Запустить call(False); если он не успел за delay секунд — запустить
+    страхующий call(True) и взять первый успешный ответ"""
+    tasks = {asyncio.ensure_future(call(False))}
+    try:
+        if delay is None:
+            return await next(iter(tasks))
+
+        done, pending = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            logger.info(f"🪁 Запрос дольше {delay:.1f} с, отправляю страхующий")
+            tasks.add(asyncio.ensure_future(call(True)))
+            pending = set(tasks)
+
+        error: Optional[BaseException] = None
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,259 @@
+import os
+import re
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from typing import Awaitable, Callable, Dict, Hashable, List, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+# Глобальный лимит исходящих запросов к DeepSeek
+DEEPSEEK_RATE = float(os.getenv("DEEPSEEK_RATE", "5"))  # запросов в секунду
+DEEPSEEK_BURST = float(os.getenv("DEEPSEEK_BURST", "10"))
+DEEPSEEK_MIN_RATE = float(os.getenv("DEEPSEEK_MIN_RATE", "0.2"))
+DEEPSEEK_QUEUE_SIZE = int(os.getenv("DEEPSEEK_QUEUE_SIZE", "200"))
+# Через сколько секунд ожидания сообщать пользователю позицию в очереди
+QUEUE_FEEDBACK_DELAY = float(os.getenv("QUEUE_FEEDBACK_DELAY", "1.5"))
+QUEUE_FEEDBACK_INTERVAL = float(os.getenv("QUEUE_FEEDBACK_INTERVAL", "5"))
+# Сколько раз ставить запрос обратно в очередь после 429
+RATE_LIMIT_REQUEUES = int(os.getenv("RATE_LIMIT_REQUEUES", "2"))
+
+# Приоритеты: меньше — раньше
+PRIORITY_HIGH = 0     # повтор после 429, продолжение уже начатого ответа
+PRIORITY_NORMAL = 1   # вопрос пользователя
+PRIORITY_LOW = 2      # фоновые задачи
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class SchedulerQueueFull(Exception):
+    """Очередь к DeepSeek переполнена"""
+
+
+def parse_reset_seconds(value: Optional[str]) -> Optional[float]:
+    """x-ratelimit-reset / retry-after: секунды, unix-время или «1m30s»"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        number = float(value)
+    except ValueError:
+        parts = _DURATION_RE.findall(value)
+        if not parts:
+            return None
+        return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+    # Большие числа — это момент сброса, а не интервал
+    if number > 1e9:
+        return max(0.0, number - time.time())
+    return max(0.0, number)
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """Token bucket, скорость которого подстраивается под ответы API"""
+
+    def __init__(self, rate: float = DEEPSEEK_RATE, capacity: float = DEEPSEEK_BURST,
+                 min_rate: float = DEEPSEEK_MIN_RATE):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.tokens = capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            start = max(self._updated, self.paused_until)
+            if now > start:
+                self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+            self._updated = now
+
+    def time_until_token(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (после 429)"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def backoff(self):
+        """Мультипликативное снижение скорости после 429"""
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        """Постепенный возврат к базовой скорости, если заголовков лимитов нет"""
+        self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+    def adapt(self, remaining: Optional[int], reset_seconds: Optional[float]):
+        """Подогнать скорость под остаток лимита до его сброса"""
+        if remaining is None:
+            return
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, float(remaining))
+        if remaining <= 0 and reset_seconds:
+            self.pause(reset_seconds)
+        elif reset_seconds:
+            self.rate = max(self.min_rate, min(self.base_rate, remaining / reset_seconds))
+        else:
+            self.rate = self.base_rate
+
+
+class DeepSeekScheduler:
+    """Единая очередь исходящих запросов к DeepSeek с приоритетами.
+
+    Запросы ждут токен в общей очереди, а не падают с 429: скорость выдачи
+    токенов следует за заголовками x-ratelimit-*. Внутри одного приоритета
+    очередь взвешенно-справедливая (start-time fair queuing): каждому
+    пользователю (flow) назначается виртуальное время окончания с учетом
+    стоимости запроса в токенах и уже израсходованного (charge), поэтому
+    при конкуренции легкие пользователи обслуживаются раньше тяжелых.
+    """
+
+    def __init__(self, bucket: Optional[TokenBucket] = None, max_queue: int = DEEPSEEK_QUEUE_SIZE):
+        self.bucket = bucket or TokenBucket()
+        self.max_queue = max_queue
+        self._heap: List[list] = []
+        self._counter = itertools.count()
+        # Виртуальное время WFQ и теги окончания пользователей
+        self.virtual_time = 0.0
+        self._finish: Dict[Hashable, float] = {}
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for entry in self._heap if not entry[3].done())
+
+    async def start(self):
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def close(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
+        for entry in self._heap:
+            if not entry[3].done():
+                entry[3].cancel()
+        self._heap.clear()
+
+    def position(self, entry: list) -> int:
+        """Позиция в очереди, начиная с 1"""
+        return 1 + sum(1 for other in self._heap if other[:3] < entry[:3] and not other[3].done())
+
+    def _tag(self, flow: Optional[Hashable], cost: float, weight: float) -> float:
+        """Виртуальное время окончания запроса пользователя flow"""
+        if flow is None:
+            return self.virtual_time
+        start = max(self.virtual_time, self._finish.get(flow, 0.0))
+        self._finish[flow] = start + cost / weight
+        return start
+
+    def charge(self, flow: Hashable, tokens: float, weight: float = 1.0):
+        """Доначислить пользователю фактически израсходованные токены"""
+        self._finish[flow] = max(self.virtual_time, self._finish.get(flow, 0.0)) + tokens / weight
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL,
+                      on_wait: Optional[Callable[[int], Awaitable[None]]] = None,
+                      flow: Optional[Hashable] = None, cost: float = 0.0, weight: float = 1.0):
+        """Дождаться права отправить один запрос; flow и cost — пользователь и оценка токенов для WFQ"""
+        if self.queue_depth >= self.max_queue:
+            raise SchedulerQueueFull(f"В очереди уже {self.max_queue} запросов")
+        await self.start()
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, self._tag(flow, cost, weight), next(self._counter), future]
+        heapq.heappush(self._heap, entry)
+        self._wakeup.set()
+
+        timeout = QUEUE_FEEDBACK_DELAY
+        last_position = None
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), timeout)
+                    return
+                except asyncio.TimeoutError:
+                    position = self.position(entry)
+                    if on_wait is not None and position != last_position:
+                        last_position = position
+                        try:
+                            await on_wait(position)
+                        except Exception as e:
+                            logger.warning(f"⚠️ Не удалось сообщить позицию в очереди: {e}")
+                    timeout = QUEUE_FEEDBACK_INTERVAL
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def observe(self, status_code: int, headers: Mapping[str, str]):
+        """Учесть заголовки лимитов из ответа DeepSeek"""
+        remaining = _parse_int(headers.get("x-ratelimit-remaining"))
+        reset = parse_reset_seconds(headers.get("x-ratelimit-reset"))
+        if status_code == 429:
+            retry_after = parse_reset_seconds(headers.get("retry-after")) or reset or 1.0 / self.bucket.min_rate
+            logger.warning(f"⏸️ DeepSeek вернул 429, пауза очереди {retry_after:.1f} с")
+            self.bucket.pause(retry_after)
+            self.bucket.backoff()
+            self._wakeup.set()
+            return
+        if remaining is None:
+            self.bucket.recover()
+        else:
+            self.bucket.adapt(remaining, reset)
+
+    async def _pump(self):
+        while True:
+            # Отбрасываем отмененных ожидающих
+            while self._heap and self._heap[0][3].done():
+                heapq.heappop(self._heap)
+            if not self._heap:
+                self._prune_flows()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self.bucket.time_until_token()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    # Просыпаемся раньше, если пришел запрос выше приоритетом или новые заголовки
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._heap)
+            if not entry[3].done():
+                self.bucket.take()
+                self.virtual_time = max(self.virtual_time, entry[1])
+                entry[3].set_result(None)
+
+    def _prune_flows(self):
+        """Пользователи, отставшие от виртуального времени, ничем не отличаются от новых"""
+        self._finish = {flow: finish for flow, finish in self._finish.items() if finish > self.virtual_time}
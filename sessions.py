@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Хранилище сессий
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "1800"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+
+
+class UserSession:
+    """Диалог пользователя (без системного промпта), сжатая память о ранних репликах,
+    факты натальной карты и служебные отметки"""
+
+    __slots__ = ("user_id", "history", "last_donation_reminder", "summary", "chart")
+
+    def __init__(self, user_id: int, history: Optional[List[dict]] = None,
+                 last_donation_reminder: Optional[datetime] = None, summary: Optional[str] = None,
+                 chart: Optional[str] = None):
+        self.user_id = user_id
+        self.history = history if history is not None else []
+        self.last_donation_reminder = last_donation_reminder
+        self.summary = summary
+        self.chart = chart
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "history": self.history,
+            "summary": self.summary,
+            "chart": self.chart,
+            "last_donation_reminder": (
+                self.last_donation_reminder.isoformat() if self.last_donation_reminder else None
+            )
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, user_id: int, raw: str) -> "UserSession":
+        data = json.loads(raw)
+        reminder = data.get("last_donation_reminder")
+        return cls(
+            user_id,
+            history=data.get("history") or [],
+            summary=data.get("summary"),
+            chart=data.get("chart"),
+            last_donation_reminder=datetime.fromisoformat(reminder) if reminder else None
+        )
+
+
+class SessionBackend(ABC):
+    """Постоянное хранилище сессий (синхронное, вызывается из потока)"""
+
+    @abstractmethod
+    def load(self, user_id: int) -> Optional[str]:
+        """Сериализованная сессия или None"""
+
+    @abstractmethod
+    def save_many(self, items: Iterable[Tuple[int, str]]):
+        """Записать пачку сессий одной транзакцией"""
+
+    @abstractmethod
+    def delete(self, user_id: int):
+        """Удалить сессию"""
+
+    def close(self):
+        """Освободить ресурсы"""
+
+
+class MemorySessionBackend(SessionBackend):
+    """Хранилище в памяти процесса — для тестов и локального запуска"""
+
+    def __init__(self):
+        self._data: Dict[int, str] = {}
+
+    def load(self, user_id: int) -> Optional[str]:
+        return self._data.get(user_id)
+
+    def save_many(self, items: Iterable[Tuple[int, str]]):
+        self._data.update(items)
+
+    def delete(self, user_id: int):
+        self._data.pop(user_id, None)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """SQLite в режиме WAL: читатели не блокируют пакетную запись"""
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, items: Iterable[Tuple[int, str]]):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                [(user_id, data, now) for user_id, data in items]
+            )
+
+    def delete(self, user_id: int):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_session_backend(kind: str = SESSION_BACKEND) -> SessionBackend:
+    """Бэкенд по имени из конфигурации"""
+    if kind == "memory":
+        return MemorySessionBackend()
+    if kind == "sqlite":
+        return SQLiteSessionBackend()
+    raise ValueError(f"Неизвестный SESSION_BACKEND: {kind}")
+
+
+class SessionStore:
+    """Горячий LRU-кэш сессий с TTL перед постоянным хранилищем.
+
+    Изменения копятся в памяти и пишутся пачками раз в flush_interval
+    секунд (write-behind). Вытесненные из кэша сессии догружаются из
+    хранилища при следующем обращении пользователя.
+    """
+
+    def __init__(self, backend: SessionBackend, max_size: int = SESSION_CACHE_SIZE,
+                 idle_ttl: float = SESSION_IDLE_TTL, flush_interval: float = SESSION_FLUSH_INTERVAL):
+        self.backend = backend
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        # user_id -> (сессия, время последнего обращения)
+        self._cache: "OrderedDict[int, Tuple[UserSession, float]]" = OrderedDict()
+        self._dirty: Dict[int, UserSession] = {}
+        # Сессии, которые пишутся прямо сейчас (еще не видны в хранилище)
+        self._flushing: Dict[int, UserSession] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    async def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await asyncio.to_thread(self.backend.close)
+
+    async def get(self, user_id: int) -> UserSession:
+        """Сессия пользователя: из кэша, из очереди записи или из хранилища"""
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            self._touch(user_id, cached[0])
+            return cached[0]
+
+        session = self._dirty.get(user_id) or self._flushing.get(user_id)
+        if session is None:
+            raw = await asyncio.to_thread(self.backend.load, user_id)
+            session = UserSession.from_json(user_id, raw) if raw else UserSession(user_id)
+            # Пока грузили, сессию мог поднять параллельный обработчик
+            cached = self._cache.get(user_id)
+            if cached is not None:
+                session = cached[0]
+
+        self._touch(user_id, session)
+        self._evict()
+        return session
+
+    def save(self, session: UserSession):
+        """Пометить сессию измененной; запись произойдет в фоне"""
+        self._dirty[session.user_id] = session
+        if session.user_id in self._cache:
+            self._touch(session.user_id, session)
+
+    def invalidate(self, user_id: int):
+        """Забыть закэшированную копию: сессию могла изменить другая реплика"""
+        if user_id not in self._dirty and user_id not in self._flushing:
+            self._cache.pop(user_id, None)
+
+    async def flush_user(self, user_id: int):
+        """Записать сессию пользователя сейчас, не дожидаясь пачки"""
+        session = self._dirty.pop(user_id, None)
+        if session is None:
+            return
+        try:
+            await asyncio.to_thread(self.backend.save_many, [(user_id, session.to_json())])
+        except Exception as e:
+            logger.error(f"❌ Не удалось сохранить сессию пользователя {user_id}: {e}")
+            self._dirty.setdefault(user_id, session)
+
+    async def delete(self, user_id: int):
+        self._cache.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+        await self.flush()
+        await asyncio.to_thread(self.backend.delete, user_id)
+
+    async def flush(self):
+        """Записать все измененные сессии одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._flushing = dirty
+            # Сериализуем в цикле событий, чтобы не гоняться с обработчиками
+            items = [(user_id, session.to_json()) for user_id, session in dirty.items()]
+            try:
+                await asyncio.to_thread(self.backend.save_many, items)
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить {len(items)} сессий: {e}")
+                # Вернем в очередь, не затирая более свежие изменения
+                for user_id, session in dirty.items():
+                    self._dirty.setdefault(user_id, session)
+            finally:
+                self._flushing = {}
+
+    def _touch(self, user_id: int, session: UserSession):
+        self._cache[user_id] = (session, time.monotonic())
+        self._cache.move_to_end(user_id)
+
+    def _evict(self):
+        """Вытеснить лишние и простаивающие сессии (несохраненные ждут flush в _dirty)"""
+        now = time.monotonic()
+        while self._cache:
+            user_id, (_, last_used) = next(iter(self._cache.items()))
+            if len(self._cache) <= self.max_size and now - last_used < self.idle_ttl:
+                break
+            del self._cache[user_id]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._evict()
+            await self.flush()
@@ -0,0 +1,124 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sessions import SessionStore, UserSession
+from tokens import history_tokens, make_message, message_tokens
+
+logger = logging.getLogger(__name__)
+
+# Сжатие старых реплик диалога в «память»
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+# Порог истории в токенах, после которого старые реплики сжимаются
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "3000"))
+# Сколько последних токенов истории оставить дословно
+SUMMARY_KEEP_TOKENS = int(os.getenv("SUMMARY_KEEP_TOKENS", "1200"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+
+SUMMARY_PROMPT = """Ты ведешь конспект астрологической консультации для самого консультанта.
+Сожми диалог в память на 5-10 пунктов: факты о пользователе (знаки, дата рождения, если названы),
+его запросы и темы, ключевые выводы и упражнения, которые уже были предложены.
+Пиши кратко, по-русски, без приветствий и без новых советов."""
+
+MEMORY_HEADER = "Память о предыдущей части консультации:"
+
+# complete(messages) -> текст или None, если вызов не удался
+Completion = Callable[[List[dict]], Awaitable[Optional[str]]]
+
+
+def memory_message(summary: str) -> dict:
+    """Системное сообщение с памятью, идет сразу после системного промпта"""
+    return make_message("system", f"{MEMORY_HEADER}\n{summary}")
+
+
+def summary_split(history: List[dict], keep_tokens: int = SUMMARY_KEEP_TOKENS) -> int:
+    """Сколько старых реплик сжать: последние keep_tokens остаются, и
+    оставшаяся часть начинается с вопроса пользователя"""
+    kept = 0
+    start = len(history)
+    while start > 0 and kept + message_tokens(history[start - 1]) <= keep_tokens:
+        start -= 1
+        kept += message_tokens(history[start])
+    while start < len(history) and history[start].get("role") != "user":
+        start += 1
+    if start == len(history):
+        # Последний вопрос с ответом остается дословно, даже если он длиннее keep_tokens
+        start = max((index for index, message in enumerate(history) if message.get("role") == "user"), default=0)
+    return start
+
+
+def _transcript(summary: Optional[str], messages: List[dict]) -> str:
+    lines = []
+    if summary:
+        lines.append(f"Прежняя память:\n{summary}\n")
+    for message in messages:
+        speaker = "Пользователь" if message["role"] == "user" else "Астролог"
+        lines.append(f"{speaker}: {message['content']}")
+    return "\n".join(lines)
+
+
+class ConversationSummarizer:
+    """Фоновое сжатие истории: не задерживает ответ пользователю.
+
+    Когда история сессии превышает порог, старые реплики (вместе с прежней
+    памятью) отправляются дешевым низкоприоритетным запросом, а результат
+    сохраняется в session.summary. Если за время запроса история изменилась
+    (/reset), результат отбрасывается.
+    """
+
+    def __init__(self, sessions: SessionStore, complete: Completion,
+                 trigger_tokens: int = SUMMARY_TRIGGER_TOKENS, keep_tokens: int = SUMMARY_KEEP_TOKENS):
+        self.sessions = sessions
+        self.complete = complete
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def maybe_schedule(self, session: UserSession):
+        user_id = session.user_id
+        if user_id in self._tasks or history_tokens(session.history) < self.trigger_tokens:
+            return
+        task = asyncio.create_task(self._summarize(user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+
+    def cancel(self, user_id: int):
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _summarize(self, user_id: int):
+        session = await self.sessions.get(user_id)
+        count = summary_split(session.history, self.keep_tokens)
+        if not count:
+            return
+        old = session.history[:count]
+        prompt = [
+            make_message("system", SUMMARY_PROMPT),
+            make_message("user", _transcript(session.summary, old))
+        ]
+        try:
+            summary = await self.complete(prompt)
+        except Exception as e:
+            logger.error(f"❌ Не удалось сжать историю пользователя {user_id}: {e}")
+            return
+        if not summary:
+            return
+
+        session = await self.sessions.get(user_id)
+        if session.history[:count] != old:
+            logger.info(f"🧠 История пользователя {user_id} изменилась, память не обновлена")
+            return
+        before = history_tokens(session.history)
+        session.summary = summary.strip()
+        session.history = session.history[count:]
+        self.sessions.save(session)
+        logger.info(f"🧠 Сжато {count} реплик пользователя {user_id}: "
+                    f"{before} → {history_tokens(session.history)} токенов истории")
@@ -0,0 +1,97 @@
+import asyncio
+
+import httpx
+import pytest
+
+import deepseek
+from deepseek import DEEPSEEK_READ_TIMEOUT, DeepSeekClient, tier_timeout
+from resilience import RETRY_ATTEMPTS, CircuitBreaker, CircuitOpenError
+
+
+def make_client(handler) -> DeepSeekClient:
+    client = DeepSeekClient("test-key", "https://deepseek.test/v1/chat/completions")
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def timing_out(calls: list):
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        raise httpx.ReadTimeout("read timed out", request=request)
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(deepseek, "backoff_delay", lambda attempt: 0.0)
+
+
+def test_tier_timeout_only_for_shorter_read_timeout():
+    error = httpx.ReadTimeout("read timed out")
+    assert tier_timeout(error, DEEPSEEK_READ_TIMEOUT / 3)
+    assert not tier_timeout(error, DEEPSEEK_READ_TIMEOUT)
+    assert not tier_timeout(error, None)
+    assert not tier_timeout(httpx.ConnectError("refused"), DEEPSEEK_READ_TIMEOUT / 3)
+
+
+def test_short_tier_timeout_is_not_retried_but_counts_as_failure():
+    calls = []
+    client = make_client(timing_out(calls))
+    provider = client.pool.providers[0]
+
+    async def run():
+        with pytest.raises(httpx.ReadTimeout):
+            await client.post({"messages": []}, read_timeout=DEEPSEEK_READ_TIMEOUT / 3)
+        await client.close()
+
+    asyncio.run(run())
+    assert len(calls) == 1
+    assert client.breaker.failures == 1
+    assert provider.failures == 1
+
+
+def test_full_read_timeout_is_retried():
+    calls = []
+    client = make_client(timing_out(calls))
+
+    async def run():
+        with pytest.raises(httpx.ReadTimeout):
+            await client.post({"messages": []}, read_timeout=DEEPSEEK_READ_TIMEOUT)
+        await client.close()
+
+    asyncio.run(run())
+    assert len(calls) == RETRY_ATTEMPTS
+    assert client.breaker.failures == RETRY_ATTEMPTS
+
+
+def test_tier_timeouts_open_the_breaker():
+    calls = []
+    client = make_client(timing_out(calls))
+
+    async def run():
+        for _ in range(client.breaker.failure_threshold):
+            with pytest.raises(httpx.ReadTimeout):
+                await client.post({"messages": []}, read_timeout=DEEPSEEK_READ_TIMEOUT / 3)
+        assert client.breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            await client.post({"messages": []}, read_timeout=DEEPSEEK_READ_TIMEOUT / 3)
+        await client.close()
+
+    asyncio.run(run())
+    assert len(calls) == client.breaker.failure_threshold
+
+
+def test_short_tier_timeout_in_stream_counts_as_failure():
+    calls = []
+    client = make_client(timing_out(calls))
+
+    async def run():
+        with pytest.raises(httpx.ReadTimeout):
+            async with client.stream({"messages": []}, read_timeout=DEEPSEEK_READ_TIMEOUT / 3):
+                pass
+        await client.close()
+
+    asyncio.run(run())
+    assert len(calls) == 1
+    assert client.breaker.failures == 1
+    assert client.pool.providers[0].failures == 1
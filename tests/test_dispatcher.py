@@ -0,0 +1,46 @@
+import asyncio
+
+from dispatcher import PerUserUpdateProcessor
+
+
+def test_detached_work_shares_the_worker_limit():
+    processor = PerUserUpdateProcessor(workers=2, max_pending=8)
+    running = []
+    peak = []
+
+    async def work():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def run():
+        tasks = [asyncio.create_task(processor.run_detached(work())) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert processor.pending == 5
+        assert processor.active == 2
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert max(peak) == 2
+    assert processor.pending == 0 and processor.active == 0
+
+
+def test_cancelled_detached_work_is_not_left_unawaited():
+    processor = PerUserUpdateProcessor(workers=1, max_pending=8)
+    started = []
+
+    async def work(name):
+        started.append(name)
+        await asyncio.sleep(0.05)
+
+    async def run():
+        first = asyncio.create_task(processor.run_detached(work("first")))
+        second = asyncio.create_task(processor.run_detached(work("second")))
+        await asyncio.sleep(0)
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+
+    asyncio.run(run())
+    assert started == ["first"]
+    assert processor.pending == 0
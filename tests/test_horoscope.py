@@ -0,0 +1,34 @@
+import pytest
+
+from horoscope import daily_sign, find_sign
+
+
+@pytest.mark.parametrize("text, sign", [
+    ("Гороскоп на сегодня для Льва", "Лев"),
+    ("гороскоп для Девы", "Дева"),
+    ("Лев сегодня", "Лев"),
+    ("Что на сегодня Рыбам?", "Рыбы"),
+    ("Что ждёт Скорпиона сегодня?", "Скорпион"),
+])
+def test_daily_request_matches(text, sign):
+    assert daily_sign(text) == sign
+
+
+@pytest.mark.parametrize("text", [
+    "гороскоп на неделю для Девы",
+    "гороскоп совместимости Льва и Рыб",
+    "Как составить гороскоп для Рака на год?",
+    "Что значит Луна в Весах в моем гороскопе?",
+    "Транзит Сатурна по Козерогу сегодня",
+    "Гороскоп на сегодня для Льва и Девы",
+    "Лев",
+    "гороскоп на сегодня",
+])
+def test_other_questions_do_not_match(text):
+    assert daily_sign(text) is None
+
+
+def test_find_sign_returns_first_mentioned():
+    assert find_sign("Рыбы и Овен") == "Рыбы"
+    assert find_sign("для Козерога") == "Козерог"
+    assert find_sign("без знака") is None
@@ -0,0 +1,47 @@
+import json
+import logging
+import queue
+
+from logging_setup import JsonFormatter, RedactingQueueHandler, TextFormatter, TEXT_FORMAT, redact_secrets
+
+BOT_TOKEN = "123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw8"
+API_KEY = "sk-0123456789abcdef0123456789abcdef"
+
+
+def queued_record(secrets=(BOT_TOKEN, API_KEY), **kwargs) -> logging.LogRecord:
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("tests.redaction")
+    logger.propagate = False
+    handler = RedactingQueueHandler(log_queue, secrets)
+    logger.addHandler(handler)
+    try:
+        try:
+            raise RuntimeError(f"POST https://api.telegram.org/bot{BOT_TOKEN}/sendMessage failed")
+        except RuntimeError as e:
+            logger.error("Ошибка отправки", exc_info=e, **kwargs)
+    finally:
+        logger.removeHandler(handler)
+    return log_queue.get_nowait()
+
+
+def test_redact_secrets():
+    assert BOT_TOKEN not in redact_secrets(f"bot{BOT_TOKEN}/getMe")
+    assert redact_secrets("Authorization: Bearer abc.def") == "Authorization: Bearer ***"
+    assert redact_secrets("key=custom-secret", ["custom-secret"]) == "key=***"
+
+
+def test_traceback_is_redacted_in_text_format():
+    line = TextFormatter(TEXT_FORMAT).format(queued_record())
+    assert "Traceback" in line
+    assert "RuntimeError" in line
+    assert BOT_TOKEN not in line
+
+
+def test_fields_are_redacted_in_json_format():
+    record = queued_record(extra={"fields": {"url": f"https://api.telegram.org/bot{BOT_TOKEN}/", "key": API_KEY,
+                                             "status": 500}})
+    data = json.loads(JsonFormatter().format(record))
+    assert BOT_TOKEN not in data["msg"]
+    assert BOT_TOKEN not in data["url"]
+    assert data["key"] == "***"
+    assert data["status"] == 500
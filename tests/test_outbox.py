@@ -0,0 +1,29 @@
+from outbox import split_message
+
+
+def test_short_text_is_one_message():
+    assert split_message("Привет") == ["Привет"]
+    assert split_message("") == [""]
+
+
+def test_long_text_splits_on_paragraphs_within_the_limit():
+    paragraphs = [f"Абзац {number}. " + "Звезды говорят. " * 20 for number in range(30)]
+    text = "\n\n".join(paragraphs)
+    chunks = split_message(text, limit=1000)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+    assert all(chunk.startswith("Абзац") for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_text_without_separators_is_cut_hard():
+    chunks = split_message("х" * 2500, limit=1000)
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+
+
+def test_markdown_code_block_is_reopened_after_the_cut():
+    text = "Вступление\n```\n" + "\n".join(f"строка {number}" for number in range(200)) + "\n```\nИтог"
+    chunks = split_message(text, limit=500, markdown=True)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 500 for chunk in chunks)
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
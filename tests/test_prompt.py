@@ -0,0 +1,20 @@
+from prompt import PromptBuilder
+from sessions import UserSession
+from tokens import history_tokens, make_message
+
+
+def test_build_and_append_trim_history_by_the_same_rule():
+    system = make_message("system", "Ты астролог. " * 200)
+    builder = PromptBuilder(system, budget=history_tokens([system]) + 600, trim_step=0.4)
+    session = UserSession(1, chart="Солнце в Овне. " * 50)
+    prefix = builder.prefix(session)
+    history_budget = builder.budget - history_tokens(prefix)
+
+    for number in range(40):
+        question = make_message("user", f"Вопрос {number} про транзиты")
+        prompt = builder.build(session, question)
+        assert prompt[:len(prefix)] == prefix
+        assert prompt[len(prefix):] == builder.trim_history(session.history + [question], prefix)
+        assert history_tokens(prompt) <= builder.budget
+        builder.append(session, question, make_message("assistant", f"Ответ {number}: Марс в Тельце"))
+        assert history_tokens(session.history) <= history_budget
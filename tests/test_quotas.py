@@ -0,0 +1,36 @@
+from metrics import USER_QUOTA_THROTTLED
+from quotas import UsageLedger
+
+
+def test_charges_completion_and_cache_miss_prompt_tokens():
+    ledger = UsageLedger(quota=10000, window=3600)
+    usage = {"prompt_tokens": 4200, "completion_tokens": 300,
+             "prompt_cache_hit_tokens": 4000, "prompt_cache_miss_tokens": 200}
+    assert ledger.record(1, usage) == 500
+    assert ledger.used(1) == 500
+
+
+def test_falls_back_to_prompt_minus_cache_hits():
+    ledger = UsageLedger(quota=10000, window=3600)
+    assert ledger.record(1, {"prompt_tokens": 1000, "completion_tokens": 100, "prompt_cache_hit_tokens": 600}) == 500
+    assert ledger.record(2, {"prompt_tokens": 1000, "completion_tokens": 100}) == 1100
+    assert ledger.record(3, None) == 0
+
+
+def test_retry_after_counts_every_throttled_request():
+    ledger = UsageLedger(quota=1000, window=3600)
+    ledger.record(1, {"prompt_tokens": 0, "completion_tokens": 600})
+    assert ledger.retry_after(1) is None
+    ledger.record(1, {"prompt_tokens": 0, "completion_tokens": 600})
+
+    before = USER_QUOTA_THROTTLED.value()
+    delay = ledger.retry_after(1)
+    assert 1.0 <= delay <= 3600
+    assert ledger.retry_after(1) is not None
+    assert USER_QUOTA_THROTTLED.value() == before + 2
+
+
+def test_unlimited_quota_never_throttles():
+    ledger = UsageLedger(quota=0)
+    ledger.record(1, {"prompt_tokens": 10 ** 6, "completion_tokens": 10 ** 6})
+    assert ledger.retry_after(1) is None
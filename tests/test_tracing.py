@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+from tracing import Tracer, _current, trace_id_for
+
+
+def test_answer_task_continues_the_update_trace(tmp_path):
+    tracer = Tracer(enabled=True, export_path=str(tmp_path / "traces.jsonl"))
+    trace_id = trace_id_for(42)
+
+    async def answer():
+        await asyncio.sleep(0.01)
+        with tracer.follow("answer_turn", trace_id):
+            with tracer.span("deepseek"):
+                pass
+
+    async def run():
+        with tracer.trace("handle_message", trace_id):
+            # Задача наследует контекст обработчика, как задачи склейки сообщений
+            task = asyncio.create_task(answer())
+        await tracer.flush()
+        await task
+        await tracer.flush()
+
+    asyncio.run(run())
+    assert len(tracer.traces) == 1
+    spans = {span["name"]: span for span in tracer.recent()[0]["spans"]}
+    assert spans["handle_message"]["parent_id"] is None
+    assert spans["answer_turn"]["parent_id"] == spans["handle_message"]["span_id"]
+    assert spans["deepseek"]["parent_id"] == spans["answer_turn"]["span_id"]
+
+    exported = [
+        span["name"]
+        for line in (tmp_path / "traces.jsonl").read_text().splitlines()
+        for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    ]
+    assert sorted(exported) == ["answer_turn", "deepseek", "handle_message"]
+
+
+def test_follow_without_parent_context_starts_a_trace():
+    tracer = Tracer(enabled=True)
+    assert _current.get() is None
+    with tracer.follow("answer_turn", trace_id_for(7)):
+        pass
+    assert len(tracer.traces) == 1
+    assert tracer.traces[0].root.name == "answer_turn"
@@ -0,0 +1,49 @@
+import asyncio
+
+from telegram import Update
+
+import webhook
+from webhook import UpdateDeduplicator, WebhookIntake
+
+
+def test_deduplicator_drops_repeats_until_forgotten():
+    dedup = UpdateDeduplicator(ttl=3600, max_size=100)
+    assert dedup.check_and_add(1)
+    assert not dedup.check_and_add(1)
+    dedup.forget(1)
+    assert dedup.check_and_add(1)
+
+
+def test_deduplicator_expires_and_stays_bounded():
+    dedup = UpdateDeduplicator(ttl=0, max_size=100)
+    assert dedup.check_and_add(1)
+    assert dedup.check_and_add(1)
+
+    dedup = UpdateDeduplicator(ttl=3600, max_size=3)
+    for update_id in range(10):
+        assert dedup.check_and_add(update_id)
+    assert len(dedup) == 3
+    assert not dedup.check_and_add(9)
+
+
+def test_intake_accepts_a_redelivered_update_once():
+    async def run():
+        intake = WebhookIntake(application=None, queue_size=10)
+        assert await intake.submit(Update(update_id=5))
+        assert await intake.submit(Update(update_id=5))
+        return intake.queue.qsize()
+
+    assert asyncio.run(run()) == 1
+
+
+def test_rejected_update_can_be_delivered_again(monkeypatch):
+    monkeypatch.setattr(webhook, "WEBHOOK_ENQUEUE_TIMEOUT", 0.01)
+
+    async def run():
+        intake = WebhookIntake(application=None, queue_size=1)
+        assert await intake.submit(Update(update_id=1))
+        assert not await intake.submit(Update(update_id=2))
+        await intake.queue.get()
+        assert await intake.submit(Update(update_id=2))
+
+    asyncio.run(run())
@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import logging
+from typing import Dict, Optional
+
+from metrics import GENERATION_TIERS
+
+logger = logging.getLogger(__name__)
+
+# Уровни генерации: короткий вопрос не ждет бюджета полного разбора карты
+TIERS_ENABLED = os.getenv("TIERS_ENABLED", "1") == "1"
+# Переопределение уровней, JSON: {"short": {"max_tokens": 300, "timeout": 15, "model": "..."}}
+GENERATION_TIERS_CONFIG = os.getenv("GENERATION_TIERS", "")
+# Вопрос не длиннее стольких символов и в одно предложение считается коротким
+SHORT_MAX_CHARS = int(os.getenv("TIER_SHORT_MAX_CHARS", "160"))
+# Длинное сообщение (рассказ о ситуации) — сразу подробный ответ
+DEEP_MIN_CHARS = int(os.getenv("TIER_DEEP_MIN_CHARS", "500"))
+
+SHORT = "short"
+NORMAL = "normal"
+DEEP = "deep"
+EXPAND = "expand"
+
+# Текст, которым кнопка «Подробнее» продолжает диалог
+EXPAND_REQUEST = "Расскажи подробнее"
+
+# Только голая просьба продолжить: «подробнее», «ещё», «расскажи больше» (сообщение целиком)
+_EXPAND_RE = re.compile(
+    r"(а\s+|и\s+)?((можно|давай|расскажи|распиши|объясни|напиши)\s+)*"
+    r"((по)?подробнее|больше|ещ[её](\s+(больше|подробнее))?|продолж(и|ай|ите)|дальше|разверн(и|ите)(\s+ответ)?)"
+    r"(,?\s*пожалуйста)?[\s.!?…]*",
+    re.IGNORECASE
+)
+_DEEP_RE = re.compile(
+    r"натальн|разбор|разбер|расшифр|подробн|детальн|совместимост|синастр|соляр|транзит|прогноз на (год|месяц)"
+    r"|кармическ|предназначени|жизненн\w* путь",
+    re.IGNORECASE
+)
+_OWN_CHART_RE = re.compile(r"\b(мо(я|ей|ю|ем)|по)\s+карт", re.IGNORECASE)
+_SENTENCE_END_RE = re.compile(r"[.!?…]+\s+\S")
+
+
+class GenerationTier:
+    """Бюджет ответа: лимит токенов, температура, таймаут чтения, модель и подсказка о длине.
+
+    hint уходит последним системным сообщением — после вопроса, чтобы не
+    ломать общий префикс промпта для контекстного кэша DeepSeek.
+    """
+
+    __slots__ = ("name", "max_tokens", "temperature", "timeout", "model", "hint", "expandable")
+
+    def __init__(self, name: str, max_tokens: int, temperature: float, timeout: float,
+                 model: Optional[str] = None, hint: Optional[str] = None, expandable: bool = False):
+        self.name = name
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.model = model
+        self.hint = hint
+        self.expandable = expandable
+
+    def params(self) -> dict:
+        """Параметры генерации поверх общих (model — только если задана своя)"""
+        params = {"temperature": self.temperature, "max_tokens": self.max_tokens}
+        if self.model:
+            params["model"] = self.model
+        return params
+
+
+def default_tiers() -> Dict[str, GenerationTier]:
+    return {
+        SHORT: GenerationTier(
+            SHORT, 350, 0.6, 20,
+            hint="Ответь коротко: 2–4 предложения по существу, без вступления и списков.",
+            expandable=True
+        ),
+        NORMAL: GenerationTier(
+            NORMAL, 900, 0.7, 40,
+            hint="Ответь по существу, не больше трех небольших абзацев.",
+            expandable=True
+        ),
+        DEEP: GenerationTier(DEEP, 2000, 0.7, 60),
+        EXPAND: GenerationTier(
+            EXPAND, 1500, 0.7, 60,
+            hint="Раскрой свой предыдущий ответ подробнее: добавь детали и практические шаги, не повторяя сказанное."
+        ),
+    }
+
+
+def load_tiers() -> Dict[str, GenerationTier]:
+    """Уровни по умолчанию с поправками из GENERATION_TIERS"""
+    tiers = default_tiers()
+    if not GENERATION_TIERS_CONFIG:
+        return tiers
+    try:
+        overrides = json.loads(GENERATION_TIERS_CONFIG)
+    except ValueError as e:
+        logger.error(f"❌ Некорректный GENERATION_TIERS, использую уровни по умолчанию: {e}")
+        return tiers
+    for name, values in overrides.items():
+        tier = tiers.get(name)
+        if tier is None:
+            logger.warning(f"⚠️ Неизвестный уровень генерации {name!r} в GENERATION_TIERS")
+            continue
+        for key, value in values.items():
+            if key in GenerationTier.__slots__ and key != "name":
+                setattr(tier, key, value)
+    return tiers
+
+
+def classify(text: str, has_chart: bool = False, has_history: bool = False) -> str:
+    """Уровень по дешевым признакам: длина, ключевые слова, контекст диалога"""
+    text = text.strip()
+    if has_history and _EXPAND_RE.fullmatch(text):
+        return EXPAND
+    if len(text) >= DEEP_MIN_CHARS or _DEEP_RE.search(text):
+        return DEEP
+    if has_chart and _OWN_CHART_RE.search(text):
+        # Вопрос по рассчитанной карте пользователя
+        return DEEP
+    if len(text) <= SHORT_MAX_CHARS and not _SENTENCE_END_RE.search(text) and "\n" not in text:
+        return SHORT
+    return NORMAL
+
+
+class TierClassifier:
+    """Выбор уровня генерации для сообщения пользователя"""
+
+    def __init__(self, enabled: bool = TIERS_ENABLED, tiers: Optional[Dict[str, GenerationTier]] = None):
+        self.enabled = enabled
+        self.tiers = tiers or load_tiers()
+
+    def choose(self, text: str, has_chart: bool = False, has_history: bool = False) -> GenerationTier:
+        # Выключено — как раньше, полный бюджет на любой вопрос
+        name = classify(text, has_chart, has_history) if self.enabled else DEEP
+        GENERATION_TIERS.inc(tier=name)
+        return self.tiers[name]
@@ -0,0 +1,69 @@
+import os
+import math
+from typing import List
+
+# Бюджет токенов на промпт (системный промпт + история)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Грубая оценка для BPE-токенизатора DeepSeek:
+# латиница ~0.3 токена на символ, кириллица и прочее ~0.5
+ASCII_TOKENS_PER_CHAR = 0.3
+OTHER_TOKENS_PER_CHAR = 0.5
+
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов без обращения к API"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    other_chars = len(text) - ascii_chars
+    return math.ceil(ascii_chars * ASCII_TOKENS_PER_CHAR + other_chars * OTHER_TOKENS_PER_CHAR)
+
+
+def make_message(role: str, content: str) -> dict:
+    """Сообщение истории с заранее посчитанной стоимостью в токенах"""
+    return {"role": role, "content": content, "tokens": estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS}
+
+
+def message_tokens(message: dict) -> int:
+    """Стоимость сообщения; считается один раз и запоминается в самом сообщении"""
+    if "tokens" not in message:
+        message["tokens"] = estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+    return message["tokens"]
+
+
+def history_tokens(history: List[dict]) -> int:
+    return sum(message_tokens(message) for message in history)
+
+
+def trim_to_budget(history: List[dict], budget: int = PROMPT_TOKEN_BUDGET) -> List[dict]:
+    """Отбросить самые старые реплики, сохранив системные сообщения в начале и последнее сообщение"""
+    if not history:
+        return history
+
+    system_count = 0
+    while system_count < len(history) - 1 and history[system_count].get("role") == "system":
+        system_count += 1
+    head = history[:system_count]
+    tail = history[len(head):]
+    total = history_tokens(history)
+
+    start = 0
+    while total > budget and start < len(tail) - 1:
+        total -= message_tokens(tail[start])
+        start += 1
+
+    # История не начинается с ответа ассистента без вопроса
+    while start < len(tail) - 1 and tail[start].get("role") == "assistant":
+        total -= message_tokens(tail[start])
+        start += 1
+
+    return head + tail[start:] if start else history
+
+
+def api_messages(history: List[dict]) -> List[dict]:
+    """Сообщения для API без служебных полей"""
+    return [{"role": message["role"], "content": message["content"]} for message in history]
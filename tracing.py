@@ -0,0 +1,386 @@
+import os
+import json
+import time
+import random
+import asyncio
+import cProfile
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Iterator, List, Optional, Tuple
+
+from metrics import SPAN_DURATION
+
+logger = logging.getLogger(__name__)
+
+# Трассировка апдейтов: последние трассы в памяти, экспорт в файл по желанию
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "500"))
+# Файл OTLP/JSON (одна запись resourceSpans на строку); пусто — без экспорта
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+TRACE_EXPORT_MAX_BYTES = int(os.getenv("TRACE_EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+# Медленные трассы пишутся в лог целиком, с длительностью каждого участка
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "15000"))
+# Доля апдейтов, обработка которых профилируется cProfile (0 — выключено)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Токен для /debug/traces (заголовок X-Debug-Token); пусто — маршрут не регистрируется
+TRACE_DEBUG_TOKEN = os.getenv("TRACE_DEBUG_TOKEN", "")
+DEBUG_TOKEN_HEADER = "x-debug-token"
+
+SERVICE_NAME = "astrobot"
+# Виды спанов OTLP
+KIND_INTERNAL = 1
+KIND_CLIENT = 3
+
+# Сдвиг между monotonic и временем эпохи — для спанов, замеренных задним числом
+_EPOCH_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+# Старшая половина trace_id: трассы разных процессов не совпадают
+_PROCESS_TRACE_PREFIX = f"{random.getrandbits(64):016x}"
+
+
+def _now_ns() -> int:
+    return time.monotonic_ns() + _EPOCH_OFFSET_NS
+
+
+def _monotonic_to_ns(value: float) -> int:
+    return int(value * 1e9) + _EPOCH_OFFSET_NS
+
+
+def trace_id_for(update_id: Optional[int]) -> str:
+    """Один trace_id на апдейт: прием сообщения и ответ на него попадают в одну трассу"""
+    if update_id is None:
+        return f"{random.getrandbits(128):032x}"
+    return f"{_PROCESS_TRACE_PREFIX}{update_id & (2 ** 64 - 1):016x}"
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], kind: int = KIND_INTERNAL,
+                 start_ns: Optional[int] = None, attributes: Optional[dict] = None):
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns if start_ns is not None else _now_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or _now_ns()) - self.start_ns) / 1e6
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None):
+        self.end_ns = _now_ns()
+        if error is not None:
+            self.error = type(error).__name__
+        SPAN_DURATION.observe(self.duration_ms / 1000, span=self.name)
+
+
+class Trace:
+    """Спаны одного апдейта (или фоновой операции) и профиль, если апдейт попал в выборку"""
+
+    __slots__ = ("trace_id", "spans", "finished", "stored", "exported", "profile")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        self.finished = False
+        # Уже в кольцевом буфере; сколько спанов уже выгружено в файл
+        self.stored = False
+        self.exported = 0
+        self.profile: Optional[cProfile.Profile] = None
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    @property
+    def duration_ms(self) -> float:
+        """От начала корня до конца последнего спана (с продолжениями трассы)"""
+        end_ns = max(span.end_ns or _now_ns() for span in self.spans)
+        return (end_ns - self.root.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "duration_ms": round(self.duration_ms, 1),
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "offset_ms": round((span.start_ns - self.root.start_ns) / 1e6, 1),
+                    "duration_ms": round(span.duration_ms, 1),
+                    **({"error": span.error} if span.error else {}),
+                    **span.attributes
+                }
+                for span in self.spans
+            ]
+        }
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(traces: List[Trace]) -> dict:
+    """Трассы в формате OTLP/JSON (как у file exporter OpenTelemetry Collector);
+    спаны, выгруженные раньше (до продолжения трассы), не повторяются"""
+    spans = []
+    for trace in traces:
+        for span in trace.spans[trace.exported:]:
+            item = {
+                "traceId": trace.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": span.kind,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {}
+            }
+            if span.parent_id:
+                item["parentSpanId"] = span.parent_id
+            spans.append(item)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}]
+    }]}
+
+
+# Текущая трасса и спан задачи; create_task копирует контекст, так что
+# дочерние задачи (страхующие запросы) пишут спаны в трассу родителя
+_current: ContextVar[Optional[Tuple[Trace, Span]]] = ContextVar("trace_span", default=None)
+
+
+class Tracer:
+    """Легкая трассировка пути сообщения: спаны в contextvars, кольцевой буфер трасс.
+
+    trace() открывает корневой спан (обработка апдейта), follow() продолжает
+    ее в задаче ответа, запущенной из обработчика, span() — вложенный
+    участок: поиск сессии, сборка промпта, очередь DeepSeek, подключение,
+    первый байт, разбор JSON, отправка ответа. Без открытой трассы span()
+    ничего не делает. Законченные трассы лежат в памяти (/debug/traces при
+    заданном TRACE_DEBUG_TOKEN) и,
+    если задан TRACE_EXPORT_PATH, пачками дописываются в файл OTLP/JSON.
+
+    Доля апдейтов (PROFILE_SAMPLE_RATE) профилируется cProfile от начала до
+    конца корневого спана, профиль пишется в PROFILE_DIR для pstats/snakeviz.
+    Профилировщик видит весь поток цикла событий: в профиль попадают и
+    соседние корутины, работавшие в те же моменты, а время ожидания сети
+    в нем не видно — его показывают спаны.
+    """
+
+    def __init__(self, enabled: bool = TRACE_ENABLED, size: int = TRACE_BUFFER_SIZE,
+                 export_path: str = TRACE_EXPORT_PATH, slow_ms: float = TRACE_SLOW_MS,
+                 profile_rate: float = PROFILE_SAMPLE_RATE, profile_dir: str = PROFILE_DIR):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.slow_ms = slow_ms
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.traces: Deque[Trace] = deque(maxlen=size)
+        self._pending: List[Trace] = []
+        self._profiling = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.enabled and self.export_path and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    @contextmanager
+    def trace(self, name: str, trace_id: Optional[str] = None, **attributes) -> Iterator[Optional[Span]]:
+        """Корневой спан новой трассы (предыдущая трасса контекста не наследуется)"""
+        if not self.enabled:
+            yield None
+            return
+        trace = Trace(trace_id or trace_id_for(None))
+        root = Span(name, None, attributes=attributes)
+        trace.spans.append(root)
+        self._maybe_profile(trace)
+        token = _current.set((trace, root))
+        error: Optional[BaseException] = None
+        try:
+            yield root
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current.reset(token)
+            root.end(error)
+            self._finish(trace)
+
+    @contextmanager
+    def follow(self, name: str, trace_id: str, **attributes) -> Iterator[Optional[Span]]:
+        """Продолжить трассу trace_id, унаследованную задачей из контекста обработчика:
+        спан name становится дочерним, трасса дописывается после своего корня.
+        Если в контексте другой трассы нет — открыть новую"""
+        current = _current.get()
+        if not self.enabled or current is None or current[0].trace_id != trace_id:
+            with self.trace(name, trace_id, **attributes) as root:
+                yield root
+            return
+        trace, parent = current
+        trace.finished = False
+        self._maybe_profile(trace)
+        span = Span(name, parent.span_id, attributes=attributes)
+        trace.spans.append(span)
+        token = _current.set((trace, span))
+        error: Optional[BaseException] = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current.reset(token)
+            span.end(error)
+            self._finish(trace, span)
+
+    @contextmanager
+    def span(self, name: str, kind: int = KIND_INTERNAL, **attributes) -> Iterator[Optional[Span]]:
+        current = _current.get()
+        if current is None or current[0].finished:
+            yield None
+            return
+        trace, parent = current
+        span = Span(name, parent.span_id, kind, attributes=attributes)
+        trace.spans.append(span)
+        token = _current.set((trace, span))
+        error: Optional[BaseException] = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current.reset(token)
+            span.end(error)
+
+    def record(self, name: str, started: float, ended: float, kind: int = KIND_INTERNAL, **attributes):
+        """Участок, замеренный задним числом по time.monotonic() (фазы httpx)"""
+        current = _current.get()
+        if current is None or current[0].finished:
+            return
+        trace, parent = current
+        span = Span(name, parent.span_id, kind, _monotonic_to_ns(started), attributes)
+        span.end_ns = _monotonic_to_ns(ended)
+        SPAN_DURATION.observe(max(0.0, ended - started), span=name)
+        trace.spans.append(span)
+
+    def recent(self, limit: int = 50, min_ms: float = 0) -> List[dict]:
+        """Последние трассы, новые первыми"""
+        result = []
+        for trace in reversed(self.traces):
+            if trace.duration_ms >= min_ms:
+                result.append(trace.to_dict())
+                if len(result) >= limit:
+                    break
+        return result
+
+    def _maybe_profile(self, trace: Trace):
+        # Решение зависит от trace_id: прием и ответ одного апдейта профилируются вместе
+        if self.profile_rate <= 0 or self._profiling:
+            return
+        if random.Random(trace.trace_id).random() >= self.profile_rate:
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Уже работает другой профилировщик (например, отладчик)
+            return
+        self._profiling = True
+        trace.profile = profile
+
+    def _finish(self, trace: Trace, top: Optional[Span] = None):
+        """Трасса закончена (или закончено ее продолжение top)"""
+        top = top or trace.root
+        trace.finished = True
+        if not trace.stored:
+            trace.stored = True
+            self.traces.append(trace)
+        if self.export_path and trace not in self._pending:
+            self._pending.append(trace)
+        if trace.profile is not None:
+            profile, trace.profile = trace.profile, None
+            profile.disable()
+            self._profiling = False
+            self._dump_profile(trace, top, profile)
+        if top.duration_ms >= self.slow_ms:
+            summary = {span.name: round(span.duration_ms) for span in trace.spans if span is not top}
+            logger.warning(f"🐢 Медленная обработка {top.name}: {top.duration_ms:.0f} мс",
+                           extra={"fields": {"event": "slow_trace", "trace_id": trace.trace_id, "spans": summary}})
+
+    def _dump_profile(self, trace: Trace, top: Span, profile: cProfile.Profile):
+        path = os.path.join(self.profile_dir, f"{top.name}-{trace.trace_id[16:]}-{int(time.time())}.prof")
+
+        def dump():
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile.dump_stats(path)
+            logger.info(f"🔬 Профиль {top.name} ({top.duration_ms:.0f} мс) записан в {path}")
+
+        try:
+            asyncio.get_running_loop().run_in_executor(None, dump)
+        except RuntimeError:
+            dump()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка экспорта трасс: {e}")
+
+    async def flush(self):
+        """Дописать накопленные трассы в файл экспорта"""
+        if not self._pending:
+            return
+        traces, self._pending = self._pending, []
+        line = json.dumps(to_otlp(traces), ensure_ascii=False) + "\n"
+        for trace in traces:
+            trace.exported = len(trace.spans)
+        await asyncio.to_thread(self._write, line)
+
+    def _write(self, line: str):
+        if os.path.exists(self.export_path) and os.path.getsize(self.export_path) + len(line) > TRACE_EXPORT_MAX_BYTES:
+            os.replace(self.export_path, f"{self.export_path}.1")
+        with open(self.export_path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+TRACER = Tracer()
+span = TRACER.span
+record_span = TRACER.record
+
+
+def current_trace_id() -> Optional[str]:
+    """trace_id текущей трассы — для связи структурированных логов со спанами"""
+    current = _current.get()
+    return current[0].trace_id if current is not None else None
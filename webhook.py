@@ -0,0 +1,132 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import WEBHOOK_QUEUE_DEPTH, WEBHOOK_UPDATES
+
+logger = logging.getLogger(__name__)
+
+# Быстрое подтверждение вебхука и внутренняя очередь
+WEBHOOK_FAST_ACK = os.getenv("WEBHOOK_FAST_ACK", "1") == "1"
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "500"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "64"))
+# Сколько ждать места в очереди, прежде чем вернуть Telegram 503
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+# Дедупликация повторных доставок по update_id
+DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", "3600"))
+DEDUP_MAX_SIZE = int(os.getenv("WEBHOOK_DEDUP_MAX_SIZE", "50000"))
+
+
+class UpdateDeduplicator:
+    """Ограниченное множество недавно виденных update_id с истечением по времени"""
+
+    def __init__(self, ttl: float = DEDUP_TTL, max_size: int = DEDUP_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: "OrderedDict[int, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def check_and_add(self, update_id: int) -> bool:
+        """True, если апдейт новый (и запомнить его), False — если повтор"""
+        now = time.monotonic()
+        self._expire(now)
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = now
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return True
+
+    def forget(self, update_id: int):
+        """Разрешить повторную доставку (апдейт не удалось принять)"""
+        self._seen.pop(update_id, None)
+
+    def _expire(self, now: float):
+        while self._seen:
+            update_id, added = next(iter(self._seen.items()))
+            if now - added < self.ttl:
+                break
+            del self._seen[update_id]
+
+
+class WebhookIntake:
+    """Принимает апдейты вебхука без ожидания обработки.
+
+    Апдейт кладется в ограниченную очередь, воркеры передают его в
+    update_processor приложения (параллельно по пользователям, по порядку
+    внутри пользователя). Повторные доставки отбрасываются, при полной
+    очереди Telegram получает 503 и доставит апдейт позже. shared_dedup
+    (cluster.SharedDeduplicator) ловит повторы, пришедшие на другую реплику.
+    """
+
+    def __init__(self, application: Application, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 workers: int = WEBHOOK_WORKERS, dedup: Optional[UpdateDeduplicator] = None,
+                 shared_dedup: Optional[Any] = None):
+        self.application = application
+        self.workers = workers
+        self.dedup = dedup or UpdateDeduplicator()
+        self.shared_dedup = shared_dedup
+        self.queue: "asyncio.Queue[Update]" = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+        WEBHOOK_QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    @property
+    def fill(self) -> float:
+        return self.queue.qsize() / self.queue.maxsize if self.queue.maxsize else 0.0
+
+    async def start(self):
+        for index in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"webhook-worker-{index}"))
+
+    async def stop(self):
+        """Дождаться разбора очереди и остановить воркеры"""
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def submit(self, update: Update) -> bool:
+        """Поставить апдейт в очередь; False — очередь переполнена"""
+        if not await self._is_new(update.update_id):
+            WEBHOOK_UPDATES.inc(result="duplicate")
+            logger.info(f"♻️ Повторная доставка апдейта {update.update_id} отброшена")
+            return True
+        try:
+            await asyncio.wait_for(self.queue.put(update), WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.dedup.forget(update.update_id)
+            if self.shared_dedup is not None:
+                await self.shared_dedup.forget(update.update_id)
+            WEBHOOK_UPDATES.inc(result="rejected")
+            logger.warning(f"🚦 Очередь вебхука заполнена, апдейт {update.update_id} отклонен")
+            return False
+        WEBHOOK_UPDATES.inc(result="accepted")
+        return True
+
+    async def _is_new(self, update_id: int) -> bool:
+        # Локальное множество отсекает частые повторы без похода в общее хранилище
+        if not self.dedup.check_and_add(update_id):
+            return False
+        if self.shared_dedup is not None and not await self.shared_dedup.check_and_add(update_id):
+            return False
+        return True
+
+    async def _worker(self):
+        application = self.application
+        while True:
+            update = await self.queue.get()
+            try:
+                await application.update_processor.process_update(update, application.process_update(update))
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки апдейта {update.update_id}: {e}", exc_info=e)
+            finally:
+                self.queue.task_done()